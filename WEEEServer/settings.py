@@ -47,6 +47,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # 请求跟踪，默认不启用，见 HTTP_TRACE_SAMPLE_RATE
+    'teemog1_api.middleware.RequestTraceMiddleware',
+    # 后台和导出读只读副本，未配置 REPLICA_DATABASES 时不启用。放在会话和认证之前，它们的查询也走副本
+    'teemog1_api.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -79,13 +83,78 @@ WSGI_APPLICATION = 'WEEEServer.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite 连接参数，每个新连接建立时执行 (见 OPTIONS['init_command'])。
+# WAL 模式下读不阻塞写、写不阻塞读；busy_timeout 为等待写锁的毫秒数，超过后才报 "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    # WAL 模式下 NORMAL 只在检查点时 fsync，掉电可能丢失最后几个事务，但不会损坏数据库
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # 负数单位为 KiB，即 64 MB
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+SQLITE_INIT_COMMAND = ';'.join('PRAGMA %s=%s' % item for item in SQLITE_PRAGMAS.items())
+
 DATABASES = {
+    # 写连接。事务以 BEGIN IMMEDIATE 开始，在事务开始时就取得写锁，
+    # 避免两个事务都从读锁升级为写锁时其中一个立即失败 (不会等待 busy_timeout)
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': {
+            'init_command': SQLITE_INIT_COMMAND,
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+    # 只读连接，事务外的查询由 ReadWriteRouter 路由到这里，不会占用写连接
+    'reader': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'init_command': SQLITE_INIT_COMMAND + ';PRAGMA query_only=1',
+        },
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
 }
 
+DATABASE_ROUTERS = ['teemog1_api.routers.ShardRouter', 'teemog1_api.routers.ReadWriteRouter']
+# ReadWriteRouter 使用的写库和读库
+WRITE_DATABASE = 'default'
+READ_DATABASE = 'reader'
+
+# ==============================================================================
+#  分片 (见 teemog1_api/sharding.py)
+# ==============================================================================
+# LocationPackage、LocationData 和 ChatLog 按设备分布在这些数据库中，只有一个时不分片。
+# 分片需要先在 DATABASES 中定义并执行 migrate --database <别名>，例如:
+#   'shard1': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'shard1.sqlite3',
+#              'OPTIONS': {'init_command': SQLITE_INIT_COMMAND}},
+#   SHARD_DATABASES = ['default', 'shard1']
+# 新增分片只影响新设备，已有设备用 rebalance_shards 命令迁移
+SHARD_DATABASES = ['default']
+# 设备 -> 分片 映射在每个进程中的缓存时间 (秒)，rebalance_shards 切换分片后等待同样长的时间再删除旧数据
+SHARD_MAP_TTL = 30
+# 后台跨分片查询的并行线程数，0 为依次查询
+SHARD_FANOUT_WORKERS = 8
+
+# ==============================================================================
+#  只读副本 (见 teemog1_api/replicas.py)
+# ==============================================================================
+# 后台和导出的只读请求使用的副本 (DATABASES 中的别名，由数据库自身的复制机制同步，
+# 例如 PostgreSQL 流复制或 SQLite + Litestream)，为空时不使用副本
+REPLICA_DATABASES = []
+# 使用副本的请求路径前缀，只有 GET/HEAD 请求使用副本
+REPLICA_PATH_PREFIXES = ('/admin/', '/location/history/export.do')
+# 请求中发生写入后，同一客户端在这段时间内 (秒) 的请求只读主库
+REPLICA_PIN_SECONDS = 5
+# 副本延迟超过该值 (秒) 时不使用，延迟由 replica_heartbeat 命令测量
+REPLICA_MAX_LAG = 10
+# 每个进程重新检查副本延迟的间隔 (秒)
+REPLICA_LAG_CHECK_INTERVAL = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -172,3 +241,140 @@ QQ_QR_URL = 'https://qm.qq.com/q/'
 TEEMOG1_QQ_CODE = 'rLGx8hsfV6'
 
 
+# ==============================================================================
+#  日志配置
+# ==============================================================================
+# 按模块配置日志级别，键为 logger 名称 (通常是模块路径)
+LOG_LEVELS = {
+    'teemog1_api': 'INFO',
+    'teemog1_api.management.commands.run_tcp_server': 'INFO',
+    # 逐包跟踪日志 (原始数据、十六进制转储、完整响应内容)，设为 DEBUG 才会输出
+    'teemog1_api.packets': 'INFO',
+    # HTTP 请求跟踪日志 (请求参数、请求体、响应体)，设为 DEBUG 才会启用 RequestTraceMiddleware
+    'teemog1_api.http': 'INFO',
+}
+
+# 逐包跟踪日志的采样率 (0.0 - 1.0)，只在 'teemog1_api.packets' 为 DEBUG 时生效
+TCP_PACKET_TRACE_SAMPLE_RATE = 0.01
+
+# HTTP 请求跟踪的采样率 (0.0 - 1.0)，以及请求体/响应体记录的最大字节数
+HTTP_TRACE_SAMPLE_RATE = 0.1
+HTTP_TRACE_MAX_BODY = 2048
+
+# 日志文件路径，为 None 时只输出到终端
+LOG_FILE = None
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        # 异步队列 Handler，磁盘 I/O 在后台线程完成，不阻塞事件循环
+        'async': {
+            '()': 'teemog1_api.log.AsyncQueueHandler',
+            'filename': LOG_FILE,
+        },
+    },
+    'root': {
+        'handlers': ['async'],
+        'level': 'WARNING',
+    },
+    'loggers': {name: {'level': level} for name, level in LOG_LEVELS.items()},
+}
+
+# ==============================================================================
+#  TCP 服务器指标 (Prometheus 文本格式)
+# ==============================================================================
+# run_tcp_server 在该地址上提供 /metrics，TCP_METRICS_PORT 设为 None 则关闭
+TCP_METRICS_HOST = '127.0.0.1'
+TCP_METRICS_PORT = 9464
+
+# ==============================================================================
+#  TCP 分帧与接收缓冲区
+# ==============================================================================
+# 各消息类型的最大帧长度 (字节，含 3 字节长度头)，未列出的已知类型使用 TCP_DEFAULT_MAX_FRAME_SIZE，
+# 未知类型使用 TCP_UNKNOWN_MAX_FRAME_SIZE。声明长度超过上限的帧头视为垃圾数据
+TCP_MAX_FRAME_SIZES = {
+    0x7a: 4 * 1024 * 1024,  # 聊天 (语音、图片)
+    0x7b: 512 * 1024,  # 通用消息 (通讯录同步等)
+}
+TCP_DEFAULT_MAX_FRAME_SIZE = 256 * 1024
+TCP_UNKNOWN_MAX_FRAME_SIZE = 64 * 1024
+# 连续丢弃多少字节仍找不到有效帧头时关闭连接
+TCP_MAX_GARBAGE_BYTES = 4096
+# 所有连接接收缓冲区合计的内存上限，超出时关闭新数据所在的连接
+TCP_BUFFER_BUDGET = 256 * 1024 * 1024
+
+# ==============================================================================
+#  TCP 服务器写数据库的组提交
+# ==============================================================================
+# 开启后登录、ping、状态、定位、聊天、通话记录、短信的写操作由一个写线程合并提交：
+# 第一个操作到达后最多等待 TCP_GROUP_COMMIT_WINDOW 秒或凑满 TCP_GROUP_COMMIT_MAX_OPS 个操作，一批只提交一次。
+# 窗口设为 0 时不额外等待，只合并上一批提交期间排队的操作
+TCP_GROUP_COMMIT = True
+TCP_GROUP_COMMIT_WINDOW = 0.005
+TCP_GROUP_COMMIT_MAX_OPS = 64
+
+# ==============================================================================
+#  重传去重 (见 teemog1_api/tcp_session.py)
+# ==============================================================================
+# 每个连接记住最近多少个定位数据包 / 聊天消息 id，手表重传的消息直接回复 ACK，不再访问数据库
+TCP_RECENT_LOCATION_IDS = 256
+TCP_RECENT_CHAT_IDS = 256
+
+# ==============================================================================
+#  异步入库 (定位、聊天、通话记录、短信先交给写前日志或 Redis Streams 再 ACK)
+# ==============================================================================
+# 日志目录，为 None 时 TCP 服务器直接写数据库；启用后需要同时运行 `python manage.py apply_journal`
+INGEST_JOURNAL_DIR = None  # 例如 BASE_DIR / 'journal'
+# 单个段文件的大小上限 (字节)
+INGEST_JOURNAL_SEGMENT_BYTES = 64 * 1024 * 1024
+# 批量 fsync：最多等待的时间 (秒) 和最多积累的记录数
+INGEST_JOURNAL_FSYNC_INTERVAL = 0.005
+INGEST_JOURNAL_FSYNC_BATCH = 256
+# apply_journal / run_ingest_workers 每个事务处理的记录数
+INGEST_APPLY_BATCH = 500
+
+# Redis Streams 入库：TCP 服务器发布到 Redis，`python manage.py run_ingest_workers` 批量写入数据库。
+# 与 INGEST_JOURNAL_DIR 二选一
+INGEST_STREAMS_URL = None  # 例如 'redis://127.0.0.1:6379/2'
+INGEST_STREAMS_GROUP = 'writers'
+# 每个 stream 保留的最大条数 (近似)，防止入库进程长时间停止时 Redis 内存无限增长，None 为不限制
+INGEST_STREAMS_MAXLEN = 1000000
+
+# ==============================================================================
+#  联系人号码索引
+# ==============================================================================
+# 最多缓存多少个设备的号码索引，以及每个设备索引的有效期 (秒)
+PHONE_INDEX_MAX_DEVICES = 1024
+PHONE_INDEX_TTL = 300
+# 联系人变化时通过该 Redis 的 contacts_notify 频道通知其他进程 (TCP 服务器) 让索引失效
+PHONE_INDEX_REDIS_URL = 'redis://localhost:6379/0'
+
+# ==============================================================================
+#  定位历史导出
+# ==============================================================================
+# 流式导出时每次从数据库取出的行数
+LOCATION_EXPORT_CHUNK_SIZE = 2000
+
+# ==============================================================================
+#  缓存
+# ==============================================================================
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # HTTP 与 TCP 进程共享的缓存 (设备 token、资源版本号)，一方写入/删除的内容必须对另一方可见
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'KEY_PREFIX': 'teemo',
+    },
+}
+
+# 设备认证使用的缓存名称，以及缓存的有效期 (秒)
+DEVICE_AUTH_CACHE = 'shared'
+DEVICE_AUTH_CACHE_TTL = 600
+
+# 设备资源版本号 (登录时下发的 *_ver) 使用的缓存名称和有效期 (秒)
+RESOURCE_VERSION_CACHE = 'shared'
+RESOURCE_VERSION_CACHE_TTL = 3600
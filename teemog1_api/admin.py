@@ -4,20 +4,227 @@ from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 from datetime import datetime
+import time
 
+from django.utils.http import urlencode
 from django.utils.text import Truncator
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Q, prefetch_related_objects
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+
+from .paginators import EstimatedCountPaginator, KeysetPaginator, ShardedKeysetPaginator
+from .phone_index import normalize_phone
+from .sharding import fan_out, shard_aliases, shard_queryset, sharding_enabled
+from .models import WatchDevice, LocationPackage, LocationData, Contact, ContactPhone, CallRecord, ChatLog, SmsMessage
+
+
+# --- 大表列表页的游标分页 ---
+CURSOR_VAR = 'cursor'
+# 分片模型详情页链接中的分片别名
+SHARD_VAR = 'shard'
+
+
+class ShardedChangeList(ChangeList):
+    """
+    分片模型的列表页。分片模式下设备表与数据不在同一个数据库中，不能 JOIN，
+    list_select_related 中的关联改为取出本页之后再 prefetch；详情页链接带上行所在的分片。
+    """
+
+    def prefetch_results(self):
+        related = self.model_admin.list_select_related
+        if sharding_enabled() and isinstance(related, (list, tuple)):
+            prefetch_related_objects(self.result_list, *related)
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.prefetch_results()
+
+    def url_for_result(self, result):
+        url = super().url_for_result(result)
+        if sharding_enabled():
+            url += '?' + urlencode({SHARD_VAR: result._state.db})
+        return url
+
+
+class KeysetChangeList(ShardedChangeList):
+    """
+    用 KeysetPaginator 代替 OFFSET 分页的列表页，只提供 "最新" 和 "更早" 两个翻页链接，
+    不计算总行数，也不支持按列排序。分片模式下在所有分片中并行查询并归并 (ShardedKeysetPaginator)。
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        # 游标不是字段过滤条件，在父类解析查询参数之前取出；从详情页返回时可能带有分片参数，一并去掉
+        self.cursor = request.GET.get(CURSOR_VAR)
+        if self.cursor is not None or SHARD_VAR in request.GET:
+            request.GET = request.GET.copy()
+            request.GET.pop(CURSOR_VAR, None)
+            request.GET.pop(SHARD_VAR, None)
+        super().__init__(request, *args, **kwargs)
+
+    def get_results(self, request):
+        if sharding_enabled():
+            paginator = ShardedKeysetPaginator({alias: self.queryset.using(alias) for alias in shard_aliases()},
+                                               self.list_per_page, self.model_admin.keyset_field)
+        else:
+            paginator = KeysetPaginator(self.queryset, self.list_per_page, self.model_admin.keyset_field)
+        try:
+            result_list, next_cursor = paginator.page(self.cursor)
+        except ValueError:
+            raise IncorrectLookupParameters
+        self.result_count = len(result_list)
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = False
+        self.paginator = paginator
+        self.first_page_url = self.get_query_string() if self.cursor else None
+        self.next_page_url = self.get_query_string({CURSOR_VAR: next_cursor}) if next_cursor else None
+        self.prefetch_results()
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """分片模式下按偏移分页的列表页一次只显示一个分片，没有选择时为第一个分片"""
+    title = '分片'
+    parameter_name = SHARD_VAR
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_aliases()]
+
+    def alias(self):
+        return self.value() if self.value() in shard_aliases() else shard_aliases()[0]
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.alias())
+
+    def choices(self, changelist):
+        # 没有 "全部" 选项
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': self.alias() == alias,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': title,
+            }
+
 
-from .models import WatchDevice, LocationPackage, LocationData, Contact, CallRecord, ChatLog, SmsMessage
+class ShardedAdminMixin:
+    """
+    分片模型 (见 sharding.py) 的后台。分片模式下：
+    * 列表页使用 ShardedChangeList，不 JOIN 设备表；
+    * 按设备 UDID 搜索时先在写库中查出设备主键；
+    * 详情页按链接中的分片参数查找对象，没有分片参数时只在对象恰好存在于一个分片中时返回它；
+    * 不提供批量操作 (操作的查询集无法确定分片)。
+    """
+    def get_changelist(self, request, **kwargs):
+        return ShardedChangeList
+
+    def get_list_select_related(self, request):
+        if sharding_enabled():
+            # 空元组而不是 False：为 False 时 list_display 中有外键字段仍会 select_related()
+            return ()
+        return super().get_list_select_related(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        if not sharding_enabled() or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        condition = Q()
+        for field in self.get_search_fields(request):
+            if field == 'device__udid':
+                device_ids = WatchDevice.objects.filter(udid__icontains=search_term).values_list('pk', flat=True)
+                condition |= Q(device_id__in=list(device_ids))
+            else:
+                condition |= Q(**{field + '__icontains': search_term})
+        return queryset.filter(condition), False
+
+    def get_actions(self, request):
+        if sharding_enabled():
+            return {}
+        return super().get_actions(request)
+
+    def get_preserved_filters(self, request):
+        # 删除、历史等页面的链接保留分片参数
+        preserved_filters = super().get_preserved_filters(request)
+        alias = request.GET.get(SHARD_VAR)
+        if sharding_enabled() and alias:
+            return '&'.join(filter(None, [preserved_filters, urlencode({SHARD_VAR: alias})]))
+        return preserved_filters
+
+    def get_object(self, request, object_id, from_field=None):
+        if not sharding_enabled():
+            return super().get_object(request, object_id, from_field)
+        model = self.model
+        field = model._meta.pk if from_field is None else model._meta.get_field(from_field)
+        try:
+            object_id = field.to_python(object_id)
+        except (ValidationError, ValueError):
+            return None
+        queryset = self.get_queryset(request)
+        alias = request.GET.get(SHARD_VAR)
+        aliases = [alias] if alias in shard_aliases() else shard_aliases()
+        found = [obj for obj in fan_out(lambda a: queryset.using(a).filter(**{field.name: object_id}).first(),
+                                        aliases).values() if obj is not None]
+        return found[0] if len(found) == 1 else None
+
+
+class KeysetPaginationMixin:
+    # 游标分页依据的字段，需要有索引 (最好是 (device, 字段) 联合索引)
+    keyset_field = 'stamp'
+    sortable_by = ()
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+class StampRangeFilter(admin.SimpleListFilter):
+    """按最近一段时间过滤，直接比较带索引的 stamp 列"""
+    title = '时间范围'
+    parameter_name = 'stamp_range'
+    # stamp 的单位: 1 为秒，1000 为毫秒
+    stamp_scale = 1
+    ranges = {
+        '1h': ('最近 1 小时', 3600),
+        '24h': ('最近 24 小时', 86400),
+        '7d': ('最近 7 天', 7 * 86400),
+        '30d': ('最近 30 天', 30 * 86400),
+    }
+
+    def lookups(self, request, model_admin):
+        return [(key, label) for key, (label, _) in self.ranges.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.ranges:
+            return queryset
+        since = int(time.time()) - self.ranges[self.value()][1]
+        return queryset.filter(stamp__gte=since * self.stamp_scale)
+
+
+class MillisecondStampRangeFilter(StampRangeFilter):
+    stamp_scale = 1000
 
 
 # --- 1. 定制 LocationPackage 的管理界面 (保持不变或简化) ---
 # 这个界面现在主要用于单独查看数据包详情
 @admin.register(LocationPackage)
-class LocationPackageAdmin(admin.ModelAdmin):
+class LocationPackageAdmin(ShardedAdminMixin, admin.ModelAdmin):
     list_display = ('msg_id', 'device_link', 'received_at', 'data_points_count')
     list_filter = ('received_at', 'device')
     search_fields = ('msg_id', 'device__udid')
     readonly_fields = ('device', 'msg_id', 'strategy', 'received_at')
+    list_select_related = ('device',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # 数据点数量通过一次聚合查询得到，而不是每行一次 COUNT
+        return super().get_queryset(request).annotate(_data_points_count=Count('data_points'))
+
+    def get_list_filter(self, request):
+        if sharding_enabled():
+            return (ShardListFilter,) + tuple(self.list_filter)
+        return self.list_filter
 
     def has_add_permission(self, request):
         return False
@@ -32,20 +239,33 @@ class LocationPackageAdmin(admin.ModelAdmin):
             return mark_safe(f'<a href="{url}">{obj.device.nick or obj.device.udid}</a>')
         return "N/A"
 
-    @admin.display(description='数据点数量')
+    @admin.display(description='数据点数量', ordering='_data_points_count')
     def data_points_count(self, obj):
-        return obj.data_points.count()
+        return obj._data_points_count
+
+
+def format_position(loc: LocationData) -> str:
+    """纬度, 经度 (精度, 定位方式)，入库时没有解析出位置的定位点为 N/A"""
+    if loc.lat is None or loc.lon is None:
+        return "N/A"
+    details = [f"±{loc.accuracy:g}m"] if loc.accuracy is not None else []
+    if loc.source:
+        details.append(loc.get_source_display())
+    return f"{loc.lat:.6f}, {loc.lon:.6f}" + (f" ({', '.join(details)})" if details else "")
 
 
 # --- 2. 定制 LocationData 的管理界面 (保持不变或简化) ---
 # 这个界面主要用于单独查看所有定位数据点
 @admin.register(LocationData)
-class LocationDataAdmin(admin.ModelAdmin):
+class LocationDataAdmin(KeysetPaginationMixin, ShardedAdminMixin, admin.ModelAdmin):
     ordering = ('-stamp',)
-    list_display = ('stamp_formatted', 'package_link', 'device_link', 'power', 'signal', 'sos')
+    list_display = ('stamp_formatted', 'package_link', 'device_link', 'position', 'power', 'signal', 'sos')
     readonly_fields = [field.name for field in LocationData._meta.fields]
-    list_filter = ('created_at',)
-    search_fields = ('package__device__udid',)  # 允许通过设备UDID搜索
+    # 过滤条件都落在 (device, stamp) 索引上
+    list_filter = ('device', StampRangeFilter)
+    search_fields = ('device__udid',)  # 允许通过设备UDID搜索
+    # 数据包和设备链接在同一条查询中取出
+    list_select_related = ('package__device',)
 
     def has_add_permission(self, request):
         return False
@@ -60,12 +280,16 @@ class LocationDataAdmin(admin.ModelAdmin):
             return mark_safe(f'<a href="{url}">{obj.package.msg_id}</a>')
         return "N/A"
 
-    @admin.display(description='时间', ordering='stamp')
+    @admin.display(description='时间')
     def stamp_formatted(self, obj):
         if obj.stamp:
             return datetime.fromtimestamp(obj.stamp).strftime('%Y-%m-%d %H:%M:%S')
         return "N/A"
 
+    @admin.display(description='位置')
+    def position(self, obj):
+        return format_position(obj)
+
     @admin.display(description='关联设备')
     def device_link(self, obj):
         if obj.package and obj.package.device:
@@ -139,9 +363,12 @@ class WatchDeviceAdmin(admin.ModelAdmin):
     # 默认排序方式，'-'表示降序
     ordering = ('-last_login',)
 
+    list_select_related = ('user',)
+
     @admin.display(description='定位历史 (点击时间可查看详情)')  # 修改描述以提示用户
     def display_latest_locations(self, obj):
-        locations = LocationData.objects.filter(package__device=obj).order_by('-stamp')[:10]
+        # 位置使用解析好的字段，不需要读取 geo 原文
+        locations = shard_queryset(LocationData, obj).defer('geo_encrypted', 'geo_decrypted').order_by('-stamp')[:10]
 
         if not locations:
             return "无定位记录"
@@ -165,7 +392,7 @@ class WatchDeviceAdmin(admin.ModelAdmin):
                     <th>电量</th>
                     <th>信号</th>
                     <th>SOS</th>
-                    <th>GEO (加密, 前30位)</th>
+                    <th>位置</th>
                 </tr>
             </thead>
             <tbody>
@@ -176,13 +403,14 @@ class WatchDeviceAdmin(admin.ModelAdmin):
             # 'admin:app名_模型名_change' 是 Django Admin URL 的命名规则
             # loc.pk 是 LocationData 实例的主键
             location_data_url = reverse("admin:teemog1_api_locationdata_change", args=[loc.pk])
+            if sharding_enabled():
+                location_data_url += '?' + urlencode({SHARD_VAR: loc._state.db})
 
             timestamp = datetime.fromtimestamp(loc.stamp).strftime('%Y-%m-%d %H:%M:%S') if loc.stamp else 'N/A'
             power = loc.power if loc.power is not None else 'N/A'
             signal = loc.signal if loc.signal is not None else 'N/A'
             sos = '是' if loc.sos == 1 else '否'
-            geo_preview = (loc.geo_decrypted[:30] + '...') if loc.geo_decrypted and len(
-                loc.geo_decrypted) > 30 else loc.geo_decrypted
+            position = format_position(loc)
 
             # 2. 将时间戳单元格包装在 <a> 标签中
             html += f"""
@@ -191,20 +419,46 @@ class WatchDeviceAdmin(admin.ModelAdmin):
                     <td>{power}</td>
                     <td>{signal}</td>
                     <td>{sos}</td>
-                    <td>{geo_preview}</td>
+                    <td>{position}</td>
                 </tr>
             """
 
         html += "</tbody></table>"
+        export_url = reverse('export_locations')
+        html += format_html('<p>导出全部定位点: <a href="{0}?user_id={1}">JSON Lines</a> | '
+                            '<a href="{0}?user_id={1}&output=csv">CSV</a></p>', export_url, obj.baby_id)
 
         return mark_safe(html)
 
 
+class ContactPhoneInline(admin.TabularInline):
+    model = ContactPhone
+    fields = ('phone', 'position')
+    extra = 0
+
+
 @admin.register(Contact)
 class ContactsAdmin(admin.ModelAdmin):
     list_display = ('name', 'phone', 'contacts_type', 'device')
     search_fields = ('name', 'phone')
     list_filter = ('device', 'contacts_type')
+    list_select_related = ('device',)
+    # 旧版 JSON 额外号码已迁移到 ContactPhone，在内联表格中编辑
+    exclude = ('ext',)
+    inlines = (ContactPhoneInline,)
+
+    def save_formset(self, request, form, formset, change):
+        instances = formset.save(commit=False)
+        for instance in instances:
+            instance.normalized = normalize_phone(instance.phone)
+            instance.save()
+        for obj in formset.deleted_objects:
+            obj.delete()
+        formset.save_m2m()
+
+    def get_queryset(self, request):
+        # 额外号码列在每一行都会用到，一次性预取
+        return super().get_queryset(request).prefetch_related('ext_phones')
 
     # 辅助方法，让 ext 字段在后台显示更友好
     def get_ext_phones_display(self, obj):
@@ -233,6 +487,10 @@ class ContactsAdmin(admin.ModelAdmin):
         # search_fields 在顶部提供一个搜索框
         search_fields = ('name', 'phone_number', 'device__udid')
 
+        list_select_related = ('device',)
+        paginator = EstimatedCountPaginator
+        show_full_result_count = False
+
         # readonly_fields 指定哪些字段在详情页是只读的
         readonly_fields = ('device', 'contact', 'name', 'phone_number', 'call_type', 'duration', 'stamp',
                            'record_id', 'geo_data_json')
@@ -262,17 +520,19 @@ class ContactsAdmin(admin.ModelAdmin):
 
 
 @admin.register(ChatLog)
-class ChatLogAdmin(admin.ModelAdmin):
+class ChatLogAdmin(KeysetPaginationMixin, ShardedAdminMixin, admin.ModelAdmin):
     # 列表页显示哪些字段
     list_display = (
     'device', 'from_to_display', 'get_content_type_display', 'content_summary', 'formatted_stamp', 'received_at')
 
     # 列表页右侧的过滤器
-    list_filter = ('device', 'content_type', 'chat_type', 'received_at')
+    list_filter = ('device', 'content_type', 'chat_type', MillisecondStampRangeFilter)
 
     # 顶部搜索框可以搜索的字段
     search_fields = ('message_id', 'from_user_id', 'to_id', 'content_text', 'device__udid')
 
+    list_select_related = ('device',)
+
     # 详情页的字段布局
     fieldsets = (
         ('消息概览', {
@@ -366,4 +626,5 @@ class ChatLogAdmin(admin.ModelAdmin):
 class SmsAdmin(admin.ModelAdmin):
     # 列表页显示哪些字段
     list_display = (
-        'device', 'phone', 'message', 'error_cause', 'stamp')
+        'device', 'phone', 'contact', 'message', 'error_cause', 'stamp')
+    list_select_related = ('device', 'contact__device')
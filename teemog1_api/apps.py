@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class WatchApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'teemog1_api'
+
+    def ready(self):
+        # 注册模型信号
+        from teemog1_api import signals  # noqa: F401
@@ -0,0 +1,105 @@
+"""
+手表 HTTP 接口的设备认证。
+
+手表和 App 调用 HTTP 接口时携带登录 (TCP 0x14) 时下发的 http_token，以及 user_id (baby_id) 或 sn (udid)。
+token -> 设备 的映射缓存在 Django 缓存 DEVICE_AUTH_CACHE 中，TCP 服务器在登录更换 token 时
+删除旧 token 并写入新 token (见 remember_device_token)，设备的身份字段被修改或设备被删除时
+删除缓存 (见 signals.py 中的 forget_device_tokens)，所以该缓存必须是 HTTP 与 TCP 进程共享的 (Redis)。
+缓存不可用时退回到数据库查询。
+
+HTTP 视图是异步的，使用 aauthenticate_device。
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+
+from teemog1_api.models import WatchDevice
+
+logger = logging.getLogger(__name__)
+
+
+def _cache():
+    return caches[getattr(settings, 'DEVICE_AUTH_CACHE', 'default')]
+
+
+def _cache_key(token) -> str:
+    return 'device_token:%s' % token
+
+
+def get_device_by_token(token):
+    """返回 token 对应的设备，token 无效时返回 None"""
+    try:
+        device = _cache().get(_cache_key(token))
+    except Exception as e:
+        logger.warning("[!] 读取设备认证缓存失败: %s", e)
+        device = None
+    if device is not None:
+        return device
+
+    try:
+        device = WatchDevice.objects.filter(http_token=token).first()
+    except ValidationError:
+        # 不是合法的 UUID
+        return None
+    if device is not None:
+        remember_device_token(device)
+    return device
+
+
+async def aget_device_by_token(token):
+    """get_device_by_token 的异步版本，供异步视图使用"""
+    try:
+        device = await _cache().aget(_cache_key(token))
+    except Exception as e:
+        logger.warning("[!] 读取设备认证缓存失败: %s", e)
+        device = None
+    if device is not None:
+        return device
+
+    try:
+        device = await WatchDevice.objects.filter(http_token=token).afirst()
+    except ValidationError:
+        return None
+    if device is not None:
+        await sync_to_async(remember_device_token)(device)
+    return device
+
+
+def _identity_matches(device: WatchDevice, baby_id, udid) -> bool:
+    if not (baby_id or udid):
+        return False
+    if baby_id and str(device.baby_id) != str(baby_id):
+        return False
+    if udid and device.udid != udid:
+        return False
+    return True
+
+
+async def aauthenticate_device(token, baby_id=None, udid=None):
+    """token 有效且与 baby_id / udid 一致时返回设备，否则返回 None"""
+    if not token:
+        return None
+    device = await aget_device_by_token(token)
+    return device if device is not None and _identity_matches(device, baby_id, udid) else None
+
+
+def remember_device_token(device: WatchDevice, old_token=None):
+    """缓存设备当前的 token，old_token 不为空时同时让旧 token 失效"""
+    try:
+        cache = _cache()
+        if old_token and str(old_token) != str(device.http_token):
+            cache.delete(_cache_key(old_token))
+        cache.set(_cache_key(device.http_token), device, getattr(settings, 'DEVICE_AUTH_CACHE_TTL', 600))
+    except Exception as e:
+        logger.warning("[!] 写入设备认证缓存失败: %s", e)
+
+
+def forget_device_tokens(*tokens):
+    """删除这些 token 的缓存，下次认证时重新查询数据库"""
+    try:
+        _cache().delete_many([_cache_key(token) for token in tokens if token])
+    except Exception as e:
+        logger.warning("[!] 删除设备认证缓存失败: %s", e)
@@ -0,0 +1,93 @@
+"""
+手表协议抓包文件的读写。
+
+文件格式 (紧凑二进制，可选 .gz 压缩)::
+
+    b'TMCAP1\\n'
+    重复: [4字节 相对起始时间(毫秒)][1字节 方向][4字节 帧长度][帧原始字节]
+
+方向 0 表示 手表 -> 服务器，1 表示 服务器 -> 手表。帧原始字节就是 TCP 流中的
+一个完整包 ([3字节长度][版本][类型][payload])，类型可以直接从第 5 个字节读出。
+"""
+import gzip
+import struct
+import time
+from dataclasses import dataclass
+
+MAGIC = b'TMCAP1\n'
+RECORD_HEADER = struct.Struct('>IBI')
+
+TO_SERVER = 0
+TO_WATCH = 1
+
+
+@dataclass
+class CapturedFrame:
+    offset_ms: int
+    direction: int
+    frame: bytes
+
+    @property
+    def msg_type(self) -> int:
+        return self.frame[4] if len(self.frame) > 4 else -1
+
+
+def _open(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def split_frames(buffer: bytes):
+    """
+    从字节流缓冲区中切出所有完整的帧。
+    :return: (完整帧列表, 剩余未完整的字节)
+    """
+    frames = []
+    while len(buffer) >= 3:
+        total = 3 + struct.unpack('>i', b'\x00' + buffer[:3])[0]
+        if len(buffer) < total:
+            break
+        frames.append(buffer[:total])
+        buffer = buffer[total:]
+    return frames, buffer
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self._file = _open(path, 'wb')
+        self._file.write(MAGIC)
+        self._start = time.monotonic()
+
+    def write(self, direction: int, frame: bytes):
+        offset_ms = int((time.monotonic() - self._start) * 1000)
+        self._file.write(RECORD_HEADER.pack(offset_ms, direction, len(frame)))
+        self._file.write(frame)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    逐条读取抓包文件，返回 CapturedFrame 迭代器。
+    录制进程被强制结束时文件末尾可能不完整，读到截断处即停止。
+    """
+    with _open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("不是有效的抓包文件: %s" % path)
+        try:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                offset_ms, direction, length = RECORD_HEADER.unpack(header)
+                frame = f.read(length)
+                if len(frame) < length:
+                    return
+                yield CapturedFrame(offset_ms, direction, frame)
+        except EOFError:
+            return
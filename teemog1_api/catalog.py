@@ -0,0 +1,234 @@
+"""
+静态目录接口 (应用列表、主题、表盘、表情包、版本检查) 的内容与缓存。
+
+每个目录由一个构造函数 build(version, **params) 生成完整的响应 dict。进程内第一次访问时：
+
+1. 用 build(None) 计算内容摘要，与数据库中的 CatalogVersion 比较，内容变化时才更新版本号
+   (版本号取变化时的时间戳，保证比以前下发过的 int(time.time()) 大)；
+2. 序列化出响应体，连同 ETag / Last-Modified 一起缓存，之后的请求直接返回缓存的字节串，
+   手表带 If-None-Match / If-Modified-Since 且内容未变时返回 304。
+
+修改目录内容后重启服务即可，版本号会自动更新。
+"""
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from teemog1_api.models import CatalogVersion
+
+# 每个目录最多缓存多少组不同参数的响应体 (例如不同的表情包 ID)
+MAX_BODIES_PER_CATALOG = 64
+
+
+@dataclass
+class CatalogBody:
+    body: bytes
+    etag: str
+    version: int
+    last_modified: datetime
+
+
+def _digest(content) -> str:
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _sync_version(name: str, digest: str) -> CatalogVersion:
+    with transaction.atomic():
+        row, created = CatalogVersion.objects.select_for_update().get_or_create(
+            name=name, defaults={'digest': digest, 'version': int(time.time())})
+        if not created and row.digest != digest:
+            row.digest = digest
+            row.version = max(int(time.time()), row.version + 1)
+            row.save()
+    return row
+
+
+class CatalogEntry:
+
+    def __init__(self, name: str, build):
+        self.name = name
+        self.build = build
+        self._row = None
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def body(self, **params) -> CatalogBody:
+        key = tuple(sorted(params.items()))
+        cached = self._bodies.get(key)
+        if cached is not None:
+            return cached
+
+        row = self._version_row()
+        body = json.dumps(self.build(row.version, **params)).encode('utf-8')
+        cached = CatalogBody(body, '"%s"' % hashlib.md5(body).hexdigest(), row.version, row.updated_at)
+        if len(self._bodies) < MAX_BODIES_PER_CATALOG:
+            self._bodies[key] = cached
+        return cached
+
+    def _version_row(self) -> CatalogVersion:
+        with self._lock:
+            if self._row is None:
+                self._row = _sync_version(self.name, _digest(self.build(None)))
+            return self._row
+
+    def version(self) -> int:
+        """当前内容的版本号，登录时作为 *_ver 下发给手表"""
+        return self._version_row().version
+
+    def response(self, request, **params) -> HttpResponse:
+        cached = self.body(**params)
+        response = get_conditional_response(request, etag=cached.etag,
+                                            last_modified=int(cached.last_modified.timestamp()))
+        if response is None:
+            response = HttpResponse(cached.body, content_type='application/json')
+        response['ETag'] = cached.etag
+        response['Last-Modified'] = http_date(cached.last_modified.timestamp())
+        return response
+
+    async def aresponse(self, request, **params) -> HttpResponse:
+        """response 的异步版本，只有第一次生成响应体 (需要访问数据库) 时才切换到线程中执行"""
+        if tuple(sorted(params.items())) not in self._bodies:
+            await sync_to_async(self.body)(**params)
+        return self.response(request, **params)
+
+    def reset(self):
+        with self._lock:
+            self._row = None
+            self._bodies = {}
+
+
+# --- 目录内容 ---
+def build_apps(version):
+    # 构造应用列表数据 (对应 AppStoreBean)
+    app_list = [
+        {
+            "id": 1,
+            "name": "聊天",
+            "package_name": "com.sogou.teemo.watch.chat",
+            "icon_url": "http://192.168.2.99:8000/static/icon/chat.png",  # 替换为你实际的图标地址
+            "version": "1",
+            "version_format": "1",
+            "pkg_url": "http://192.168.2.99:8000/static/apk/chat.apk",  # 替换为实际APK下载地址
+            "pkg_size": 1024 * 1024 * 5,  # 5MB，单位字节
+            "pkg_hashcode": "md5_of_apk",  # 如果有校验逻辑，这里需要真实的MD5
+            "status": 1,  # 状态码很重要，通常 0:下载 1:更新 3:打开 等，具体需测试
+            "content_type": 1,
+            "display_version": "1",
+            "description": "这是聊天应用",
+            "digest": "聊天应用简介"
+        },
+        {
+            "id": 2,
+            "name": "电话",
+            "package_name": "com.sogou.teemo.watch.phone",
+            "version": "1",
+            "pkg_url": "",
+            "status": 3  # 假设3是已安装/系统应用
+        }
+    ]
+
+    return {
+        "code": 200,
+        "status": 200,  # 外层状态码，视框架而定，有些是 code: 0
+        "msg": "success",
+        "data": {
+            # 对应 AppStoreServerBean
+            "apps": {
+                # 对应 AppStoreServerBean.Apps 内部类
+                "data": app_list,  # <--- 这才是真正的列表，名字必须叫 data
+                "page_index": 1,
+                "page_size": 20,
+                "total_count": len(app_list)
+            },
+            # 对应 AppStoreServerBean.installed_apps
+            "installed_apps": []
+        }
+    }
+
+
+def build_packages(version):
+    """主题和表盘: 暂无可下载的包"""
+    return {
+        "message": {"content": "成功", "notice": ""},
+        "data": {"packages": [], "version": version}
+    }
+
+
+def build_emoticon_package(version, package_id=1):
+    # 构建符合 Java 端 EmojiPackageBean 和 EmojiBean 结构的响应数据
+    emoticon_package_data = {
+        "package_id": package_id,
+        "name": "默认表情",
+        "version": version,
+        "emoticons": [
+            # {
+            #     "id": "1_1",
+            #     "tag": "[哈哈]",
+            #     "url": "http://192.168.2.132:8000/static/emojis/haha.gif",
+            #     "type": 1,
+            #     "index": 1,
+            #     "static_url": "http://192.168.2.132:8000/static/emojis/haha.png"
+            # },
+            # {
+            #     "id": "1_2",
+            #     "tag": "[可爱]",
+            #     "url": "http://192.168.2.132:8000/static/emojis/keai.gif",
+            #     "type": 1,
+            #     "index": 2,
+            #     "static_url": "http://192.168.2.132:8000/static/emojis/keai.png"
+            # },
+            # {
+            #     "id": "1_3",
+            #     "tag": "[飞吻]",
+            #     "url": "http://192.168.2.132:8000/static/emojis/feiwen.gif",
+            #     "type": 1,
+            #     "index": 3,
+            #     "static_url": "http://192.168.2.132:8000/static/emojis/feiwen.png"
+            # },
+            # {
+            #     "id": "1_4",
+            #     "tag": "[白眼]",
+            #     "url": "http://192.168.2.132:8000/static/emojis/baiyan.gif",
+            #     "type": 1,
+            #     "index": 4,
+            #     "static_url": "http://192.168.2.132:8000/static/emojis/baiyan.png"
+            # }
+        ]
+    }
+
+    # 包装在顶层结构中
+    return {
+        "message": {"content": "成功", "notice": ""},
+        "data": emoticon_package_data
+    }
+
+
+def build_version(version):
+    return {
+        "message": {"content": "已经是最新版本", "notice": ""},
+        "data": {}
+    }
+
+
+apps = CatalogEntry('apps', build_apps)
+themes = CatalogEntry('themes', build_packages)
+dials = CatalogEntry('dials', build_packages)
+emoticons = CatalogEntry('emoticons', build_emoticon_package)
+app_version = CatalogEntry('app_version', build_version)
+
+ENTRIES = (apps, themes, dials, emoticons, app_version)
+
+
+def reset():
+    """清空进程内缓存，下次访问时重新计算摘要和响应体"""
+    for entry in ENTRIES:
+        entry.reset()
@@ -0,0 +1,101 @@
+"""
+TCP 长连接的分帧。
+
+帧格式: 3 字节长度 (大端序，等于 版本+类型+payload 的长度) + 1 字节版本 + 1 字节类型 + payload。
+
+FrameDecoder 从接收到的字节流中切出完整的帧：
+
+* 每种消息类型有各自的最大帧长度，未知类型使用 unknown_max_size。格式正确的未知类型帧照常切出，
+  由调用方跳过，不会卡在缓冲区头部；
+* 声明长度不合理 (小于 2 或超过该类型的上限) 的帧头视为垃圾数据，逐字节向后查找下一个合理的帧头。
+  连续丢弃超过 max_garbage 字节时抛出 FrameError，调用方应关闭连接；
+* 所有连接的接收缓冲区共享一个 BufferBudget，超出预算时抛出 FrameError。
+"""
+
+HEADER_SIZE = 5
+# 声明长度至少包含版本和类型两个字节
+MIN_DECLARED_LENGTH = 2
+
+
+class FrameError(Exception):
+    """数据流无法继续解析，或缓冲区超出内存预算，连接应当关闭"""
+
+
+class BufferBudget:
+    """所有连接接收缓冲区共享的内存预算 (字节)，只在事件循环线程中使用"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def resize(self, old: int, new: int) -> bool:
+        """把一个缓冲区的占用从 old 调整为 new，超出预算时返回 False 且不做修改"""
+        if new > old and self.used - old + new > self.limit:
+            return False
+        self.used += new - old
+        return True
+
+
+class FrameDecoder:
+
+    def __init__(self, max_frame_sizes: dict, unknown_max_size: int, max_garbage: int, budget: BufferBudget = None):
+        # 上限是整帧长度 (含 3 字节长度头)，换算成声明长度的上限，
+        # 并按类型预先展开成长度为 256 的列表，每帧只需一次下标访问
+        self._max_sizes = [max_frame_sizes.get(msg_type, unknown_max_size) - 3 for msg_type in range(256)]
+        self._max_any = max(self._max_sizes)
+        self.max_garbage = max_garbage
+        self.budget = budget
+        self._buffer = bytearray()
+        self._reserved = 0
+        # 自上一个有效帧以来连续丢弃的字节数，以及整个连接累计丢弃的字节数
+        self.garbage = 0
+        self.discarded = 0
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> list:
+        """追加收到的数据，返回其中所有完整的帧 (bytes，包含帧头)"""
+        if self.budget is not None and not self.budget.resize(self._reserved, len(self._buffer) + len(data)):
+            raise FrameError('接收缓冲区超出内存预算 (%d 字节)' % self.budget.limit)
+        self._reserved = len(self._buffer) + len(data)
+        self._buffer += data
+
+        buffer = self._buffer
+        frames = []
+        pos = 0
+        end = len(buffer)
+        while end - pos >= 3:
+            length = int.from_bytes(buffer[pos:pos + 3], 'big')
+            if MIN_DECLARED_LENGTH <= length <= self._max_any and (
+                    end - pos < HEADER_SIZE or length <= self._max_sizes[buffer[pos + 4]]):
+                if end - pos < 3 + length:
+                    # 帧头合理，等待剩余数据
+                    break
+                frames.append(bytes(buffer[pos:pos + 3 + length]))
+                pos += 3 + length
+                self.garbage = 0
+                continue
+
+            # 帧头不合理，丢弃一个字节后重新同步
+            pos += 1
+            self.garbage += 1
+            self.discarded += 1
+            if self.garbage > self.max_garbage:
+                del buffer[:pos]
+                raise FrameError('连续 %d 字节无法解析为有效帧' % self.garbage)
+
+        if pos:
+            del buffer[:pos]
+        if self.budget is not None:
+            self.budget.resize(self._reserved, len(buffer))
+        self._reserved = len(buffer)
+        return frames
+
+    def close(self):
+        """连接关闭时调用，归还占用的内存预算"""
+        if self.budget is not None:
+            self.budget.resize(self._reserved, 0)
+        self._reserved = 0
+        self._buffer = bytearray()
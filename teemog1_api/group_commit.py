@@ -0,0 +1,164 @@
+"""
+TCP 服务器数据库写入的组提交 (group commit)。
+
+每个处理函数单独提交时，SQLite 的每次提交都是一次 fsync，几百个手表同时上报 ping、状态和定位时
+就是每秒几百次 fsync。GroupCommitter 在一个专用的写线程 (使用自己的数据库连接) 中执行所有写操作：
+第一个操作到达后最多再等待 window 秒或凑满 max_ops 个操作，把这一批放在同一个事务中执行，
+每个操作有自己的保存点，单个操作出错只回滚它自己；事务提交后才把结果返回给各个等待的协程。
+外键约束延迟到提交时才检查，保存点发现不了，这时整批提交失败，改为每个操作单独一个事务重新执行。
+
+用法::
+
+    @group_commit_task
+    def handle_xxx_db(device_instance, payload, **kwargs):
+        ...
+"""
+import asyncio
+import functools
+import logging
+import queue
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from teemog1_api.metrics import DB_WAIT_SECONDS, GROUP_COMMIT_OPS
+
+logger = logging.getLogger(__name__)
+
+
+def _resolve(future: asyncio.Future, ok: bool, value):
+    if future.done():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+def _call_soon(future: asyncio.Future, callback, *args):
+    """在 future 所属的事件循环线程中执行 callback"""
+    try:
+        future.get_loop().call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # 事件循环已经关闭 (服务器退出)，结果无人等待
+        pass
+
+
+class GroupCommitter:
+
+    def __init__(self, window: float = 0.005, max_ops: int = 64, using: str = DEFAULT_DB_ALIAS):
+        self.window = window
+        self.max_ops = max_ops
+        self.using = using
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """处理完已提交的操作后停止写线程"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    async def submit(self, func, *args, **kwargs):
+        """在写线程中执行 func(*args, **kwargs)，所在批次提交后返回它的结果"""
+        if self._thread is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put((func, args, kwargs, future))
+        return await future
+
+    def _collect(self, first) -> tuple:
+        """从第一个操作开始收集一批，返回 (批次, 是否收到停止信号)"""
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_ops:
+            try:
+                if self.window > 0:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    # 不等待，只合并上一批提交期间排队的操作
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stopping = self._collect(first)
+            self._commit(batch)
+        connections[self.using].close()
+
+    def _commit_one(self, func, args, kwargs) -> tuple:
+        try:
+            with transaction.atomic(using=self.using):
+                return True, func(*args, **kwargs)
+        except Exception as e:
+            logger.error("[!] 操作 %s 提交失败: %s", getattr(func, '__name__', func), e)
+            connections[self.using].close_if_unusable_or_obsolete()
+            return False, e
+
+    def _commit(self, batch: list):
+        results = []
+        try:
+            with transaction.atomic(using=self.using):
+                for func, args, kwargs, _ in batch:
+                    try:
+                        with transaction.atomic(using=self.using):
+                            results.append((True, func(*args, **kwargs)))
+                    except Exception as e:
+                        results.append((False, e))
+        except Exception as e:
+            logger.warning("[!] 组提交失败 (%d 个操作)，改为逐个提交: %s", len(batch), e)
+            # 连接断开等错误之后重新建立连接
+            connections[self.using].close_if_unusable_or_obsolete()
+            # 在保存点中已经出错的操作保留原来的错误，其余 (包括还没执行到的) 重新执行
+            results += [(True, None)] * (len(batch) - len(results))
+            results = [self._commit_one(func, args, kwargs) if ok else (ok, value)
+                       for (func, args, kwargs, _), (ok, value) in zip(batch, results)]
+        # 指标只在事件循环线程中更新 (见 metrics.py)
+        _call_soon(batch[0][3], GROUP_COMMIT_OPS.observe, len(batch))
+        for (_, _, _, future), (ok, value) in zip(batch, results):
+            _call_soon(future, _resolve, future, ok, value)
+
+
+committer = GroupCommitter(window=getattr(settings, 'TCP_GROUP_COMMIT_WINDOW', 0.005),
+                           max_ops=getattr(settings, 'TCP_GROUP_COMMIT_MAX_OPS', 64))
+
+
+def group_commit_task(func):
+    """
+    TCP 服务器写数据库的处理函数使用的装饰器，TCP_GROUP_COMMIT 为 True 时通过 committer 组提交，
+    否则等同于 run_tcp_server.db_task。func.__wrapped__ 仍然是原来的同步函数。
+    """
+    async_func = database_sync_to_async(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with DB_WAIT_SECONDS.time(handler=func.__name__):
+            if getattr(settings, 'TCP_GROUP_COMMIT', False):
+                return await committer.submit(func, *args, **kwargs)
+            return await async_func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,546 @@
+"""
+定位、聊天、通话记录和短信的入库逻辑。
+
+默认由 TCP 服务器的处理函数直接调用。TCP 服务器也可以只把消息转交出去并立即回复 ACK：
+
+* 配置了 INGEST_JOURNAL_DIR 时写入写前日志 (见 journal.py)，由 apply_journal 命令运行 JournalConsumer
+  按顺序入库：每批记录和检查点 (IngestCheckpoint) 在同一个事务中提交，崩溃后从检查点重放，不会重复写入；
+  一批提交失败 (外键错误在提交时才发现) 时逐条重新提交，仍然失败的记录移入死信文件，
+  其他数据库错误 (例如数据库被锁) 不移动检查点，这批记录稍后重试；
+* 配置了 INGEST_STREAMS_URL 时发布到 Redis Streams (见 streams.py)，由 run_ingest_workers 命令
+  以消费组的方式读取，调用 apply_records 批量入库。
+
+定位和聊天写入设备所在的分片 (见 sharding.py)。分片与写库不是同一个数据库时，
+它们不在检查点或外层事务的保护范围内。
+"""
+import base64
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from datetime import timezone as datetimezone
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+from django.utils import timezone
+
+from teemog1_api.journal import read_records, purge_segments, append_dead_letter
+from teemog1_api.models import (WatchDevice, Contact, LocationPackage, LocationData, CallRecord, ChatLog, SmsMessage,
+                                IngestCheckpoint)
+from teemog1_api.NativeUtils import NativeUtils
+from teemog1_api.phone_index import phone_index
+from teemog1_api.sharding import shard_map
+
+logger = logging.getLogger(__name__)
+
+# 日志记录的类型
+LOCATION = 'location'
+CHAT = 'chat'
+CALL_RECORDS = 'call_records'
+SMS = 'sms'
+
+# 记录本身的数据问题，重试也不会成功，移入死信文件后跳过。
+# 数据库被锁、连接断开等其他错误向上抛出，检查点不前进，这批记录稍后重试
+RECORD_ERRORS = (IntegrityError, DataError, KeyError, ValueError, TypeError)
+
+
+def decode_geo(geo) -> str:
+    """解密手表上报的 geo 字段，返回 JSON 字符串，失败时返回空字符串"""
+    if not geo:
+        return ''
+    try:
+        if isinstance(geo, str):
+            return NativeUtils.decrypt(base64.decodebytes(geo.encode('utf8')), 5)
+        elif isinstance(geo, dict):
+            return json.dumps(geo)
+        else:
+            return geo
+    except Exception:
+        return ''
+
+
+# geo 中表示定位方式的值 (小写) 所包含的关键字
+GEO_SOURCES = (('gps', LocationData.Source.GPS), ('wifi', LocationData.Source.WIFI),
+               ('cell', LocationData.Source.CELL), ('lbs', LocationData.Source.CELL))
+
+
+def _geo_float(geo: dict, *keys):
+    for key in keys:
+        try:
+            return float(geo[key])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def parse_geo(decoded: str) -> dict:
+    """
+    从 decode_geo 的结果中取出 LocationData 的 lat、lon、accuracy、source 字段，
+    不是 JSON 对象或没有有效的经纬度时返回空字典
+    """
+    try:
+        geo = json.loads(decoded) if decoded else None
+    except ValueError:
+        return {}
+    if not isinstance(geo, dict):
+        return {}
+    lat = _geo_float(geo, 'lat', 'latitude')
+    lon = _geo_float(geo, 'lon', 'lng', 'longitude')
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return {}
+    source = str(geo.get('source') or geo.get('type') or '').lower()
+    return {
+        'lat': lat,
+        'lon': lon,
+        'accuracy': _geo_float(geo, 'accuracy', 'radius'),
+        'source': next((value for keyword, value in GEO_SOURCES if keyword in source), ''),
+    }
+
+
+def _msg_id(payload: dict) -> str:
+    return str(payload.get('id') or '')
+
+
+def apply_location(device: WatchDevice, payload: dict):
+    """
+    保存一个定位数据包及其中的所有定位点。数据包已经保存过 (手表没收到 ACK 而重传，
+    由 (设备, msg_id) 唯一约束发现) 时不写入，返回 None
+    """
+    alias = shard_map.alias_for(device)
+    msg_id = _msg_id(payload)
+    try:
+        with transaction.atomic(using=alias):
+            location_package = LocationPackage.objects.using(alias).create(
+                device=device,
+                user=device.user,
+                msg_id=msg_id,
+                strategy=payload.get('strategy'),
+                received_at=timezone.now()
+            )
+            LocationData.objects.using(alias).bulk_create(_location_points(location_package, device, payload))
+    except IntegrityError:
+        if not msg_id or not LocationPackage.objects.using(alias).filter(device=device, msg_id=msg_id).exists():
+            raise
+        logger.info("[*] 设备 %s 重传的定位数据包 %s 已保存过，忽略。", device.udid, msg_id)
+        return None
+    return location_package
+
+
+def _location_points(package: LocationPackage, device: WatchDevice, payload: dict) -> list:
+    points = []
+    for _data in payload.get('data'):
+        if not isinstance(_data, dict):
+            continue
+        geo = _data.get('geo', '')
+        geo_decrypted = decode_geo(geo)
+        points.append(LocationData(
+            package=package,
+            device=device,
+            # 数据点信息
+            stamp=_data.get('stamp', 0),
+            power=_data.get('power', 0),
+            signal=_data.get('signal', 0),
+            sos=_data.get('sos', 0),
+            reply_loc=_data.get('reply_loc', 0),
+            geo_encrypted=geo,
+            geo_decrypted=geo_decrypted,
+            valid_wifis=','.join([str(i) for i in _data.get('valid_wifi', {}).get('id', [])]),
+            created_at=timezone.now(),
+            **parse_geo(geo_decrypted)
+        ))
+    return points
+
+
+def apply_chat(device: WatchDevice, payload: dict, binary_payload: bytes = None) -> bool:
+    """
+    保存一条聊天消息，消息已存在时返回 False。
+    不事先查询，重复的消息由 message_id 唯一约束发现，通常只执行一次 INSERT
+    """
+    message_id = payload.get('id')
+    alias = shard_map.alias_for(device)
+    try:
+        with transaction.atomic(using=alias):
+            _chat_log(device, payload, binary_payload).save(using=alias)
+    except IntegrityError:
+        if not ChatLog.objects.using(alias).filter(message_id=message_id).exists():
+            raise
+        logger.warning("[*] 收到重复的聊天消息 %s，忽略处理。", message_id)
+        return False
+    logger.info("[*] 已成功保存来自 %s 的聊天消息 %s。", device.udid, message_id)
+    return True
+
+
+def _chat_log(device: WatchDevice, payload: dict, binary_payload: bytes = None) -> ChatLog:
+    """构造 ChatLog (不保存)，语音文件直接写入 MEDIA_ROOT"""
+    message_id = payload.get('id')
+    content = payload.get('content', {})
+    content_type = payload.get('content_type')
+
+    chat_log_data = {
+        'device': device,
+        'message_id': message_id,
+        'chat_type': payload.get('chat_type'),
+        'content_type': content_type,
+        'from_user_id': payload.get('from_user_id'),
+        'to_id': payload.get('to_id'),
+        'stamp': payload.get('stamp'),
+    }
+
+    if content_type == ChatLog.ContentType.TEXT:
+        chat_log_data['content_text'] = content.get('text')
+    elif content_type == ChatLog.ContentType.VOICE:
+        chat_log_data['voice_length'] = content.get('voice_length', 0)
+        if binary_payload:
+            # 定义存储路径
+            voice_dir = os.path.join(settings.MEDIA_ROOT, 'voice_messages', device.udid)
+            os.makedirs(voice_dir, exist_ok=True)
+            # 使用 message_id 作为文件名保证唯一性，后缀为 .amr
+            file_name = f"{message_id}.amr"
+            file_path = os.path.join(voice_dir, file_name)
+            with open(file_path, 'wb') as f:
+                f.write(binary_payload)
+            # 在数据库中存储相对路径
+            chat_log_data['content_file_path'] = os.path.join('voice_messages', device.udid, file_name)
+            logger.debug("[*] 语音消息已保存至: %s", file_path)
+
+    # TODO: 在此添加对图片、视频、表情等其他类型的处理
+    # elif content_type == ChatLog.ContentType.IMAGE:
+    #     ...
+
+    return ChatLog(**chat_log_data)
+
+
+def apply_call_records(device: WatchDevice, payload: dict):
+    """保存一批通话记录，返回 (新建条数, 更新条数)"""
+    # 同一批次内重复的 id 以最后一条为准
+    records = {}
+    for record in payload.get('recents', []):
+        record_id = record.get('id')
+        if not record_id:
+            continue
+        records[record_id] = record
+
+    if not records:
+        return 0, 0
+
+    # 整个批次作为一个事务处理：一次查询取出已存在的记录，一次查询取出号码对应的联系人，
+    # 然后批量插入新记录、批量更新旧记录
+    with transaction.atomic():
+        existing = {obj.record_id: obj for obj in CallRecord.objects.filter(record_id__in=list(records))}
+
+        # 号码 -> 联系人 通过设备的号码索引匹配 (包含额外号码)，缓存命中时不查询数据库
+        contact_ids = phone_index.lookup_many(device.pk, {record.get('phone') for record in records.values()})
+
+        to_create, to_update = [], []
+        for record_id, record in records.items():
+            obj = existing.get(record_id)
+            if obj is None:
+                obj = CallRecord(record_id=record_id)
+                to_create.append(obj)
+            else:
+                to_update.append(obj)
+            obj.device = device
+            obj.phone_number = record.get('phone')
+            obj.name = record.get('name')
+            obj.call_type = record.get('in', 0)
+            # 手表上报的是秒级时间戳，转换为 Django 的 DateTimeField
+            obj.stamp = datetime.fromtimestamp(record.get('stamp', 0), tz=datetimezone.utc)
+            obj.duration = record.get('time', 0)
+            obj.geo_data_json = json.dumps(record.get('geo_data'))
+            obj.is_read = record.get('is_read') == 1
+            obj.is_sync = True  # 既然服务器收到了，就标记为已同步
+            # 尝试将记录与现有联系人关联
+            if obj.phone_number in contact_ids:
+                obj.contact_id = contact_ids[obj.phone_number]
+
+        _drop_stale_contacts(to_create + to_update)
+        CallRecord.objects.bulk_create(to_create)
+        CallRecord.objects.bulk_update(to_update, [
+            'device', 'phone_number', 'name', 'call_type', 'stamp', 'duration', 'geo_data_json',
+            'is_read', 'is_sync', 'contact',
+        ])
+
+    logger.info("[*] 设备 %s 的通话记录: 创建 %d 条, 更新 %d 条", device.udid, len(to_create), len(to_update))
+    return len(to_create), len(to_update)
+
+
+def apply_sms(device: WatchDevice, payload: dict, received_at: datetime = None):
+    """保存一条短信，received_at 为空时使用当前时间"""
+    sms = _sms_message(device, payload, received_at)
+    with transaction.atomic():
+        _drop_stale_contacts([sms])
+        sms.save()
+    return sms
+
+
+def _drop_stale_contacts(objs: list):
+    """
+    号码索引可能比数据库旧 (其他进程刚删除了联系人，失效通知还没有到达)。在写入事务中确认
+    匹配到的联系人仍然存在，已删除的不再关联，并让索引失效
+    """
+    contact_ids = {obj.contact_id for obj in objs if obj.contact_id is not None}
+    if not contact_ids:
+        return
+    existing = set(Contact.objects.filter(pk__in=contact_ids).values_list('pk', flat=True))
+    for obj in objs:
+        if obj.contact_id is not None and obj.contact_id not in existing:
+            logger.warning("[!] 设备 %s 的号码索引中的联系人 %s 已被删除", obj.device_id, obj.contact_id)
+            phone_index.invalidate(obj.device_id)
+            obj.contact_id = None
+
+
+def _sms_message(device: WatchDevice, payload: dict, received_at: datetime = None) -> SmsMessage:
+    phone = payload.get('phone', '')
+    return SmsMessage(
+        device=device,                # 必须填入关联的 WatchDevice 实例
+        contact_id=phone_index.lookup(device.pk, phone),  # 匹配到的联系人
+        message=payload.get('message', ''),       # 获取短信内容
+        phone=phone,           # 获取电话号码
+        error_cause=int(payload.get('error_cause', '0')),
+        stamp=received_at or timezone.now()
+    )
+
+
+def is_valid(kind: str, payload) -> bool:
+    """消息是否能够入库。不能入库的消息不写入日志，仍由处理函数按原来的方式回复"""
+    if not isinstance(payload, dict):
+        return False
+    if kind == LOCATION:
+        data = payload.get('data')
+        return bool(data) and isinstance(data, list)
+    if kind == CHAT:
+        return bool(payload.get('id'))
+    if kind == CALL_RECORDS:
+        return 'recents' in payload
+    return kind == SMS
+
+
+def make_record(kind: str, device: WatchDevice, payload: dict, binary_payload: bytes = None) -> dict:
+    record = {'kind': kind, 'device': device.pk, 'ts': time.time(), 'payload': payload}
+    if binary_payload:
+        record['binary'] = base64.b64encode(binary_payload).decode('ascii')
+    return record
+
+
+def _binary(record: dict):
+    binary = record.get('binary')
+    return base64.b64decode(binary) if binary else None
+
+
+def _received_at(record: dict) -> datetime:
+    return datetime.fromtimestamp(record['ts'], tz=datetimezone.utc)
+
+
+def apply_record(device: WatchDevice, record: dict):
+    kind, payload = record['kind'], record['payload']
+    if kind == LOCATION:
+        apply_location(device, payload)
+    elif kind == CHAT:
+        apply_chat(device, payload, binary_payload=_binary(record))
+    elif kind == CALL_RECORDS:
+        apply_call_records(device, payload)
+    elif kind == SMS:
+        apply_sms(device, payload, received_at=_received_at(record))
+    else:
+        logger.error("[!] 未知的日志记录类型: %s", kind)
+
+
+def _new_locations(items: list, using: str) -> list:
+    """去掉已经保存过的 (重传的) 定位数据包，以及同一批次内重复的数据包"""
+    keys = {(device.pk, _msg_id(record['payload'])) for device, record in items}
+    seen = set(LocationPackage.objects.using(using)
+               .filter(device_id__in={device_id for device_id, _ in keys},
+                       msg_id__in={msg_id for _, msg_id in keys if msg_id})
+               .values_list('device_id', 'msg_id'))
+    fresh = []
+    for device, record in items:
+        key = (device.pk, _msg_id(record['payload']))
+        if key[1]:
+            if key in seen:
+                continue
+            seen.add(key)
+        fresh.append((device, record))
+    return fresh
+
+
+def _new_chats(items: list, using: str) -> list:
+    """去掉已经保存过的 (重传的) 聊天消息，以及同一批次内重复的消息"""
+    message_ids = {record['payload'].get('id') for _, record in items}
+    seen = set(ChatLog.objects.using(using).filter(message_id__in=message_ids - {None, ''})
+               .values_list('message_id', flat=True))
+    fresh = []
+    for device, record in items:
+        message_id = record['payload'].get('id')
+        if message_id:
+            if message_id in seen:
+                continue
+            seen.add(message_id)
+        fresh.append((device, record))
+    return fresh
+
+
+def _bulk_apply(kind: str, items: list, using: str) -> int:
+    """把同一类型的多条记录合并成几次 bulk_create，返回写入的条数。定位和聊天的 items 都属于分片 using"""
+    if kind == LOCATION:
+        items = _new_locations(items, using)
+        packages = LocationPackage.objects.using(using).bulk_create([
+            LocationPackage(device=device, user_id=device.user_id, msg_id=_msg_id(record['payload']),
+                            strategy=record['payload'].get('strategy'))
+            for device, record in items
+        ])
+        LocationData.objects.using(using).bulk_create([
+            point
+            for package, (device, record) in zip(packages, items)
+            for point in _location_points(package, device, record['payload'])
+        ])
+    elif kind == CHAT:
+        items = _new_chats(items, using)
+        # message_id 有唯一约束，查询之后其他进程写入的同一条消息直接忽略
+        ChatLog.objects.using(using).bulk_create(
+            [_chat_log(device, record['payload'], _binary(record)) for device, record in items], ignore_conflicts=True)
+    elif kind == SMS:
+        messages = [_sms_message(device, record['payload'], _received_at(record)) for device, record in items]
+        _drop_stale_contacts(messages)
+        SmsMessage.objects.bulk_create(messages)
+    else:
+        for device, record in items:
+            apply_record(device, record)
+    return len(items)
+
+
+def _group_by_shard(kind: str, items: list) -> dict:
+    """把 [(下标, 设备, 记录)] 按分片分组: {数据库别名: items}，只有定位和聊天分片保存"""
+    if kind not in (LOCATION, CHAT):
+        return {getattr(settings, 'WRITE_DATABASE', 'default'): items}
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_map.alias_for(item[1]), []).append(item)
+    return groups
+
+
+def apply_records(kind: str, records: list) -> tuple:
+    """
+    批量写入同一类型的记录，返回 (写入的条数, 已处理完的记录下标集合)。每个分片的记录在一个事务中写入；
+    失败时逐条重试。已处理完包括写入成功的记录和不需要重试的记录 (设备不存在、数据错误 RECORD_ERRORS)，
+    因数据库被锁、连接断开等原因没有写入的记录不在其中，由调用方稍后重试。
+    """
+    devices = WatchDevice.objects.in_bulk({record['device'] for record in records})
+    items = []
+    done = set()
+    for index, record in enumerate(records):
+        device = devices.get(record['device'])
+        if device is None:
+            logger.warning("[!] 记录 (%s) 的设备 %s 不存在，跳过", kind, record['device'])
+            done.add(index)
+            continue
+        items.append((index, device, record))
+
+    applied = 0
+    for using, group in _group_by_shard(kind, items).items():
+        try:
+            with transaction.atomic(using=using):
+                applied += _bulk_apply(kind, [(device, record) for _, device, record in group], using)
+            done.update(index for index, _, _ in group)
+            continue
+        except Exception as e:
+            logger.warning("[!] 批量写入 %d 条 %s 记录失败，改为逐条写入: %s", len(group), kind, e)
+
+        for index, device, record in group:
+            try:
+                with transaction.atomic(using=using):
+                    apply_record(device, record)
+                applied += 1
+            except RECORD_ERRORS as e:
+                logger.error("[!] 记录 (%s) 入库失败，跳过: %s", kind, e)
+            except Exception as e:
+                # 数据库不可用时其余记录也写不进去，留给调用方重试
+                logger.error("[!] 记录 (%s) 入库失败，稍后重试: %s", kind, e)
+                break
+            done.add(index)
+    return applied, done
+
+
+class JournalConsumer:
+    """按顺序把写前日志中的记录写入数据库，进度保存在名为 name 的 IngestCheckpoint 中"""
+
+    def __init__(self, directory, name: str = 'default', batch_size: int = 500):
+        self.directory = directory
+        self.name = name
+        self.batch_size = batch_size
+
+    def _checkpoint(self) -> IngestCheckpoint:
+        checkpoint, _ = IngestCheckpoint.objects.select_for_update().get_or_create(name=self.name)
+        return checkpoint
+
+    def _apply(self, entries: list) -> list:
+        """写入一批记录，返回因数据错误跳过的 [(偏移量, 记录, 错误)]，提交后再写入死信文件"""
+        devices = WatchDevice.objects.in_bulk({record['device'] for _, record in entries})
+        failed = []
+        for offset, record in entries:
+            device = devices.get(record['device'])
+            if device is None:
+                logger.warning("[!] 日志记录 %d 的设备 %s 不存在，跳过", offset, record['device'])
+                continue
+            try:
+                # 每条记录一个保存点，单条记录出错不影响同一批的其他记录
+                with transaction.atomic():
+                    apply_record(device, record)
+            except RECORD_ERRORS as e:
+                logger.error("[!] 日志记录 %d (%s) 入库失败，移入死信文件: %s", offset, record['kind'], e)
+                failed.append((offset, record, e))
+        return failed
+
+    def _dead_letter(self, failed: list):
+        for offset, record, error in failed:
+            append_dead_letter(self.directory, offset, record, error)
+
+    def run_once(self) -> int:
+        """处理一批记录，返回处理的条数 (为 0 表示已追上写入方)"""
+        try:
+            with transaction.atomic():
+                checkpoint = self._checkpoint()
+                entries = read_records(self.directory, checkpoint.offset, self.batch_size)
+                if not entries:
+                    return 0
+                failed = self._apply(entries)
+                checkpoint.offset = entries[-1][0]
+                checkpoint.save(update_fields=['offset', 'updated_at'])
+            self._dead_letter(failed)
+        except IntegrityError as e:
+            # 外键约束延迟到提交时才检查，保存点隔离不了，也无法知道是哪条记录出错
+            logger.warning("[!] 日志记录批量提交失败，改为逐条提交: %s", e)
+            entries = self._apply_one_by_one()
+            checkpoint = IngestCheckpoint.objects.get(name=self.name)
+
+        removed = purge_segments(self.directory, checkpoint.offset)
+        if removed:
+            logger.info("[*] 已删除 %d 个处理完毕的日志段", removed)
+        return len(entries)
+
+    def _apply_one_by_one(self) -> list:
+        """
+        重新读取这一批，每条记录和检查点在单独的事务中提交。提交失败的记录写入死信文件
+        (journal.append_dead_letter)，检查点越过它，不会在同一批记录上反复失败
+        """
+        with transaction.atomic():
+            entries = read_records(self.directory, self._checkpoint().offset, self.batch_size)
+        for offset, record in entries:
+            try:
+                with transaction.atomic():
+                    checkpoint = self._checkpoint()
+                    if checkpoint.offset >= offset:
+                        continue
+                    failed = self._apply([(offset, record)])
+                    checkpoint.offset = offset
+                    checkpoint.save(update_fields=['offset', 'updated_at'])
+                self._dead_letter(failed)
+            except IntegrityError as e:
+                logger.error("[!] 日志记录 %d (%s) 提交失败，移入死信文件: %s", offset, record['kind'], e)
+                append_dead_letter(self.directory, offset, record, e)
+                with transaction.atomic():
+                    checkpoint = self._checkpoint()
+                    if checkpoint.offset < offset:
+                        checkpoint.offset = offset
+                        checkpoint.save(update_fields=['offset', 'updated_at'])
+        return entries
@@ -0,0 +1,259 @@
+"""
+TCP 入库的写前日志 (append-only journal)。
+
+定位、聊天、通话记录和短信先追加到日志并落盘，然后立即回复 ACK，数据库写入由 apply_journal 命令
+按顺序完成 (见 ingest.JournalConsumer)，数据库变慢不会再让手表等待 ACK。
+
+日志由多个段文件组成，文件名是该段第一条记录的全局偏移量 (%020d.log)，单个段超过 segment_bytes 后
+新建下一个段。每条记录的格式为::
+
+    4 字节长度 (大端序) + 4 字节 CRC32 + JSON (UTF-8)
+
+写入在事件循环线程中完成 (只写入操作系统缓冲区)，fsync 在线程池中批量执行：
+每隔 fsync_interval 秒或积累 fsync_batch 条记录执行一次，append() 在记录落盘后返回。
+进程崩溃后重新打开日志时，最后一个段末尾不完整的记录会被截断。
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.log'
+# 无法入库的记录，每行一个 JSON 对象，不参与段的读取和清理
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+
+def _segment_name(base: int) -> str:
+    return '%020d%s' % (base, SEGMENT_SUFFIX)
+
+
+def list_segments(directory) -> list:
+    """按起始偏移量排序的 (起始偏移量, 路径) 列表"""
+    segments = []
+    for path in Path(directory).glob('*' + SEGMENT_SUFFIX):
+        try:
+            segments.append((int(path.stem), path))
+        except ValueError:
+            continue
+    segments.sort()
+    return segments
+
+
+def encode_record(record: dict) -> bytes:
+    body = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def _scan(data: bytes, position: int = 0):
+    """从 position 开始解析完整的记录，返回 [(记录结束位置, 记录)]，遇到不完整或损坏的记录时停止"""
+    records = []
+    while position + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+        body = data[start:start + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            break
+        position = start + length
+        records.append((position, json.loads(body)))
+    return records
+
+
+def _read(f, size: int, limit: int):
+    """
+    从文件当前位置逐条读取最多 limit 条完整记录 (size 为当前位置之后的字节数)，
+    返回 [(记录结束位置, 记录)]，位置相对于开始读取的位置，遇到不完整或损坏的记录时停止
+    """
+    records = []
+    position = 0
+    while len(records) < limit and position + RECORD_HEADER.size <= size:
+        length, crc = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        if position + RECORD_HEADER.size + length > size:
+            break
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) != crc:
+            break
+        position += RECORD_HEADER.size + length
+        records.append((position, json.loads(body)))
+    return records
+
+
+def read_records(directory, offset: int, limit: int) -> list:
+    """
+    读取全局偏移量 offset 之后的最多 limit 条记录，返回 [(下一条记录的偏移量, 记录)]。
+    只会读到当前已写入的完整记录，写入方仍在追加的段也可以安全读取。
+    每次只读取需要的记录，不会读取整个段。
+    """
+    segments = list_segments(directory)
+    entries = []
+    for index, (base, path) in enumerate(segments):
+        next_base = segments[index + 1][0] if index + 1 < len(segments) else None
+        if next_base is not None and next_base <= offset:
+            continue
+        position = max(offset - base, 0)
+        with open(path, 'rb') as f:
+            size = max(os.fstat(f.fileno()).st_size - position, 0)
+            f.seek(position)
+            records = _read(f, size, limit - len(entries))
+        for end, record in records:
+            entries.append((base + position + end, record))
+        if len(entries) >= limit:
+            break
+        consumed = records[-1][0] if records else 0
+        if consumed < size and next_base is not None:
+            # 只有崩溃前的最后一个段会以不完整的记录结尾，重新打开日志时才会截断
+            logger.warning("[!] 日志段 %s 在偏移量 %d 处损坏，跳过剩余 %d 字节",
+                           path.name, base + position + consumed, size - consumed)
+        if next_base is None:
+            break
+        offset = next_base
+    return entries
+
+
+def append_dead_letter(directory, offset: int, record: dict, error: Exception):
+    """记录一条无法入库的记录 (offset 为该记录之后的全局偏移量)，供人工处理后重放"""
+    line = json.dumps({'offset': offset, 'error': str(error), 'record': record}, ensure_ascii=False)
+    with open(Path(directory) / DEAD_LETTER_FILE, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def purge_segments(directory, checkpoint: int) -> int:
+    """删除所有记录都已在检查点之前的段 (永远保留最后一个段)，返回删除的段数"""
+    segments = list_segments(directory)
+    removed = 0
+    for (base, path), (next_base, _) in zip(segments, segments[1:]):
+        if next_base > checkpoint:
+            break
+        path.unlink()
+        removed += 1
+    return removed
+
+
+class Journal:
+
+    def __init__(self, directory, segment_bytes: int = 64 * 1024 * 1024, fsync_interval: float = 0.005,
+                 fsync_batch: int = 256):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self._file = None
+        self._base = 0
+        self._position = 0
+        # 已经切换但还没有落盘、关闭的段文件
+        self._retired = []
+        self._new_segment = False
+        self._waiters = []
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+
+    @property
+    def offset(self) -> int:
+        """下一条记录的全局偏移量"""
+        return self._base + self._position
+
+    def open(self):
+        """打开最后一个段继续追加，截断崩溃时写了一半的记录"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = list_segments(self.directory)
+        if segments:
+            self._base, path = segments[-1]
+            data = path.read_bytes()
+            records = _scan(data)
+            valid = records[-1][0] if records else 0
+            if valid < len(data):
+                logger.warning("[!] 截断日志段 %s 末尾不完整的 %d 字节", path.name, len(data) - valid)
+                with open(path, 'r+b') as f:
+                    f.truncate(valid)
+                    os.fsync(f.fileno())
+            self._position = valid
+            self._file = open(path, 'ab')
+        else:
+            self._base, self._position = 0, 0
+            self._file = open(self.directory / _segment_name(0), 'ab')
+            self._new_segment = True
+        logger.info("[*] 写前日志已打开: %s，偏移量 %d", self.directory, self.offset)
+        self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def _roll(self):
+        self._retired.append(self._file)
+        self._base += self._position
+        self._position = 0
+        self._file = open(self.directory / _segment_name(self._base), 'ab')
+        self._new_segment = True
+
+    async def append(self, record: dict) -> int:
+        """追加一条记录，落盘后返回该记录之后的全局偏移量"""
+        if self._position >= self.segment_bytes:
+            self._roll()
+        data = encode_record(record)
+        self._file.write(data)
+        self._position += len(data)
+        offset = self.offset
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._wakeup.set()
+        await waiter
+        return offset
+
+    def _sync(self, files, sync_directory: bool):
+        for f in files:
+            os.fsync(f.fileno())
+        if sync_directory:
+            # 新建的段文件需要同步目录项才能保证崩溃后仍然存在
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            if len(self._waiters) < self.fsync_batch:
+                # 等待同一时间窗口内的其他记录，一次 fsync 确认一批
+                await asyncio.sleep(self.fsync_interval)
+            self._wakeup.clear()
+
+            waiters, self._waiters = self._waiters, []
+            retired, self._retired = self._retired, []
+            files = retired + [self._file]
+            sync_directory, self._new_segment = self._new_segment, False
+            for f in files:
+                f.flush()
+            try:
+                await loop.run_in_executor(None, self._sync, files, sync_directory)
+            except Exception as e:
+                logger.error("[!] 写前日志落盘失败: %s", e)
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            for f in retired:
+                f.close()
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def close(self):
+        """等待已追加的记录落盘后关闭"""
+        if self._flusher is None:
+            return
+        if self._waiters:
+            await asyncio.gather(*self._waiters, return_exceptions=True)
+        self._flusher.cancel()
+        self._flusher = None
+        for f in self._retired + [self._file]:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self._retired = []
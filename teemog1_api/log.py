@@ -0,0 +1,83 @@
+"""
+服务器日志工具。
+
+- AsyncQueueHandler: 日志记录只在调用方线程入队，格式化和磁盘/终端 I/O 都交给
+  后台 QueueListener 线程完成，避免阻塞 asyncio 事件循环。
+- PacketTraceSampler: 对逐包跟踪日志 (原始数据、十六进制转储等) 进行采样，
+  未命中采样或日志级别未开启时不做任何格式化。HTTP 请求跟踪 (middleware.py) 也使用它。
+
+日志级别在 settings.LOG_LEVELS 中按模块配置，见 settings.LOGGING。
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+DEFAULT_FORMAT = '%(asctime)s %(levelname)s:%(name)s:%(message)s'
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    基于队列的异步日志 Handler，供 settings.LOGGING 通过 '()' 工厂方式创建。
+
+    :param filename: 日志文件路径，为空则不写文件
+    :param console: 是否同时输出到 stderr
+    :param max_bytes: 单个日志文件的最大字节数，超过后轮转
+    :param backup_count: 保留的轮转文件个数
+    :param queue_size: 队列容量，队列满时丢弃新记录而不是阻塞调用方
+    """
+
+    def __init__(self, filename=None, console=True, max_bytes=50 * 1024 * 1024, backup_count=5,
+                 queue_size=10000, fmt=DEFAULT_FORMAT):
+        super().__init__(queue.Queue(queue_size))
+        formatter = logging.Formatter(fmt)
+        handlers = []
+        if console:
+            handlers.append(logging.StreamHandler())
+        if filename:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def prepare(self, record):
+        # 默认实现会在调用方线程里执行 format()，这里把格式化推迟到监听线程
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class PacketTraceSampler:
+    """
+    逐包跟踪日志的采样器。
+
+    用法::
+
+        if packet_trace.sample():
+            packet_logger.debug("... %s", packet_data.hex())
+
+    :param logger: 跟踪日志使用的 logger，未开启 DEBUG 时 sample() 总是返回 False
+    :param rate: 采样率 (0.0 - 1.0)
+    """
+
+    def __init__(self, logger: logging.Logger, rate: float = 1.0):
+        self.logger = logger
+        self.rate = rate
+
+    def enabled(self) -> bool:
+        """采样率大于 0 且 logger 开启了 DEBUG"""
+        return self.rate > 0 and self.logger.isEnabledFor(logging.DEBUG)
+
+    def sample(self) -> bool:
+        if not self.enabled():
+            return False
+        return self.rate >= 1 or random.random() < self.rate
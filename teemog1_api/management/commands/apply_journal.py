@@ -0,0 +1,49 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections
+
+from teemog1_api.ingest import JournalConsumer
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Applies records from the TCP ingest journal (INGEST_JOURNAL_DIR) to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default='default', help='检查点名称')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'INGEST_APPLY_BATCH', 500),
+                            help='每个事务处理的记录数')
+        parser.add_argument('--interval', type=float, default=0.2, help='追上写入方后再次检查的间隔 (秒)')
+        parser.add_argument('--retry-interval', type=float, default=5.0, help='数据库出错后重试的间隔 (秒)')
+        parser.add_argument('--once', action='store_true', help='处理完现有记录后退出')
+
+    def handle(self, *args, **options):
+        directory = getattr(settings, 'INGEST_JOURNAL_DIR', None)
+        if not directory:
+            raise CommandError('INGEST_JOURNAL_DIR 未配置')
+
+        consumer = JournalConsumer(directory, name=options['name'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"[*] 开始处理写前日志 {directory} (检查点 {options['name']})"))
+        total = 0
+        try:
+            while True:
+                try:
+                    applied = consumer.run_once()
+                except DatabaseError as e:
+                    # 检查点没有移动，等待后重试同一批记录
+                    logger.error("[!] 写入数据库失败，%s 秒后重试: %s", options['retry_interval'], e)
+                    close_old_connections()
+                    time.sleep(options['retry_interval'])
+                    continue
+                total += applied
+                if not applied:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f"[*] 共处理 {total} 条记录。"))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from teemog1_api.ingest import parse_geo
+from teemog1_api.models import LocationData
+from teemog1_api.sharding import shard_aliases
+
+GEO_FIELDS = ('lat', 'lon', 'accuracy', 'source')
+
+
+class Command(BaseCommand):
+    help = 'Parses LocationData.geo_decrypted into the lat/lon/accuracy/source columns for rows stored before they existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每批处理的定位点数量')
+
+    def handle(self, *args, **options):
+        updated = 0
+        for alias in shard_aliases():
+            updated += self.backfill(alias, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"[*] 回填完成：{updated} 个定位点。"))
+
+    def backfill(self, alias: str, batch_size: int) -> int:
+        updated = skipped = 0
+        last_pk = 0
+        while True:
+            # 按主键翻页，无法解析的定位点保持为空，不会被重复读取
+            batch = list(LocationData.objects.using(alias).filter(pk__gt=last_pk, lat__isnull=True)
+                         .exclude(geo_decrypted='').order_by('pk').only('pk', 'geo_decrypted')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            rows = []
+            for row in batch:
+                geo = parse_geo(row.geo_decrypted)
+                if not geo:
+                    skipped += 1
+                    continue
+                for field, value in geo.items():
+                    setattr(row, field, value)
+                rows.append(row)
+            with transaction.atomic(using=alias):
+                LocationData.objects.using(alias).bulk_update(rows, GEO_FIELDS)
+            updated += len(rows)
+            self.stdout.write(f"[*] {alias}: 已处理到定位点 {last_pk}，共回填 {updated} 个，{skipped} 个无法解析...")
+        return updated
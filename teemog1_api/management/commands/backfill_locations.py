@@ -0,0 +1,41 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from teemog1_api.models import LocationPackage, LocationData
+from teemog1_api.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    help = 'Fills LocationData.device from the owning LocationPackage for rows stored before the column existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每批处理的数据包数量')
+
+    def handle(self, *args, **options):
+        updated = 0
+        # 数据包和它的定位点总在同一个分片中
+        for alias in shard_aliases():
+            updated += self.backfill(alias, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"[*] 回填完成：{updated} 个定位点。"))
+
+    def backfill(self, alias: str, batch_size: int) -> int:
+        updated = 0
+        last_pk = 0
+        while True:
+            batch = list(LocationPackage.objects.using(alias).filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', 'device_id')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            packages_by_device = defaultdict(list)
+            for package_id, device_id in batch:
+                packages_by_device[device_id].append(package_id)
+            with transaction.atomic(using=alias):
+                for device_id, package_ids in packages_by_device.items():
+                    updated += LocationData.objects.using(alias) \
+                        .filter(package_id__in=package_ids, device__isnull=True).update(device_id=device_id)
+            self.stdout.write(f"[*] {alias}: 已处理到数据包 {last_pk}，共回填 {updated} 个定位点...")
+        return updated
@@ -0,0 +1,50 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from teemog1_api.models import Contact, ContactPhone
+from teemog1_api.phone_index import normalize_phone, phone_index
+
+
+class Command(BaseCommand):
+    help = 'Moves legacy JSON extra phone numbers from Contact.ext into the ContactPhone table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        migrated = skipped = 0
+        last_pk = 0
+        while True:
+            batch = list(Contact.objects.filter(pk__gt=last_pk, ext__isnull=False).exclude(ext='')
+                         .order_by('pk').only('pk', 'ext')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            rows = []
+            for contact in batch:
+                try:
+                    phones = json.loads(contact.ext)
+                except json.JSONDecodeError:
+                    phones = []
+                if not isinstance(phones, list):
+                    skipped += 1
+                    phones = []
+                rows.extend(ContactPhone(contact_id=contact.pk, phone=str(phone), normalized=normalize_phone(phone),
+                                         position=position)
+                            for position, phone in enumerate(p for p in phones if p not in (None, '')))
+
+            with transaction.atomic():
+                ids = [contact.pk for contact in batch]
+                ContactPhone.objects.filter(contact_id__in=ids).delete()
+                ContactPhone.objects.bulk_create(rows)
+                # update() 不触发信号，置空后不会重复迁移
+                Contact.objects.filter(pk__in=ids).update(ext=None)
+            migrated += len(batch)
+            self.stdout.write(f"[*] 已迁移 {migrated} 个联系人...")
+
+        phone_index.clear()
+        self.stdout.write(self.style.SUCCESS(f"[*] 迁移完成：{migrated} 个联系人，{skipped} 个 ext 格式无效已忽略。"))
@@ -0,0 +1,168 @@
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from teemog1_api.models import WatchDevice, DeviceShard, LocationPackage, LocationData, ChatLog
+from teemog1_api.sharding import shard_aliases, hash_alias, shard_map
+
+
+@contextmanager
+def keep_auto_now_add(*models):
+    """复制数据时保留原来的 received_at/created_at，而不是 auto_now_add 填入的当前时间"""
+    fields = [field for model in models for field in model._meta.concrete_fields
+              if getattr(field, 'auto_now_add', False)]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class DeviceMove:
+    """把一个设备的数据包、定位点和聊天记录从 source 复制到 target，记录各表已复制到的主键"""
+
+    def __init__(self, device: WatchDevice, source: str, target: str, batch_size: int):
+        self.device = device
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.packages = {}  # 源分片中的数据包主键 -> 目标分片中的主键，目标分片已有该数据包时为 None
+        self.last_package = self.last_point = self.last_chat = 0
+        self.copied = 0
+
+    def _rows(self, model, last_pk: int) -> list:
+        return list(model.objects.using(self.source).filter(device_id=self.device.pk, pk__gt=last_pk)
+                    .order_by('pk')[:self.batch_size])
+
+    def discard_target(self):
+        """删除上次中断的迁移留在目标分片中的副本 (设备仍指向源分片，目标分片中的数据只可能是副本)"""
+        LocationData.objects.using(self.target).filter(device_id=self.device.pk).delete()
+        LocationPackage.objects.using(self.target).filter(device_id=self.device.pk).delete()
+        ChatLog.objects.using(self.target).filter(device_id=self.device.pk).delete()
+
+    def copy(self):
+        """复制上次复制之后新增的数据"""
+        with keep_auto_now_add(LocationPackage, LocationData, ChatLog):
+            while rows := self._rows(LocationPackage, self.last_package):
+                last_pk = rows[-1].pk
+                # 切换分片期间重传的数据包可能已经写入目标分片 (连同定位点)，不再复制
+                existing = dict(LocationPackage.objects.using(self.target)
+                                .filter(device_id=self.device.pk, msg_id__in=[row.msg_id for row in rows if row.msg_id])
+                                .values_list('msg_id', 'pk'))
+                new = []
+                for row in rows:
+                    if row.msg_id in existing:
+                        self.packages[row.pk] = None
+                    else:
+                        new.append((row.pk, row))
+                        row.pk = None
+                with transaction.atomic(using=self.target):
+                    LocationPackage.objects.using(self.target).bulk_create([row for _, row in new])
+                self.packages.update((old_pk, row.pk) for old_pk, row in new)
+                self.last_package = last_pk
+                self.copied += len(new)
+
+            while rows := self._rows(LocationData, self.last_point):
+                # 数据包在定位点之前写入，所属数据包还没有复制的定位点留到下一次
+                ready = []
+                for row in rows:
+                    if row.package_id not in self.packages:
+                        break
+                    ready.append(row)
+                if not ready:
+                    break
+                last_pk = ready[-1].pk
+                new = [row for row in ready if self.packages[row.package_id] is not None]
+                for row in new:
+                    row.pk = None
+                    row.package_id = self.packages[row.package_id]
+                with transaction.atomic(using=self.target):
+                    LocationData.objects.using(self.target).bulk_create(new)
+                self.last_point = last_pk
+                self.copied += len(new)
+                if len(ready) < len(rows):
+                    break
+
+            while rows := self._rows(ChatLog, self.last_chat):
+                last_pk = rows[-1].pk
+                for row in rows:
+                    row.pk = None
+                with transaction.atomic(using=self.target):
+                    # 切换分片期间重发的消息可能已经写入目标分片
+                    ChatLog.objects.using(self.target).bulk_create(rows, ignore_conflicts=True)
+                self.last_chat = last_pk
+                self.copied += len(rows)
+
+    def delete_source(self) -> int:
+        deleted = 0
+        for model in (LocationData, LocationPackage, ChatLog):
+            while pks := list(model.objects.using(self.source).filter(device_id=self.device.pk)
+                              .values_list('pk', flat=True)[:self.batch_size]):
+                with transaction.atomic(using=self.source):
+                    deleted += model.objects.using(self.source).filter(pk__in=pks).delete()[0]
+        return deleted
+
+
+class Command(BaseCommand):
+    help = 'Moves devices\' location and chat data between shards (SHARD_DATABASES) while the servers keep running'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', action='append', default=[], metavar='UDID', help='要迁移的设备，可以重复')
+        parser.add_argument('--to', dest='target', help='目标分片，不指定时迁移到按 UDID 哈希得到的分片')
+        parser.add_argument('--all', action='store_true', help='迁移所有不在哈希分片上的设备 (增加分片之后使用)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批复制/删除的行数')
+        parser.add_argument('--wait', type=float, default=getattr(settings, 'SHARD_MAP_TTL', 30),
+                            help='切换分片后等待各进程缓存过期的时间 (秒)，不能小于 SHARD_MAP_TTL')
+        parser.add_argument('--dry-run', action='store_true', help='只列出需要迁移的设备')
+
+    def handle(self, *args, **options):
+        aliases = shard_aliases()
+        if len(aliases) == 1:
+            raise CommandError('SHARD_DATABASES 只有一个数据库，没有可迁移的分片')
+        if options['target'] and options['target'] not in aliases:
+            raise CommandError(f"未知的分片: {options['target']}")
+        if bool(options['device']) == options['all']:
+            raise CommandError('需要指定 --device 或 --all 其中之一')
+
+        if options['all']:
+            placements = DeviceShard.objects.select_related('device').order_by('pk')
+            moves = [(placement.device, placement.alias, options['target'] or hash_alias(placement.device.udid))
+                     for placement in placements.iterator()]
+        else:
+            moves = []
+            for udid in options['device']:
+                device = WatchDevice.objects.filter(udid=udid).first()
+                if device is None:
+                    raise CommandError(f"设备不存在: {udid}")
+                moves.append((device, shard_map.alias_for(device), options['target'] or hash_alias(udid)))
+        moves = [move for move in moves if move[1] != move[2]]
+
+        self.stdout.write(f"[*] 需要迁移 {len(moves)} 个设备")
+        for device, source, target in moves:
+            self.stdout.write(f"    {device.udid}: {source} -> {target}")
+        if options['dry_run'] or not moves:
+            return
+
+        for device, source, target in moves:
+            self.move(DeviceMove(device, source, target, options['batch_size']), options['wait'])
+        self.stdout.write(self.style.SUCCESS(f"[*] 迁移完成：{len(moves)} 个设备。"))
+
+    def move(self, move: DeviceMove, wait: float):
+        udid = move.device.udid
+        move.discard_target()
+        # 1. 复制现有数据，此时新数据仍写入源分片
+        move.copy()
+        # 2. 切换分片。其他进程在缓存过期前仍可能写入源分片，等待过期后再补齐这段时间的数据
+        DeviceShard.objects.filter(device=move.device).update(alias=move.target)
+        shard_map.invalidate(move.device.pk)
+        self.stdout.write(f"[*] {udid} 已切换到 {move.target}，等待 {wait:g} 秒...")
+        time.sleep(wait)
+        move.copy()
+        # 3. 删除源分片中的数据
+        deleted = move.delete_source()
+        self.stdout.write(f"[*] {udid}: 复制 {move.copied} 行，从 {move.source} 删除 {deleted} 行")
@@ -0,0 +1,88 @@
+import asyncio
+import ssl
+import logging
+
+from django.core.management.base import BaseCommand
+
+from teemog1_api.capture import CaptureWriter, split_frames, TO_SERVER, TO_WATCH
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Runs a recording TLS proxy in front of run_tcp_server and writes every frame '
+            '(type, timing, payload) to a capture file for replay_load')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='抓包文件路径，以 .gz 结尾时压缩保存')
+        parser.add_argument('--listen-host', default='0.0.0.0')
+        parser.add_argument('--listen-port', type=int, default=59094, help='手表连接的端口')
+        parser.add_argument('--upstream-host', default='127.0.0.1')
+        parser.add_argument('--upstream-port', type=int, default=59093, help='run_tcp_server 的端口')
+        parser.add_argument('--cert', default='./ca.crt')
+        parser.add_argument('--key', default='./ca.key')
+
+    async def _pipe(self, reader, writer, direction):
+        buffer = b''
+        try:
+            while True:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+                frames, buffer = split_frames(buffer + chunk)
+                for frame in frames:
+                    self.capture.write(direction, frame)
+                    self.frame_count += 1
+        except (ConnectionError, ssl.SSLError) as e:
+            logger.debug("[-] 转发中断: %s", e)
+        finally:
+            writer.close()
+
+    async def _handle_watch(self, watch_reader, watch_writer):
+        addr = watch_writer.get_extra_info('peername')
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                self.upstream_host, self.upstream_port, ssl=self.client_context)
+        except OSError as e:
+            logger.error("[!] 无法连接上游服务器: %s", e)
+            watch_writer.close()
+            return
+        logger.info("[+] 正在录制来自 %s 的连接", addr)
+        await asyncio.gather(
+            self._pipe(watch_reader, upstream_writer, TO_SERVER),
+            self._pipe(upstream_reader, watch_writer, TO_WATCH),
+        )
+        self.capture.flush()
+        logger.info("[-] 连接 %s 已结束，累计录制 %d 帧", addr, self.frame_count)
+
+    async def handle_async(self, options):
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.set_ciphers('DEFAULT:@SECLEVEL=0')
+        server_context.minimum_version = ssl.TLSVersion.TLSv1
+        server_context.load_cert_chain(certfile=options['cert'], keyfile=options['key'])
+
+        self.client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.client_context.check_hostname = False
+        self.client_context.verify_mode = ssl.CERT_NONE
+        self.upstream_host = options['upstream_host']
+        self.upstream_port = options['upstream_port']
+
+        server = await asyncio.start_server(
+            self._handle_watch, options['listen_host'], options['listen_port'], ssl=server_context)
+        self.stdout.write(self.style.SUCCESS(
+            f"[*] 录制代理正在 {options['listen_host']}:{options['listen_port']} 上监听，"
+            f"转发到 {self.upstream_host}:{self.upstream_port}，写入 {options['output']}"))
+        async with server:
+            await server.serve_forever()
+
+    def handle(self, *args, **options):
+        self.capture = CaptureWriter(options['output'])
+        self.frame_count = 0
+        try:
+            asyncio.run(self.handle_async(options))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING(f'\n[*] 录制结束，共 {self.frame_count} 帧。'))
+        finally:
+            self.capture.close()
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import random
+import ssl
+import struct
+import time
+import uuid
+import zlib
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from teemog1_api.capture import read_capture, TO_SERVER
+from teemog1_api.management.commands.run_tcp_server import create_teemo_response_packet
+
+# 负载类型 -> 帧类型
+KIND_MSG_TYPES = {
+    'login': (0x14,),
+    'ping': (0x01,),
+    'location': (0x0b, 0x7d),
+    'chat': (0x7a,),
+    'contacts': (0x7b,),
+}
+DEFAULT_MIX = 'ping=10,location=5,chat=2,contacts=1'
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in KIND_MSG_TYPES or kind == 'login':
+            raise CommandError(f"未知的负载类型: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def build_chat_frame(json_data: dict, binary: bytes = b'') -> bytes:
+    json_bytes = json.dumps(json_data).encode('utf-8')
+    payload = struct.pack('>H', len(json_bytes)) + json_bytes + binary
+    return struct.pack('>i', 2 + len(payload))[1:] + bytes([4, 0x7a]) + payload
+
+
+def build_zlib_frame(msg_type: int, json_data: dict) -> bytes:
+    payload = zlib.compress(json.dumps(json_data).encode('utf-8'))
+    return struct.pack('>i', 2 + len(payload))[1:] + bytes([4, msg_type]) + payload
+
+
+class SimulatedWatch:
+    """一个模拟手表：登录后按权重发送各类消息，每个请求等待一个响应帧"""
+
+    def __init__(self, index: int, templates: dict):
+        self.index = index
+        self.templates = templates
+        self.udid = 'loadtest%016d' % index
+        self.baby_id = 0
+
+    # --- 帧构造 ---
+    def login_frame(self) -> bytes:
+        payload = self._template_json(0x14) or {}
+        payload.update({
+            'udid': self.udid,
+            'imei': '86%013d' % self.index,
+            'imsi': '46%013d' % self.index,
+            'mac': ':'.join('%02x' % b for b in struct.pack('>IH', 0x02000000, self.index & 0xffff)),
+            'device_version': payload.get('device_version', 'loadtest'),
+        })
+        return create_teemo_response_packet(0x14, payload)
+
+    def frame_for(self, kind: str) -> bytes:
+        if kind == 'ping':
+            return self._captured(0x01) or create_teemo_response_packet(
+                0x01, {'power': 4, 'power_percent': 80, 'signal': 3, 'voltage': 4000})
+        if kind == 'contacts':
+            return create_teemo_response_packet(0x7b, {'sub_type': 2})
+        if kind == 'location':
+            payload = self._template_json(0x0b) or self._template_json(0x7d) or {
+                'strategy': 1,
+                'data': [{'stamp': int(time.time()), 'power': 80, 'signal': 3, 'sos': 0,
+                          'geo': {'lat': 39.9, 'lon': 116.4, 'accuracy': 30}}],
+            }
+            payload['id'] = uuid.uuid4().hex
+            if 0x7d in self.templates and 0x0b not in self.templates:
+                return build_zlib_frame(0x7d, payload)
+            return create_teemo_response_packet(0x0b, payload)
+        if kind == 'chat':
+            template = self.templates.get(0x7a)
+            json_data, binary = ({
+                'chat_type': 1, 'content_type': 2, 'to_id': 0, 'content': {'text': 'load test'},
+            }, b'')
+            if template:
+                json_len = struct.unpack('>H', template[5:7])[0]
+                json_data = json.loads(template[7:7 + json_len])
+                binary = template[7 + json_len:]
+            json_data.update({'id': uuid.uuid4().hex, 'from_user_id': self.baby_id,
+                              'stamp': int(time.time() * 1000)})
+            return build_chat_frame(json_data, binary)
+        raise ValueError(kind)
+
+    def _captured(self, msg_type):
+        return self.templates.get(msg_type)
+
+    def _template_json(self, msg_type):
+        frame = self.templates.get(msg_type)
+        if not frame:
+            return None
+        body = frame[5:]
+        if msg_type == 0x7d:
+            body = zlib.decompress(body)
+        return json.loads(body)
+
+
+async def read_frame(reader) -> bytes:
+    header = await reader.readexactly(3)
+    body = await reader.readexactly(struct.unpack('>i', b'\x00' + header)[0])
+    return header + body
+
+
+class Command(BaseCommand):
+    help = ('Replays captured or synthetic watch traffic as N concurrent TLS watches against run_tcp_server '
+            'and reports throughput, latency percentiles and errors')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=59093)
+        parser.add_argument('--watches', type=int, default=100, help='模拟的手表数量')
+        parser.add_argument('--duration', type=float, default=30, help='压测持续时间 (秒)')
+        parser.add_argument('--interval', type=float, default=0.0,
+                            help='每个手表两次请求之间的间隔 (秒)，0 表示收到响应后立即发送下一个')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help=f'各类消息的权重，默认 {DEFAULT_MIX}')
+        parser.add_argument('--capture', help='record_frames 生成的抓包文件，用其中的帧作为模板')
+        parser.add_argument('--timeout', type=float, default=10, help='单个请求的超时时间 (秒)')
+        parser.add_argument('--ramp-up', type=float, default=5, help='在该时间内逐步建立所有连接 (秒)')
+
+    async def run_watch(self, watch: SimulatedWatch, options, deadline):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.set_ciphers('DEFAULT:@SECLEVEL=0')
+
+        await asyncio.sleep(options['ramp_up'] * watch.index / max(1, options['watches']))
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(options['host'], options['port'], ssl=context), options['timeout'])
+        except (OSError, asyncio.TimeoutError) as e:
+            self.errors['connect: %s' % type(e).__name__] += 1
+            return
+
+        kinds = list(self.mix)
+        weights = [self.mix[k] for k in kinds]
+        try:
+            response = await self.request(reader, writer, 'login', watch.login_frame(), options)
+            if response is None:
+                return
+            try:
+                watch.baby_id = json.loads(response[5:]).get('baby_id', 0)
+            except ValueError:
+                pass
+            while time.monotonic() < deadline:
+                kind = random.choices(kinds, weights)[0]
+                if await self.request(reader, writer, kind, watch.frame_for(kind), options) is None:
+                    return
+                if options['interval']:
+                    await asyncio.sleep(options['interval'])
+        finally:
+            writer.close()
+
+    async def request(self, reader, writer, kind, frame, options):
+        start = time.perf_counter()
+        try:
+            writer.write(frame)
+            await writer.drain()
+            response = await asyncio.wait_for(read_frame(reader), options['timeout'])
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            self.errors['%s: %s' % (kind, type(e).__name__)] += 1
+            return None
+        self.latencies[kind].append(time.perf_counter() - start)
+        if response[4] == 0x00:
+            # 服务器对空响应回复的错误包
+            self.errors['%s: error packet' % kind] += 1
+        return response
+
+    async def handle_async(self, options):
+        templates = {}
+        if options['capture']:
+            for captured in read_capture(options['capture']):
+                if captured.direction == TO_SERVER:
+                    templates.setdefault(captured.msg_type, captured.frame)
+            self.stdout.write(f"[*] 从抓包文件中载入了 {len(templates)} 种帧模板")
+
+        self.mix = parse_mix(options['mix'])
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+        start = time.monotonic()
+        deadline = start + options['ramp_up'] + options['duration']
+        watches = [SimulatedWatch(i, templates) for i in range(options['watches'])]
+        await asyncio.gather(*(self.run_watch(w, options, deadline) for w in watches))
+        elapsed = time.monotonic() - start
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.latencies.values())
+        self.stdout.write(self.style.SUCCESS(
+            f"\n[*] 共完成 {total} 个请求，用时 {elapsed:.1f} 秒，吞吐量 {total / elapsed:.1f} req/s"))
+        self.stdout.write(f"{'类型':<10}{'数量':>8}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+        for kind, values in sorted(self.latencies.items()):
+            values.sort()
+            self.stdout.write(f"{kind:<10}{len(values):>8}" + ''.join(
+                f"{percentile(values, p) * 1000:>10.2f}" for p in (50, 90, 99, 100)))
+        if self.errors:
+            self.stdout.write(self.style.ERROR(f"[!] 错误数: {sum(self.errors.values())}"))
+            for name, count in sorted(self.errors.items()):
+                self.stdout.write(f"    {name}: {count}")
+        else:
+            self.stdout.write("[*] 没有错误")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.handle_async(options))
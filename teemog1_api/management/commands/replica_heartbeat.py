@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from teemog1_api.metrics import REPLICA_LAG_SECONDS, start_metrics_server
+from teemog1_api.models import ReplicaHeartbeat
+from teemog1_api.replicas import LagMonitor, replica_aliases
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Writes a heartbeat to the primary database and reports how far each read replica lags behind it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0, help='心跳间隔 (秒)，也是延迟的测量精度')
+        parser.add_argument('--metrics-port', type=int, default=None, help='在该端口提供 /metrics')
+        parser.add_argument('--once', action='store_true', help='写入一次心跳并输出当前延迟后退出')
+
+    def handle(self, *args, **options):
+        if not replica_aliases():
+            raise CommandError('REPLICA_DATABASES 未配置')
+        self.options = options
+        self.monitor = LagMonitor()
+        try:
+            asyncio.run(self.handle_async())
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n[*] 副本心跳已停止。'))
+
+    async def handle_async(self):
+        if self.options['metrics_port']:
+            await start_metrics_server(getattr(settings, 'TCP_METRICS_HOST', '127.0.0.1'), self.options['metrics_port'])
+        while True:
+            lags = await database_sync_to_async(self.beat)()
+            if self.options['once']:
+                for alias, lag in lags.items():
+                    self.stdout.write(f"[*] {alias}: " + ('未知' if lag is None else f"落后 {lag:.1f} 秒"))
+                return
+            await asyncio.sleep(self.options['interval'])
+
+    def beat(self) -> dict:
+        using = getattr(settings, 'WRITE_DATABASE', 'default')
+        ReplicaHeartbeat.objects.using(using).update_or_create(pk=1, defaults={'stamp': time.time()})
+        lags = self.monitor.measure()
+        max_lag = getattr(settings, 'REPLICA_MAX_LAG', 10)
+        for alias, lag in lags.items():
+            # 无法测量时按不可用处理，报告为无穷大
+            REPLICA_LAG_SECONDS.set(float('inf') if lag is None else lag, alias=alias)
+            if lag is None or lag > max_lag:
+                logger.warning("[!] 副本 %s 延迟 %s 秒，超过 %s 秒，暂不用于读取", alias, lag, max_lag)
+        return lags
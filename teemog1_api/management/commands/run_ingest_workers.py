@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+import redis.asyncio as redis
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from teemog1_api import ingest, streams
+from teemog1_api.metrics import (INGEST_STREAM_LAG, INGEST_STREAM_PENDING, INGEST_RECORDS, INGEST_BATCH_SECONDS,
+                                 start_metrics_server)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Consumes ingest records from Redis Streams (INGEST_STREAMS_URL) and writes them to the database in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', default=getattr(settings, 'INGEST_STREAMS_GROUP', 'writers'), help='消费组名称')
+        parser.add_argument('--consumer', default='%s-%d' % (socket.gethostname(), os.getpid()),
+                            help='消费者名称前缀，同一消费组内必须唯一')
+        parser.add_argument('--concurrency', type=int, default=1, help='本进程内的消费者数量')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'INGEST_APPLY_BATCH', 500),
+                            help='每个 stream 每次读取的最大条数')
+        parser.add_argument('--block-ms', type=int, default=1000, help='没有新消息时 XREADGROUP 的等待时间')
+        parser.add_argument('--claim-idle-ms', type=int, default=60000,
+                            help='认领其他消费者超过该时间仍未确认的消息 (例如进程崩溃)')
+        parser.add_argument('--lag-interval', type=float, default=10.0, help='刷新积压指标的间隔 (秒)')
+        parser.add_argument('--metrics-port', type=int, default=None, help='在该端口提供 /metrics')
+
+    def handle(self, *args, **options):
+        url = getattr(settings, 'INGEST_STREAMS_URL', None)
+        if not url:
+            raise CommandError('INGEST_STREAMS_URL 未配置')
+        self.options = options
+        try:
+            asyncio.run(self.handle_async(url))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n[*] 入库进程已停止。'))
+
+    async def handle_async(self, url):
+        client = redis.from_url(url, decode_responses=True)
+        group = self.options['group']
+        await streams.ensure_groups(client, group)
+        if self.options['metrics_port']:
+            await start_metrics_server(getattr(settings, 'TCP_METRICS_HOST', '127.0.0.1'), self.options['metrics_port'])
+
+        consumers = ['%s-%d' % (self.options['consumer'], i) for i in range(self.options['concurrency'])]
+        self.stdout.write(self.style.SUCCESS(f"[*] 入库进程已启动: 消费组 {group}，消费者 {', '.join(consumers)}"))
+        await asyncio.gather(self.report_lag(client, group),
+                             *(self.consume(client, group, consumer) for consumer in consumers))
+
+    async def consume(self, client, group: str, consumer: str):
+        batch_size = self.options['batch_size']
+        names = [streams.stream_name(kind) for kind in streams.KINDS]
+        # 先处理崩溃的消费者遗留的消息；出错后留在 PEL 中的消息也要靠认领重试，所以繁忙时也定期认领
+        next_claim = 0
+        while True:
+            try:
+                if time.monotonic() >= next_claim:
+                    next_claim = time.monotonic() + self.options['claim_idle_ms'] / 1000
+                    await self.claim(client, group, consumer, names)
+                response = await client.xreadgroup(group, consumer, {name: '>' for name in names},
+                                                   count=batch_size, block=self.options['block_ms'])
+                if not response:
+                    next_claim = 0
+                    continue
+                for name, entries in response:
+                    await self.apply(client, group, name, entries)
+            except redis.ConnectionError as e:
+                logger.error("[!] 读取 Redis Streams 失败，5 秒后重试: %s", e)
+                await asyncio.sleep(5)
+            except DatabaseError as e:
+                # 没有确认的消息留在 PEL 中，超过 claim_idle_ms 后重新认领
+                logger.error("[!] 写入数据库失败，5 秒后重试: %s", e)
+                await asyncio.sleep(5)
+
+    async def claim(self, client, group: str, consumer: str, names: list):
+        for name in names:
+            start = '0-0'
+            while True:
+                start, entries, _ = await client.xautoclaim(name, group, consumer, self.options['claim_idle_ms'],
+                                                            start_id=start, count=self.options['batch_size'])
+                if entries:
+                    logger.info("[*] %s 认领了 %s 中 %d 条未确认的消息", consumer, name, len(entries))
+                    await self.apply(client, group, name, entries)
+                if start == '0-0':
+                    break
+
+    async def apply(self, client, group: str, name: str, entries: list):
+        kind = streams.stream_kind(name)
+        ids, records, record_ids = [], [], []
+        for entry_id, fields in entries:
+            # xautoclaim 返回已被裁剪的消息时 fields 为空
+            if not fields:
+                ids.append(entry_id)
+                continue
+            try:
+                records.append(streams.decode(fields))
+            except (KeyError, ValueError) as e:
+                logger.error("[!] 无法解析 %s 中的消息 %s，跳过: %s", name, entry_id, e)
+                ids.append(entry_id)
+                continue
+            record_ids.append(entry_id)
+        if records:
+            with INGEST_BATCH_SECONDS.time(kind=kind):
+                applied, done = await database_sync_to_async(ingest.apply_records)(kind, records)
+            INGEST_RECORDS.inc(applied, kind=kind)
+            ids += [record_ids[index] for index in sorted(done)]
+        # 写入数据库后才确认，没有确认的消息 (进程崩溃或数据库出错) 会被重新认领
+        if ids:
+            await client.xack(name, group, *ids)
+
+    async def report_lag(self, client, group: str):
+        while True:
+            try:
+                for name, (lag, pending) in (await streams.group_lag(client, group)).items():
+                    if lag is not None:
+                        INGEST_STREAM_LAG.set(lag, stream=name)
+                    INGEST_STREAM_PENDING.set(pending, stream=name)
+                    logger.debug("[*] %s: 积压 %s 条，未确认 %s 条", name, lag, pending)
+            except redis.RedisError as e:
+                logger.warning("[!] 读取消费组积压失败: %s", e)
+            await asyncio.sleep(self.options['lag_interval'])
@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import ssl
 import struct
 import json
@@ -14,17 +15,32 @@ import redis.asyncio as redis  # 使用异步 redis 库
 from django.conf import settings
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from channels.db import database_sync_to_async
 from django.utils import timezone
 
 from teemog1_api.models import WatchDevice, LocationPackage, LocationData, Contact, CallRecord, ChatLog, SmsMessage
 from django.contrib.auth.models import User
 from teemog1_api.NativeUtils import NativeUtils
+from teemog1_api import catalog, ingest, resource_versions
+from teemog1_api.journal import Journal
+from teemog1_api.streams import StreamPublisher
+from teemog1_api.authentication import remember_device_token
+from teemog1_api.log import PacketTraceSampler
+from teemog1_api.phone_index import CONTACTS_CHANNEL, INVALIDATE_COMMAND, phone_index
+from teemog1_api.group_commit import group_commit_task
+from teemog1_api.framing import BufferBudget, FrameDecoder, FrameError
+from teemog1_api.tcp_session import ConnectionSession
+from teemog1_api.metrics import (FRAMES, FRAME_BYTES, GENERAL_MESSAGES, HANDLER_SECONDS, DB_WAIT_SECONDS,
+                                 CONNECTED_CLIENTS, BUFFER_BYTES, BUFFER_BUDGET_BYTES, DISCARDED_BYTES, FRAMING_ERRORS,
+                                 DUPLICATE_MESSAGES, REDIS_LISTENER_LAG_SECONDS, start_metrics_server)
 
 import logging
 
-logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(message)s')
 logger = logging.getLogger(__name__)
+# 逐包跟踪日志单独使用一个 logger，级别和采样率见 settings.LOG_LEVELS / TCP_PACKET_TRACE_SAMPLE_RATE
+packet_logger = logging.getLogger('teemog1_api.packets')
+packet_trace = PacketTraceSampler(packet_logger, getattr(settings, 'TCP_PACKET_TRACE_SAMPLE_RATE', 0.01))
 
 # --- 配置 ---
 TCP_HOST = '0.0.0.0'
@@ -32,13 +48,46 @@ TCP_PORT = 59093
 CERT_FILE = './ca.crt'  # 证书和私钥路径
 KEY_FILE = './ca.key'
 CLIENTS = {}
+# 指标服务监听地址，TCP_METRICS_PORT 为 None 时不启动
+METRICS_HOST = getattr(settings, 'TCP_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(settings, 'TCP_METRICS_PORT', None)
+
+CONNECTED_CLIENTS.set_function(lambda: len(CLIENTS))
+# 预先生成 msg_type 的指标标签，避免每个包都格式化一次
+MSG_TYPE_LABELS = ['0x%02x' % i for i in range(256)]
+
+# 分帧限制，见 settings 中的 TCP 分帧配置
+MAX_FRAME_SIZES = getattr(settings, 'TCP_MAX_FRAME_SIZES', {})
+DEFAULT_MAX_FRAME_SIZE = getattr(settings, 'TCP_DEFAULT_MAX_FRAME_SIZE', 256 * 1024)
+UNKNOWN_MAX_FRAME_SIZE = getattr(settings, 'TCP_UNKNOWN_MAX_FRAME_SIZE', 64 * 1024)
+MAX_GARBAGE_BYTES = getattr(settings, 'TCP_MAX_GARBAGE_BYTES', 4096)
+BUFFER_BUDGET = BufferBudget(getattr(settings, 'TCP_BUFFER_BUDGET', 256 * 1024 * 1024))
+BUFFER_BUDGET_BYTES.set_function(lambda: BUFFER_BUDGET.used)
+
+# 写前日志目录 / Redis Streams 地址，都为 None 时处理函数直接写数据库，见 ingest.py
+JOURNAL_DIR = getattr(settings, 'INGEST_JOURNAL_DIR', None)
+STREAMS_URL = getattr(settings, 'INGEST_STREAMS_URL', None)
+# 启用时为 Journal 或 StreamPublisher，在 Command.handle_async 中创建
+ingest_sink = None
+
+
+def db_task(func):
+    """等同于 database_sync_to_async，同时记录等待数据库线程完成的耗时"""
+    async_func = database_sync_to_async(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with DB_WAIT_SECONDS.time(handler=func.__name__):
+            return await async_func(*args, **kwargs)
+
+    return wrapper
 
 
 async def redis_listener():
     """监听 Redis 的 'contacts_notify' 频道"""
     r = redis.from_url("redis://localhost", decode_responses=True)
     pubsub = r.pubsub()
-    await pubsub.subscribe("contacts_notify")  # 频道名可以更通用一些
+    await pubsub.subscribe(CONTACTS_CHANNEL)  # 频道名可以更通用一些
     logger.info("[*] Redis 订阅器已启动，正在监听 'contacts_notify' 频道...")
 
     while True:
@@ -50,11 +99,17 @@ async def redis_listener():
                 data_str = message['data']
                 data = json.loads(data_str)
                 command = data.get('command')
+                if 'ts' in data:
+                    REDIS_LISTENER_LAG_SECONDS.observe(max(0.0, time.time() - data['ts']))
 
-                if command == 'add_contact':
+                if command == INVALIDATE_COMMAND:
+                    # 联系人是在其他进程中修改的，本进程收不到模型信号
+                    phone_index.invalidate(data['device_id'])
+
+                elif command == 'add_contact':
                     udid = data['udid']
                     new_contact_user_id = data['contact_id']
-                    logger.debug(f"[*] 从 Redis 收到通知：为设备 {udid} 添加联系人 {new_contact_user_id}。")
+                    logger.debug("[*] 从 Redis 收到通知：为设备 %s 添加联系人 %s。", udid, new_contact_user_id)
 
                     if udid in CLIENTS:
                         writer = CLIENTS[udid]
@@ -67,13 +122,13 @@ async def redis_listener():
                             if response_packet:
                                 writer.write(response_packet)
                                 await writer.drain()
-                                logger.debug(f"[*] 已通过 TCP 连接向 {udid} 推送 'add' 联系人消息。")
+                                logger.debug("[*] 已通过 TCP 连接向 %s 推送 'add' 联系人消息。", udid)
                         except Exception as e:
-                            logger.error(f"[!] 推送 'add' 联系人消息到 {udid} 时出错: {e}")
+                            logger.error("[!] 推送 'add' 联系人消息到 %s 时出错: %s", udid, e)
                     else:
-                        logger.error(f"[!] 收到 'add' 通知，但设备 {udid} 当前未连接。")
+                        logger.error("[!] 收到 'add' 通知，但设备 %s 当前未连接。", udid)
         except Exception as e:
-            logger.error(f"[!] Redis 监听器出错: {e}")
+            logger.error("[!] Redis 监听器出错: %s", e)
             await asyncio.sleep(5)
 
 
@@ -95,7 +150,7 @@ def parse_chat_message_packet(payload: bytes):
 
         json_end = 2 + json_len
         if len(payload) < json_end:
-            logger.error(f"[!] 聊天消息载荷不完整。声明的JSON长度为 {json_len}，但实际载荷只有 {len(payload)}。")
+            logger.error("[!] 聊天消息载荷不完整。声明的JSON长度为 %d，但实际载荷只有 %d。", json_len, len(payload))
             return None, None
 
         json_bytes = payload[2:json_end]
@@ -107,7 +162,7 @@ def parse_chat_message_packet(payload: bytes):
         return json_data, binary_data
 
     except (struct.error, json.JSONDecodeError, UnicodeDecodeError) as e:
-        logger.error(f"[!] 解析聊天消息载荷失败: {e}")
+        logger.error("[!] 解析聊天消息载荷失败: %s", e)
         return None, None
 
 
@@ -120,13 +175,13 @@ def parse_teemo_zlib_packet(data):
     try:
         payload = zlib.decompress(payload_zlib)
     except zlib.error as e:
-        logger.error(f"[!] 解压payload失败: {e}\n    原始Payload: {payload}")
-        return payload, None
+        logger.error("[!] 解压payload失败: %s\n    原始Payload: %r", e, payload_zlib)
+        return payload_zlib, None
     try:
         json_data = json.loads(payload.decode('utf-8'))
         return json_data, None
     except (json.JSONDecodeError, UnicodeDecodeError) as e:
-        logger.error(f"[!] 解析JSON失败: {e}\n    原始Payload: {payload}")
+        logger.error("[!] 解析JSON失败: %s\n    原始Payload: %r", e, payload)
         return payload, None
 
 
@@ -140,7 +195,7 @@ def parse_teemo_packet(data):
         json_data = json.loads(payload.decode('utf-8'))
         return json_data, None
     except (json.JSONDecodeError, UnicodeDecodeError) as e:
-        logger.error(f"[!] 解析JSON失败: {e}\n    原始Payload: {payload}")
+        logger.error("[!] 解析JSON失败: %s\n    原始Payload: %r", e, payload)
         return payload, None
 
 
@@ -152,13 +207,21 @@ def create_teemo_response_packet(msg_type, json_payload):
     return header + payload_bytes
 
 
-@database_sync_to_async
+def _new_baby_id() -> int:
+    """用时间戳生成 baby_id，同一秒内有多个新设备登录时顺延，避免违反唯一约束"""
+    baby_id = int(time.time())
+    while WatchDevice.objects.filter(baby_id=baby_id).exists():
+        baby_id += 1
+    return baby_id
+
+
+@group_commit_task
 def handle_login_request_db(device_instance: WatchDevice | None, req_json_data: dict, **kwargs):
     """处理登录请求并与数据库交互"""
     valid = True
     udid = req_json_data.get('udid')
     if not udid or len(udid) < 16:
-        logger.error(f"params udid invalid: {udid}")
+        logger.error("params udid invalid: %s", udid)
         valid = False
     iccid = req_json_data.get('iccid')
     # if not iccid or len(iccid) < 16:
@@ -166,7 +229,7 @@ def handle_login_request_db(device_instance: WatchDevice | None, req_json_data:
     #     valid = False
     imei = req_json_data.get('imei')
     if not imei or len(imei) < 15:
-        logger.error(f"params imei invalid: {imei}")
+        logger.error("params imei invalid: %s", imei)
         valid = False
     imsi = req_json_data.get('imsi')
     # if not imsi or len(imsi) < 15:
@@ -174,7 +237,7 @@ def handle_login_request_db(device_instance: WatchDevice | None, req_json_data:
     #     valid = False
     mac = req_json_data.get('mac')
     if not mac or len(mac) < 17:
-        logger.error(f"params mac invalid: {mac}")
+        logger.error("params mac invalid: %s", mac)
         valid = False
 
     if not valid:
@@ -184,7 +247,7 @@ def handle_login_request_db(device_instance: WatchDevice | None, req_json_data:
     device, created = WatchDevice.objects.get_or_create(
         udid=udid,
         defaults={
-            'baby_id': int(time.time()),  # 用时间戳生成一个唯一的 baby_id
+            'baby_id': _new_baby_id,  # 只在创建设备时调用，生成一个唯一的 baby_id
             'ssn': req_json_data.get('imei', ''),
             'iccid': iccid,
             'imei': imei,
@@ -194,6 +257,7 @@ def handle_login_request_db(device_instance: WatchDevice | None, req_json_data:
     )
 
     # 每次登录都更新 token 和状态
+    old_http_token = device.http_token
     device.http_token = uuid.uuid4()
     # device.is_bound = True
     device.device_version = req_json_data.get('device_version')
@@ -202,8 +266,12 @@ def handle_login_request_db(device_instance: WatchDevice | None, req_json_data:
     device.imei = req_json_data.get('imei', "")
     device.imsi = req_json_data.get('imsi', "")
     device.save()
+    # 旧 token 立即失效，新 token 预先写入缓存，手表随后的 HTTP 请求不需要再查数据库。
+    # 在 post_save 删除缓存 (signals.forget_changed_device_token) 之后、事务提交之后执行
+    transaction.on_commit(lambda: remember_device_token(device, old_token=old_http_token))
 
-    logger.info(f"[*] 设备 {'创建' if created else '找到'}: {device.udid}")
+    logger.info("[*] 设备 %s: %s", '创建' if created else '找到', device.udid)
+    versions = resource_versions.get_versions(device.pk)
 
     response_payload = {
         # 身份认证相关
@@ -235,13 +303,13 @@ def handle_login_request_db(device_instance: WatchDevice | None, req_json_data:
         "pingpong": 300,
         # 各种资源（表情、联系人、主题、表盘等）的版本号
         # 如果服务器的版本号更高，手表就会发起请求去下载新资源
-        "emoticon_ver": 1,
-        "contact_ptt_ver": 1,
-        "family_ptt_ver": 1,
-        "friend_ptt_ver": 1,
-        "theme_ver": "1",
-        "dial_ver": "1",
-        "cover_ver": "1",
+        "emoticon_ver": catalog.emoticons.version(),
+        "contact_ptt_ver": versions[resource_versions.CONTACT_PTT],
+        "family_ptt_ver": versions[resource_versions.FAMILY_PTT],
+        "friend_ptt_ver": versions[resource_versions.FRIEND_PTT],
+        "theme_ver": str(catalog.themes.version()),
+        "dial_ver": str(catalog.dials.version()),
+        "cover_ver": str(versions[resource_versions.COVER]),
         # 可能与SIM卡的流量、有效期等信息有关
         "current_month": 0,
         "current_remainder": 0,
@@ -307,7 +375,7 @@ def handle_weather_request(device_instance: WatchDevice, req_json_data: dict, **
     return response_packet
 
 
-@database_sync_to_async
+@db_task
 def handle_add_contact_push_db(device_instance: WatchDevice, new_contact_user_id):
     """
     为单个新增联系人构造一个 "type": "add" 的推送包。
@@ -317,10 +385,10 @@ def handle_add_contact_push_db(device_instance: WatchDevice, new_contact_user_id
     try:
         contact = Contact.objects.get(device=device_instance, user_id=new_contact_user_id)
     except Contact.DoesNotExist:
-        logger.error(f"[!] 无法构造推送包：在数据库中找不到新增的联系人 ID {new_contact_user_id}")
+        logger.error("[!] 无法构造推送包：在数据库中找不到新增的联系人 ID %s", new_contact_user_id)
         return None
 
-    logger.debug(f"[*] 正在为新增联系人 '{contact.name}' 构造 'add' 类型的推送包...")
+    logger.debug("[*] 正在为新增联系人 '%s' 构造 'add' 类型的推送包...", contact.name)
 
     contact_data = {
         "user_id": contact.user_id,
@@ -364,7 +432,7 @@ def handle_add_contact_push_db(device_instance: WatchDevice, new_contact_user_id
     return create_teemo_response_packet(123, final_response)
 
 
-@database_sync_to_async
+@db_task
 def handle_contact_request_db(device_instance: WatchDevice, req_json_data: dict, **kwargs):
     """
     处理联系人同步请求，从数据库查询并构造响应包。
@@ -376,10 +444,10 @@ def handle_contact_request_db(device_instance: WatchDevice, req_json_data: dict,
         return
     logger.debug("[*] 检测到联系人请求 (类型 123,2)，正在构造成功响应...")
 
-    logger.debug(f"[*] 为设备 {device_instance.udid} 查询联系人...")
+    logger.debug("[*] 为设备 %s 查询联系人...", device_instance.udid)
 
     # 从数据库中获取该设备的所有联系人
-    all_contacts = Contact.objects.filter(device=device_instance).order_by('spell', 'name')
+    all_contacts = Contact.objects.filter(device=device_instance).order_by('spell', 'name').prefetch_related('ext_phones')
 
     # 按类型分组
     family_list = []
@@ -397,7 +465,7 @@ def handle_contact_request_db(device_instance: WatchDevice, req_json_data: dict,
             "spell": contact.spell or "",
             "device_type": 100 if contact.admin == 1 else 2,
             "auth": contact.auth,
-            "ext": contact.get_ext_phones()  # 使用辅助方法获取列表
+            "ext": contact.get_ext_phones()  # 读取预取的 ext_phones，不再逐行查询或解析 JSON
         }
 
         if contact.contacts_type == Contact.ContactType.FAMILY:
@@ -441,13 +509,15 @@ def handle_contact_request_db(device_instance: WatchDevice, req_json_data: dict,
         "data": contacts_down_data
     }
 
-    logger.debug(f"[*] 为设备 {device_instance.udid} 生成了包含 {len(all_contacts)} 个联系人的响应包。")
-    logger.debug(json.dumps(final_response, indent=2, ensure_ascii=False))  # 日志太长，可以注释掉
+    logger.debug("[*] 为设备 %s 生成了包含 %d 个联系人的响应包。", device_instance.udid, len(all_contacts))
+    if packet_trace.sample():
+        # 完整通讯录很长，只在逐包跟踪开启并命中采样时才序列化
+        packet_logger.debug("[*] 联系人响应内容: %s", json.dumps(final_response, ensure_ascii=False))
 
     return create_teemo_response_packet(123, final_response)
 
 
-@database_sync_to_async
+@group_commit_task
 def handle_sms_record_db(device_instance: WatchDevice, sms_data: dict, **kwargs):
     """
     处理短信上报，并将其存入数据库
@@ -456,14 +526,13 @@ def handle_sms_record_db(device_instance: WatchDevice, sms_data: dict, **kwargs)
         return None
     if not device_instance:
         return None
-    sms_log = SmsMessage.objects.create(
-        device=device_instance,                # 必须填入关联的 WatchDevice 实例
-        message=sms_data.get('message', ''),       # 获取短信内容
-        phone=sms_data.get('phone', ''),           # 获取电话号码
-        error_cause=int(sms_data.get('error_cause', '0')),
-        stamp=timezone.now()                 # 生成当前时间戳（秒级），如果需要毫秒则 *1000
-    )
-    return
+    ingest.apply_sms(device_instance, sms_data)
+    return sms_ack(sms_data)
+
+
+def sms_ack(sms_data: dict):
+    # 短信不需要确认
+    return None
     # 清空所有短信
     # return create_teemo_response_packet(28, {"status": 1, "msg": ""})
     # 给指定号码发短信
@@ -472,7 +541,7 @@ def handle_sms_record_db(device_instance: WatchDevice, sms_data: dict, **kwargs)
     # return create_teemo_response_packet(57, {"service_number": 10086, "msg": ""})
 
 
-@database_sync_to_async
+@group_commit_task
 def handle_call_record_db(device_instance: WatchDevice, record_data: dict, **kwargs):
     """
     处理通话记录上报，并将其存入数据库
@@ -481,44 +550,11 @@ def handle_call_record_db(device_instance: WatchDevice, record_data: dict, **kwa
         return None
     if not device_instance or 'recents' not in record_data:
         return None
+    ingest.apply_call_records(device_instance, record_data)
+    return call_record_ack(record_data)
 
-    saved_records = []
-    for record in record_data.get('recents', []):
-        record_id = record.get('id')
-        if not record_id:
-            continue
-
-        # 使用 update_or_create 避免重复创建
-        # 我们使用 record_id 作为唯一标识
-        obj, created = CallRecord.objects.update_or_create(
-            record_id=record_id,
-            defaults={
-                'device': device_instance,
-                'phone_number': record.get('phone'),
-                'name': record.get('name'),
-                'call_type': record.get('in', 0),
-                # 手表上报的是秒级时间戳，转换为 Django 的 DateTimeField
-                'stamp': datetime.fromtimestamp(record.get('stamp', 0), tz=datetimezone.utc),
-                'duration': record.get('time', 0),
-                'geo_data_json': json.dumps(record.get('geo_data')),
-                'is_read': record.get('is_read') == 1,
-                'is_sync': True,  # 既然服务器收到了，就标记为已同步
-            }
-        )
-
-        # 尝试将记录与现有联系人关联
-        # 这是一个可选的优化，可以后台任务做
-        try:
-            contact = Contact.objects.filter(device=device_instance, phone=obj.phone_number).first()
-            if contact:
-                obj.contact = contact
-                obj.save(update_fields=['contact'])
-        except Exception:
-            pass
-
-        logger.info(f"[*] 通话记录 {'创建' if created else '更新'}: ID {record_id} for device {device_instance.udid}")
-        saved_records.append(record_id)
 
+def call_record_ack(record_data: dict):
     # 根据源码 RecordRemoteDataSource，服务器需要回复一个确认包
     # 这个包的结构是 RecordDownData
     response_payload = {
@@ -549,7 +585,7 @@ def handle_apps_request(device_instance: WatchDevice, req_json_data: dict, **kwa
     return response_packet
 
 
-@database_sync_to_async
+@group_commit_task
 def handle_location_msg(device_instance: WatchDevice, req_json_data: dict, **kwargs):
     """
     处理位置消息 (类型 11)，并返回一个表示成功的响应包
@@ -560,80 +596,25 @@ def handle_location_msg(device_instance: WatchDevice, req_json_data: dict, **kwa
     # 0x7d: 新协议teemo_K1
     logger.debug("[*] 检测到位置消息 (类型 11 / 0x7d)，正在构造成功响应...")
 
-    msg_type = kwargs.get('kwargs', 11)
     package_id = req_json_data.get('id')
     if not package_id:
-        logger.error(f"params id invalid: {package_id}")
+        logger.error("params id invalid: %s", package_id)
     data = req_json_data.get('data')
     if not data or not isinstance(data, list) or len(data) < 1:
-        logger.error(f"params data invalid: {data}")
+        logger.error("params data invalid: %s", data)
         return
-    strategy = req_json_data.get('strategy')
-    # if not strategy:
-    #     logger.error(f"params strategy invalid: {strategy}")
 
-    # 查找或创建设备
-    location_package = LocationPackage.objects.create(
-        device=device_instance,
-        user=device_instance.user,
-        msg_id=package_id,
-        strategy=strategy,
-        received_at=timezone.now()
-    )
+    if ingest.apply_location(device_instance, req_json_data) is None:
+        DUPLICATE_MESSAGES.inc(kind=ingest.LOCATION, source='database')
+    # 重传的数据包已经保存过，同样回复 ACK，否则手表会一直重传
+    return location_ack(req_json_data)
 
-    if not location_package:
-        logger.error(f"[!] 建立LocationPackage错误")
-
-    for _data in data:
-        if not isinstance(_data, dict):
-            continue
-        valid_wifi = ','.join([str(i) for i in _data.get('valid_wifi', {}).get('id', [])])
-        power = _data.get('power', 0)
-        stamp = _data.get('stamp', 0)
-        signal = _data.get('signal', 0)
-        reply_loc = _data.get('reply_loc', 0)
-        sos = _data.get('sos', 0)
-        geo = _data.get('geo', '')
-        geo_data = ''
-        isGps = _data.get('isGps', 0)
-        gps_time_duration = _data.get('gps_time', {}).get('duration', 0)
-        gps_time_type = _data.get('gps_time', {}).get('type', 0)
-        gps_timeout = _data.get('gps_timeout', 0)
-        search_count = _data.get('search_count', 0)
-        wifi_1 = _data.get('wifi_1', 0)
-        wifi_2 = _data.get('wifi_2', 0)
-        wifi_3 = _data.get('wifi_3', 0)
-        wifi_1_valid = _data.get('wifi_1_valid', 0)
-        wifi_2_valid = _data.get('wifi_2_valid', 0)
-        wifi_3_valid = _data.get('wifi_3_valid', 0)
-        if geo:
-            try:
-                if isinstance(geo, str):
-                    geo_data = NativeUtils.decrypt(base64.decodebytes(geo.encode('utf8')), 5)
-                elif isinstance(geo, dict):
-                    geo_data = json.dumps(geo)
-                else:
-                    geo_data = geo
-            except:
-                geo_data = ''
-        LocationData.objects.create(
-            package=location_package,
-            # 数据点信息
-            stamp=stamp,
-            power=power,
-            signal=signal,
-            sos=sos,
-            reply_loc=reply_loc,
-            geo_encrypted=geo,
-            geo_decrypted=geo_data,
-            valid_wifis=valid_wifi,
-            created_at=timezone.now()
-        )
-    response_packet = create_teemo_response_packet(11, {"status": 1, "msg": "", "id": package_id})
-    return response_packet
 
+def location_ack(req_json_data: dict):
+    return create_teemo_response_packet(11, {"status": 1, "msg": "", "id": req_json_data.get('id')})
 
-@database_sync_to_async
+
+@group_commit_task
 def update_device_status_db(device_instance: WatchDevice, ping_data: dict, **kwargs):
     """
     使用 PING 包的数据更新数据库中的设备状态
@@ -641,7 +622,7 @@ def update_device_status_db(device_instance: WatchDevice, ping_data: dict, **kwa
     if not device_instance or not isinstance(ping_data, dict):
         return
 
-    logger.debug(f"[*] 正在为设备 {device_instance.udid} 更新 PING 状态...")
+    logger.debug("[*] 正在为设备 %s 更新 PING 状态...", device_instance.udid)
     device_instance.last_power = ping_data.get('power')
     device_instance.last_power_percent = ping_data.get('power_percent')
     device_instance.last_signal = ping_data.get('signal')
@@ -656,9 +637,9 @@ def update_device_status_db(device_instance: WatchDevice, ping_data: dict, **kwa
     return create_teemo_response_packet(2, {"status": 1, "msg": ""})
 
 
-@database_sync_to_async
+@group_commit_task
 def handle_status_msg(device_instance: WatchDevice, req_json_data: dict, **kwargs):
-    logger.debug(f"[*] 正在为设备 {device_instance.udid} 更新 PING 状态...")
+    logger.debug("[*] 正在为设备 %s 更新 PING 状态...", device_instance.udid)
     charging = req_json_data.get('charging', 'off')
     if device_instance and device_instance.last_charging != charging:
         device_instance.last_ping_time = timezone.now()
@@ -670,7 +651,7 @@ def handle_status_msg(device_instance: WatchDevice, req_json_data: dict, **kwarg
     return response_packet
 
 
-@database_sync_to_async
+@group_commit_task
 def handle_chat_message_db(device_instance: WatchDevice, json_payload: dict, **kwargs):
     """
     处理解析后的聊天消息，存入数据库，并返回 ACK 包。
@@ -678,97 +659,94 @@ def handle_chat_message_db(device_instance: WatchDevice, json_payload: dict, **k
     if not device_instance or not json_payload:
         return None
 
-    binary_payload = kwargs.get('binary_payload')
-
     message_id = json_payload.get('id')
     if not message_id:
         logger.error("[!] 聊天消息中缺少 'id' 字段。")
         return None
 
-    # 1. 检查消息是否已存在，防止重复处理
-    if ChatLog.objects.filter(device=device_instance, message_id=message_id).exists():
-        logger.warning(f"[*] 收到重复的聊天消息 {message_id}，忽略处理。")
-        # 即使是重复消息，也应该回复 ACK，防止客户端重传
-        response_payload = {"id": message_id, "type": 122}
-        return create_teemo_response_packet(0x03, response_payload)
-
-    # 2. 解析并创建 ChatLog 对象
     try:
-        content = json_payload.get('content', {})
-        content_type = json_payload.get('content_type')
-
-        chat_log_data = {
-            'device': device_instance,
-            'message_id': message_id,
-            'chat_type': json_payload.get('chat_type'),
-            'content_type': content_type,
-            'from_user_id': json_payload.get('from_user_id'),
-            'to_id': json_payload.get('to_id'),
-            'stamp': json_payload.get('stamp'),
-        }
-
-        if content_type == ChatLog.ContentType.TEXT:
-            chat_log_data['content_text'] = content.get('text')
-        elif content_type == ChatLog.ContentType.VOICE:
-            chat_log_data['voice_length'] = content.get('voice_length', 0)
-            if binary_payload:
-                # 定义存储路径
-                voice_dir = os.path.join(settings.MEDIA_ROOT, 'voice_messages', device_instance.udid)
-                os.makedirs(voice_dir, exist_ok=True)
-                # 使用 message_id 作为文件名保证唯一性，后缀为 .amr
-                file_name = f"{message_id}.amr"
-                file_path = os.path.join(voice_dir, file_name)
-                with open(file_path, 'wb') as f:
-                    f.write(binary_payload)
-                # 在数据库中存储相对路径
-                chat_log_data['content_file_path'] = os.path.join('voice_messages', device_instance.udid, file_name)
-                logger.debug(f"[*] 语音消息已保存至: {file_path}")
-
-        # TODO: 在此添加对图片、视频、表情等其他类型的处理
-        # elif content_type == ChatLog.ContentType.IMAGE:
-        #     ...
-
-        ChatLog.objects.create(**chat_log_data)
-        logger.info(f"[*] 已成功保存来自 {device_instance.udid} 的聊天消息 {message_id}。")
-
+        # 重复的消息不会再次保存，但也应该回复 ACK，防止客户端重传
+        if not ingest.apply_chat(device_instance, json_payload, binary_payload=kwargs.get('binary_payload')):
+            DUPLICATE_MESSAGES.inc(kind=ingest.CHAT, source='database')
     except Exception as e:
-        logger.error(f"[!] 保存聊天消息 {message_id} 到数据库时出错: {e}")
+        logger.error("[!] 保存聊天消息 %s 到数据库时出错: %s", message_id, e)
         # 即使保存失败，也可能需要回复ACK，具体取决于业务逻辑
         # 这里我们选择不回复，让客户端有机会重试
         return None
 
-    # 3. 构造并返回 ACK 确认包
+    return chat_ack(json_payload)
+
+
+def chat_ack(json_payload: dict):
+    # 构造 ACK 确认包
     response_payload = {
-        "id": message_id,
+        "id": json_payload.get('id'),
         "type": 122  # ACK包里的type字段是原始消息的类型
     }
-    logger.debug(f"[*] 正在为消息 {message_id} 构造 ACK (类型 0x03) ...")
+    logger.debug("[*] 正在为消息 %s 构造 ACK (类型 0x03) ...", response_payload['id'])
     return create_teemo_response_packet(0x03, response_payload)
 
 
+def deferred(kind: str, handler, ack):
+    """
+    启用写前日志或 Redis Streams 时，可以入库的消息交给 ingest_sink 后立即回复 ACK，
+    由 apply_journal / run_ingest_workers 入库；未启用或消息不完整时仍由 handler 直接处理。
+    """
+    async def wrapper(device_instance: WatchDevice, payload: dict, **kwargs):
+        if ingest_sink is None or not device_instance or settings.ONLY_LOGIN or not ingest.is_valid(kind, payload):
+            return await handler(device_instance, payload, **kwargs)
+        await ingest_sink.append(ingest.make_record(kind, device_instance, payload, kwargs.get('binary_payload')))
+        return ack(payload)
+
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+
+def deduplicated(kind: str, handler, ack):
+    """
+    本连接最近已经 ACK 过的消息 (手表没收到 ACK 而重传) 直接再回复一次 ACK，不交给 handler，
+    不访问数据库也不写入日志。记录保存在 ConnectionSession.recent[kind] 中
+    """
+    async def wrapper(device_instance: WatchDevice, payload: dict, session: ConnectionSession = None, **kwargs):
+        message_id = payload.get('id') if isinstance(payload, dict) else None
+        recent_ids = session.recent.get(kind) if session is not None and message_id else None
+        if recent_ids is not None and str(message_id) in recent_ids:
+            DUPLICATE_MESSAGES.inc(kind=kind, source='session')
+            logger.debug("[*] 设备重传了 %s 消息 %s，直接回复 ACK", kind, message_id)
+            return ack(payload)
+        response = await handler(device_instance, payload, session=session, **kwargs)
+        if response and recent_ids is not None:
+            recent_ids.add(str(message_id))
+        return response
+
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+
 async def handle_general_message(device_instance: WatchDevice, raw_payload: dict, **kwargs):
-    logger.debug(f"[*] 处理 general 类型消息...")
+    logger.debug("[*] 处理 general 类型消息...")
     error_resp = None
     if not isinstance(raw_payload, dict):
-        logger.error(f"[!] 消息payload类型错误: {raw_payload}")
+        logger.error("[!] 消息payload类型错误: %r", raw_payload)
         return error_resp
     if "sub_type" not in raw_payload:
-        logger.error(f"[!] 消息payload数据错误, 'sub_type' 不存在: {raw_payload}")
+        logger.error("[!] 消息payload数据错误, 'sub_type' 不存在: %s", raw_payload)
         return error_resp
     try:
         sub_type = int(raw_payload["sub_type"])
     except ValueError as e:
-        logger.error(f"[!] 消息payload数据错误, 'sub_type' 应为数字: {raw_payload}")
+        logger.error("[!] 消息payload数据错误, 'sub_type' 应为数字: %s", raw_payload)
         return error_resp
 
     # logger.debug(f"[*] 子类型: {sub_type}")
     dispatcher = general_dispatcher.get(sub_type, {})
     if 'type' not in dispatcher:
-        logger.error(f"[!] 未知子类型: {sub_type}")
+        logger.error("[!] 未知子类型: %s", sub_type)
         return error_resp
-    logger.info(f"[*] 收到通用类型消息， {sub_type}: {dispatcher['type']}")
+    logger.info("[*] 收到通用类型消息， %s: %s", sub_type, dispatcher['type'])
+    GENERAL_MESSAGES.inc(sub_type=sub_type, type=dispatcher['type'])
     if 'handler' not in dispatcher:
-        logger.error(f"[!] 未定义handler: {sub_type}")
+        logger.error("[!] 未定义handler: %s", sub_type)
         return error_resp
 
     handler = dispatcher['handler']
@@ -778,10 +756,10 @@ async def handle_general_message(device_instance: WatchDevice, raw_payload: dict
         elif callable(handler):
             return handler(device_instance, raw_payload)
         else:
-            logger.error(f"[!] handler类型错误: {type(handler)}")
+            logger.error("[!] handler类型错误: %s", type(handler))
             return error_resp
     except Exception as e:
-        logger.error(f"{e}")
+        logger.error("%s", e)
         return error_resp
 
 
@@ -799,12 +777,14 @@ message_dispatcher = {
     0x0b: {
         'type': 'location',
         'parser': parse_teemo_packet,
-        'handler': handle_location_msg,
+        'handler': deduplicated(ingest.LOCATION, deferred(ingest.LOCATION, handle_location_msg, location_ack),
+                                location_ack),
     },
     0x7d: {
         'type': 'location',
         'parser': parse_teemo_zlib_packet,
-        'handler': handle_location_msg,
+        'handler': deduplicated(ingest.LOCATION, deferred(ingest.LOCATION, handle_location_msg, location_ack),
+                                location_ack),
     },
     0x2d: {
         'type': 'status',
@@ -814,12 +794,12 @@ message_dispatcher = {
     0x34: {
         'type': 'call record',
         'parser': parse_teemo_packet,
-        'handler': handle_call_record_db,
+        'handler': deferred(ingest.CALL_RECORDS, handle_call_record_db, call_record_ack),
     },
     0x39: {
         'type': 'sms message',
         'parser': parse_teemo_packet,
-        'handler': handle_sms_record_db,
+        'handler': deferred(ingest.SMS, handle_sms_record_db, sms_ack),
     },
     0x7b: {
         'type': 'general',
@@ -830,7 +810,7 @@ message_dispatcher = {
     0x7a: {
         'type': 'chat',
         'parser': parse_chat_message_packet,
-        'handler': handle_chat_message_db,
+        'handler': deduplicated(ingest.CHAT, deferred(ingest.CHAT, handle_chat_message_db, chat_ack), chat_ack),
     }
 }
 
@@ -863,81 +843,78 @@ general_dispatcher = {
 }
 
 
+def new_frame_decoder() -> FrameDecoder:
+    """为一个连接创建分帧器，已知类型的上限取 TCP_MAX_FRAME_SIZES 或 TCP_DEFAULT_MAX_FRAME_SIZE"""
+    max_sizes = {msg_type: MAX_FRAME_SIZES.get(msg_type, DEFAULT_MAX_FRAME_SIZE) for msg_type in message_dispatcher}
+    return FrameDecoder(max_sizes, UNKNOWN_MAX_FRAME_SIZE, MAX_GARBAGE_BYTES, budget=BUFFER_BUDGET)
+
+
 async def handle_client(reader, writer):
     """异步处理每个客户端连接"""
     addr = writer.get_extra_info('peername')
-    logger.debug(f"\n[+] 接受来自 {addr[0]}:{addr[1]} 的新加密连接")
+    logger.debug("[+] 接受来自 %s:%s 的新加密连接", addr[0], addr[1])
 
     # 在这个连接的生命周期内，保存设备实例
     device_instance = None
-    buffer = b''  # 初始化一个空的接收缓冲区
+    session = ConnectionSession()
+    decoder = new_frame_decoder()
     error_packet = create_teemo_response_packet(0x00, {"status": 0, "msg": "Unknown Error."})
 
     try:
         while True:
             chunk = await reader.read(4096)
             if not chunk:
-                logger.debug(f"[-] 来自 {addr} 的连接已关闭 (EOF)。")
+                logger.debug("[-] 来自 %s 的连接已关闭 (EOF)。", addr)
                 break
 
-            buffer += chunk
-            logger.debug(f"[*] 收到 {len(chunk)} 字节数据，当前缓冲区大小: {len(buffer)}")
-
-            while True:
-                # 检查是否足够解析出长度头
-                if len(buffer) < 3:
-                    # 数据不够，跳出内层循环，等待下一次 read
-                    break
-
-                # 3 字节长度 (大端序)
-                # 这个长度是 (版本+类型+payload) 的长度
-                declared_body_length = struct.unpack('>i', b'\x00' + buffer[:3])[0]
-                # 整个数据包的长度 = 3字节长度字段 + declared_body_length
-                total_packet_length = 3 + declared_body_length
-
-                # 检查缓冲区数据是否足够一个完整的包
-                if len(buffer) < total_packet_length:
-                    # 数据不够一个完整的包，跳出内层循环，等待下一次 read
-                    logger.info(f"[*] 数据包不完整：需要 {total_packet_length} 字节，当前只有 {len(buffer)} 字节。等待更多数据...")
-                    break
-
-                packet_data = buffer[:total_packet_length]
-                buffer = buffer[total_packet_length:]
-                logger.debug(f"[*] 从缓冲区中提取了一个完整的包，长度为 {total_packet_length}。剩余缓冲区大小: {len(buffer)}")
-
-                timestamp_data = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                logger.debug(f"\n--- 正在处理TCP包于: {timestamp_data} ---")
-                logger.debug(f"  原始数据: {packet_data}")
-                logger.debug(f"  原始十六进制: {packet_data.hex()}")
-
-                length, version, msg_type = struct.unpack('>i', b'\x00' + packet_data[:3])[0], packet_data[3], \
-                                            packet_data[4]
-                logger.debug(f"[*] 解析TCP包: 声明长度=0x{length:02x}, 版本=0x{version:02x}, 类型=0x{msg_type:02x}")
+            discarded = decoder.discarded
+            try:
+                frames = decoder.feed(chunk)
+            finally:
+                if decoder.discarded != discarded:
+                    DISCARDED_BYTES.inc(decoder.discarded - discarded)
+            BUFFER_BYTES.observe(decoder.buffered)
+            logger.debug("[*] 收到 %d 字节数据，当前缓冲区大小: %d", len(chunk), decoder.buffered)
+
+            for packet_data in frames:
+                total_packet_length = len(packet_data)
+                length, version, msg_type = total_packet_length - 3, packet_data[3], packet_data[4]
+                logger.debug("[*] 解析TCP包: 声明长度=0x%02x, 版本=0x%02x, 类型=0x%02x", length, version, msg_type)
+                if packet_trace.sample():
+                    # 十六进制转储只在命中采样时才计算
+                    packet_logger.debug("[*] 原始数据 from %s 类型=0x%02x: %s", addr, msg_type, packet_data.hex())
 
                 dispatcher = message_dispatcher.get(msg_type, {})
+                msg_type_label = MSG_TYPE_LABELS[msg_type]
+                FRAMES.inc(msg_type=msg_type_label, type=dispatcher.get('type', 'unknown'))
+                FRAME_BYTES.inc(total_packet_length, msg_type=msg_type_label)
+                # 帧已经从缓冲区中取出，无法处理时跳过即可，不影响后续的帧
                 if 'type' not in dispatcher or 'parser' not in dispatcher or 'handler' not in dispatcher:
-                    logger.error(f"[!] 未知消息类型: {msg_type}")
-                    break
+                    logger.warning("[!] 未知消息类型: 0x%02x，已跳过 %d 字节", msg_type, total_packet_length)
+                    continue
 
-                logger.debug(f"[*] 收到 {msg_type:2x}: {dispatcher['type']} 消息")
+                logger.debug("[*] 收到 %2x: %s 消息", msg_type, dispatcher['type'])
                 parser = dispatcher['parser']
                 handler = dispatcher['handler']
                 if not callable(parser) or not callable(handler):
-                    logger.error(f"[!] parser or handler 类型错误")
-                    break
+                    logger.error("[!] 0x%02x 的 parser or handler 类型错误，已跳过", msg_type)
+                    continue
 
-                json_payload, byte_payload = parser(packet_data)
-                response_packet = await handler(device_instance, json_payload, binary_payload=byte_payload, msg_type=msg_type)
+                with HANDLER_SECONDS.time(msg_type=msg_type_label):
+                    json_payload, byte_payload = parser(packet_data)
+                    response_packet = await handler(device_instance, json_payload, binary_payload=byte_payload,
+                                                    msg_type=msg_type, session=session)
 
                 if 0x14 == msg_type and isinstance(response_packet, tuple) and 2 == len(response_packet):
                     instance, response_packet = response_packet
                     if instance and response_packet:
                         device_instance = instance
                         CLIENTS[device_instance.udid] = writer  # 注册
-                        logger.info(f"[*] 设备 {device_instance.udid} 已注册到 TCP 服务器。当前连接数: {len(CLIENTS)}")
+                        logger.info("[*] 设备 %s 已注册到 TCP 服务器。当前连接数: %d", device_instance.udid, len(CLIENTS))
 
                 if response_packet:
-                    logger.debug(f"[*] 响应包:{response_packet[5:]}")
+                    if packet_trace.sample():
+                        packet_logger.debug("[*] 响应包: %r", response_packet[5:])
                     writer.write(response_packet)
                 else:
                     logger.error("[*] 空响应包")
@@ -945,13 +922,17 @@ async def handle_client(reader, writer):
                 await writer.drain()
                 logger.debug("[*] 响应包已发送。")
 
+    except FrameError as e:
+        FRAMING_ERRORS.inc()
+        logger.warning("[!] 来自 %s 的数据无法分帧，关闭连接: %s", addr, e)
     except Exception as e:
-        logger.error(f"[!] 处理来自 {addr} 的连接时发生错误: {e}")
+        logger.error("[!] 处理来自 %s 的连接时发生错误: %s", addr, e)
     finally:
+        decoder.close()
         if device_instance and device_instance.udid in CLIENTS:
             del CLIENTS[device_instance.udid]  # 注销
-            logger.info(f"[*] 设备 {device_instance.udid} 已从 TCP 服务器注销。当前连接数: {len(CLIENTS)}")
-        logger.info(f"[*] 关闭与 {addr} 的连接。")
+            logger.info("[*] 设备 %s 已从 TCP 服务器注销。当前连接数: %d", device_instance.udid, len(CLIENTS))
+        logger.info("[*] 关闭与 %s 的连接。", addr)
         writer.close()
 
 
@@ -979,6 +960,24 @@ class Command(BaseCommand):
         # 启动 Redis 监听器作为后台任务
         asyncio.create_task(redis_listener())
 
+        global ingest_sink
+        if JOURNAL_DIR and STREAMS_URL:
+            self.stderr.write(self.style.ERROR("[!] INGEST_JOURNAL_DIR 和 INGEST_STREAMS_URL 只能配置一个"))
+            return
+        if JOURNAL_DIR:
+            ingest_sink = Journal(JOURNAL_DIR,
+                                  segment_bytes=getattr(settings, 'INGEST_JOURNAL_SEGMENT_BYTES', 64 * 1024 * 1024),
+                                  fsync_interval=getattr(settings, 'INGEST_JOURNAL_FSYNC_INTERVAL', 0.005),
+                                  fsync_batch=getattr(settings, 'INGEST_JOURNAL_FSYNC_BATCH', 256))
+            ingest_sink.open()
+            self.stdout.write(self.style.SUCCESS(f'[*] 写前日志已启用: {JOURNAL_DIR}，请同时运行 apply_journal'))
+        elif STREAMS_URL:
+            ingest_sink = StreamPublisher(STREAMS_URL, maxlen=getattr(settings, 'INGEST_STREAMS_MAXLEN', None))
+            self.stdout.write(self.style.SUCCESS('[*] Redis Streams 入库已启用，请同时运行 run_ingest_workers'))
+
+        if METRICS_PORT:
+            await start_metrics_server(METRICS_HOST, METRICS_PORT)
+
         async with server:
             await server.serve_forever()
 
@@ -0,0 +1,204 @@
+"""
+TCP 服务器的轻量级指标采集，输出 Prometheus 文本格式 (text/plain; version=0.0.4)。
+
+不依赖 prometheus_client。所有指标只在 asyncio 事件循环线程中更新，
+一次更新就是一次字典查找加一次加法，可以在生产环境常开。
+
+用法::
+
+    FRAMES.inc(msg_type='0x14', type='login')
+    with HANDLER_SECONDS.time(msg_type='0x14'):
+        ...
+    await start_metrics_server('127.0.0.1', 9464)
+"""
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def collect(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type_name)]
+        lines.extend(self.collect())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), value)
+                for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """数值型指标。可以直接 set()，也可以用 set_function() 在抓取时计算。"""
+    type_name = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._function = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def collect(self):
+        if self._function is not None:
+            return ['%s %s' % (self.name, self._function())]
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), value)
+                for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [每个桶的计数 (不累计) ..., +Inf 桶计数, sum]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        lines = []
+        for key, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, key, [('le', bound)]),
+                                                 cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+            lines.append('%s_sum%s %s' % (self.name, labels, state[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# --- TCP 服务器指标 ---
+FRAMES = Counter('teemo_frames_total', '收到的 TCP 帧数量', ('msg_type', 'type'))
+FRAME_BYTES = Counter('teemo_frame_bytes_total', '收到的 TCP 帧字节数', ('msg_type',))
+GENERAL_MESSAGES = Counter('teemo_general_messages_total', '0x7b 通用消息按子类型计数', ('sub_type', 'type'))
+HANDLER_SECONDS = Histogram('teemo_handler_seconds', '消息处理耗时 (含数据库)', ('msg_type',))
+DB_WAIT_SECONDS = Histogram('teemo_db_wait_seconds', '等待数据库线程完成的耗时', ('handler',))
+GROUP_COMMIT_OPS = Histogram('teemo_group_commit_ops', '每次组提交包含的写操作数',
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+CONNECTED_CLIENTS = Gauge('teemo_connected_clients', '当前已登录注册的设备连接数')
+BUFFER_BYTES = Histogram('teemo_connection_buffer_bytes', '每次读取后连接接收缓冲区的大小', buckets=SIZE_BUCKETS)
+BUFFER_BUDGET_BYTES = Gauge('teemo_buffer_budget_used_bytes', '所有连接接收缓冲区占用的总字节数')
+DISCARDED_BYTES = Counter('teemo_discarded_bytes_total', '重新同步帧头时丢弃的无效字节数')
+FRAMING_ERRORS = Counter('teemo_framing_errors_total', '因数据无法分帧或超出内存预算而关闭的连接数')
+DUPLICATE_MESSAGES = Counter('teemo_duplicate_messages_total', '手表重传、没有再次写入的消息数', ('kind', 'source'))
+REDIS_LISTENER_LAG_SECONDS = Histogram('teemo_redis_listener_lag_seconds',
+                                       'Redis 通知从发布到被 TCP 服务器处理的延迟')
+
+# --- 入库 worker 指标 (run_ingest_workers) ---
+INGEST_STREAM_LAG = Gauge('teemo_ingest_stream_lag', '消费组尚未读取的消息数', ('stream',))
+INGEST_STREAM_PENDING = Gauge('teemo_ingest_stream_pending', '已读取但尚未确认的消息数', ('stream',))
+INGEST_RECORDS = Counter('teemo_ingest_records_total', '写入数据库的记录数', ('kind',))
+INGEST_BATCH_SECONDS = Histogram('teemo_ingest_batch_seconds', '一批记录写入数据库的耗时', ('kind',))
+
+# --- 只读副本 (replica_heartbeat) ---
+REPLICA_LAG_SECONDS = Gauge('teemo_replica_lag_seconds', '只读副本落后主库的时间', ('alias',))
+
+
+async def _handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # 读掉剩余的请求头
+        while True:
+            line = await reader.readline()
+            if not line or line in (b'\r\n', b'\n'):
+                break
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = b'200 OK', REGISTRY.render().encode('utf-8')
+        else:
+            status, body = b'404 Not Found', b'not found\n'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\n'
+                     b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                     b'Connection: close\r\n\r\n' + body)
+        await writer.drain()
+    except Exception as e:
+        logger.error("[!] 处理指标请求时出错: %s", e)
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int):
+    """在本地端口上以 Prometheus 文本格式暴露 /metrics"""
+    server = await asyncio.start_server(_handle_metrics_request, host, port)
+    logger.info("[*] 指标服务已启动: http://%s:%s/metrics", host, port)
+    return server
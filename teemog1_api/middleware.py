@@ -0,0 +1,140 @@
+"""
+HTTP 中间件。
+
+RequestTraceMiddleware: 请求跟踪。默认不启用：只有 'teemog1_api.http' logger 为 DEBUG 且 HTTP_TRACE_SAMPLE_RATE > 0 时才会加载，
+否则 Django 启动时即移除该中间件，请求路径上没有任何额外开销。
+命中采样的请求记录为一条结构化日志 (JSON)，请求体和响应体按 HTTP_TRACE_MAX_BODY 截断，
+序列化在日志后台线程中完成 (见 log.AsyncQueueHandler)。
+
+ReplicaRoutingMiddleware: 后台和导出的只读请求使用只读副本，见 replicas.py。没有配置 REPLICA_DATABASES 时同样被移除。
+"""
+import json
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from teemog1_api import replicas
+from teemog1_api.log import PacketTraceSampler
+
+logger = logging.getLogger('teemog1_api.http')
+
+# 只记录这些类型的请求体/响应体，其余 (文件上传、图片等) 只记录长度
+TEXT_CONTENT_TYPES = ('application/json', 'application/x-www-form-urlencoded', 'text/')
+
+
+class _JsonMessage:
+    """日志参数包装，str() 时才序列化"""
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, ensure_ascii=False, default=str)
+
+
+def _truncate(content: bytes, content_type: str, limit: int):
+    if not content_type.startswith(TEXT_CONTENT_TYPES):
+        return '<%d bytes %s>' % (len(content), content_type or 'unknown')
+    text = content[:limit].decode('utf-8', errors='replace')
+    if len(content) > limit:
+        text += '...<%d bytes>' % len(content)
+    return text
+
+
+class RequestTraceMiddleware:
+    # 同时支持同步和异步，ASGI 下不会让异步视图退化为在线程中执行
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.max_body = getattr(settings, 'HTTP_TRACE_MAX_BODY', 2048)
+        self.sampler = PacketTraceSampler(logger, getattr(settings, 'HTTP_TRACE_SAMPLE_RATE', 0.0))
+        if not self.sampler.enabled():
+            raise MiddlewareNotUsed
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampler.sample():
+            return self.get_response(request)
+        body = self._request_body(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._log(request, body, response, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampler.sample():
+            return await self.get_response(request)
+        body = self._request_body(request)
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._log(request, body, response, time.perf_counter() - start)
+        return response
+
+    def _request_body(self, request) -> str:
+        # 在视图之前读取请求体 (超过限制的不读取，避免把大文件读入内存)
+        content_type = request.content_type or ''
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        if length and length <= self.max_body:
+            return _truncate(request.body, content_type, self.max_body)
+        return '<%d bytes %s>' % (length, content_type or 'unknown') if length else ''
+
+    def _log(self, request, body, response, elapsed):
+        trace = {
+            'method': request.method,
+            'path': request.path,
+            'query': request.GET.dict(),
+            'remote_addr': request.META.get('REMOTE_ADDR'),
+            'request_body': body,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 2),
+        }
+        if not response.streaming:
+            trace['response_body'] = _truncate(response.content, response.get('Content-Type', ''), self.max_body)
+        logger.debug("[http] %s", _JsonMessage(trace))
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefixes = tuple(getattr(settings, 'REPLICA_PATH_PREFIXES', ('/admin/',)))
+        self.pin_seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+        if not replicas.replica_aliases():
+            raise MiddlewareNotUsed
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _allowed(self, request) -> bool:
+        # 客户端在刚写入之后的一段时间内只读主库
+        return (request.method in ('GET', 'HEAD') and request.path.startswith(self.prefixes)
+                and replicas.REPLICA_PIN_COOKIE not in request.COOKIES)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with replicas.replica_reads(self._allowed(request)) as state:
+            response = self.get_response(request)
+        return self._finish(state, response)
+
+    async def __acall__(self, request):
+        with replicas.replica_reads(self._allowed(request)) as state:
+            response = await self.get_response(request)
+        return self._finish(state, response)
+
+    def _finish(self, state, response):
+        if state['pinned']:
+            response.set_cookie(replicas.REPLICA_PIN_COOKIE, '1', max_age=self.pin_seconds, httponly=True, samesite='Lax')
+        elif state['used']:
+            lag = replicas.lag_monitor.lags().get(state['used'])
+            response['X-Replica-Lag'] = '%s=%.1fs' % (state['used'], lag or 0.0)
+        return response
@@ -1,7 +1,8 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 import uuid
-import json
+
+from teemog1_api.phone_index import normalize_phone
 
 
 class WatchDevice(models.Model):
@@ -20,7 +21,7 @@ class WatchDevice(models.Model):
 
     # 激活和会话信息
     baby_id = models.BigIntegerField(unique=True, help_text="手表用户的唯一ID")
-    http_token = models.UUIDField(default=uuid.uuid4, editable=False, help_text="用于HTTP API认证的Token")
+    http_token = models.UUIDField(default=uuid.uuid4, editable=False, db_index=True, help_text="用于HTTP API认证的Token")
     # 手表是否已经绑定， True: 绑定, False: 未绑定
     is_bound = models.BooleanField(default=False)
     # 手表是否已经停用， True: 停用, False: 正常
@@ -44,11 +45,32 @@ class WatchDevice(models.Model):
     def __str__(self):
         return self.nick or f"Device {self.udid} (Baby ID: {self.baby_id})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录读出时的 token，token 被修改时旧 token 的认证缓存也要删除 (见 signals.py)
+        instance._loaded_http_token = instance.__dict__.get('http_token')
+        return instance
+
+
+class DeviceShard(models.Model):
+    """设备的定位和聊天数据所在的分片 (见 sharding.py)，保存在写库中"""
+    device = models.OneToOneField(WatchDevice, on_delete=models.CASCADE, related_name='shard')
+    alias = models.CharField(max_length=64, help_text="分片的数据库别名")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.device_id} -> {self.alias}"
+
 
+# LocationPackage、LocationData 和 ChatLog 可能位于分片中，与 User/WatchDevice 不在同一个数据库，
+# 所以外键不建数据库约束 (db_constraint=False)，删除设备或用户时由 signals.py 清理各分片中的数据
 class LocationPackage(models.Model):
     # 与 Django 内置用户关联，一个用户可以有多个设备
-    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='location_packages')
-    device = models.ForeignKey(WatchDevice, on_delete=models.SET_NULL, null=True, related_name='location_packages')
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                             related_name='location_packages')
+    device = models.ForeignKey(WatchDevice, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                               related_name='location_packages')
     # 定位信息
     msg_id = models.CharField(max_length=50, help_text="手表端生成的数据包ID")
     strategy = models.IntegerField(default=0, blank=True, null=True, help_text="定位策略")
@@ -61,10 +83,23 @@ class LocationPackage(models.Model):
     class Meta:
         # 按接收时间倒序排列
         ordering = ['-received_at']
+        constraints = [
+            # 手表没收到 ACK 时会重传同一个数据包，见 ingest.apply_location
+            models.UniqueConstraint(fields=['device', 'msg_id'], condition=~models.Q(msg_id=''),
+                                    name='unique_device_location_msg_id'),
+        ]
 
 
 class LocationData(models.Model):
+    class Source(models.TextChoices):
+        GPS = 'gps', 'GPS'
+        WIFI = 'wifi', 'Wi-Fi'
+        CELL = 'cell', '基站'
+
     package = models.ForeignKey(LocationPackage, on_delete=models.CASCADE, related_name='data_points')
+    # 冗余保存所属设备，按设备+时间查询时不需要关联 LocationPackage (旧数据见 backfill_locations 命令)
+    device = models.ForeignKey(WatchDevice, on_delete=models.DO_NOTHING, null=True, blank=True, db_constraint=False,
+                               related_name='location_data')
     # 数据点信息
     stamp = models.BigIntegerField(help_text="数据点的时间戳 (秒)")
     power = models.IntegerField(null=True, blank=True, help_text="电量")
@@ -88,6 +123,12 @@ class LocationData(models.Model):
     geo_decrypted = models.TextField(blank=True, help_text="解密后的geo数据 (JSON格式)")
     valid_wifis = models.TextField(blank=True, help_text="有效的Wi-Fi信息 (JSON格式)")
 
+    # 入库时从 geo_decrypted 中解析出的位置，无法解析时为空 (旧数据见 backfill_geo 命令)
+    lat = models.FloatField(null=True, blank=True, help_text="纬度")
+    lon = models.FloatField(null=True, blank=True, help_text="经度")
+    accuracy = models.FloatField(null=True, blank=True, help_text="定位精度 (米)")
+    source = models.CharField(max_length=8, choices=Source.choices, blank=True, default='', help_text="定位方式")
+
     # 自动记录时间
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -99,6 +140,12 @@ class LocationData(models.Model):
 
     class Meta:
         ordering = ['stamp']
+        indexes = [
+            models.Index(fields=['device', 'stamp']),
+            models.Index(fields=['stamp']),
+            # 按经纬度范围查询
+            models.Index(fields=['lat', 'lon']),
+        ]
 
 
 class Contact(models.Model):
@@ -111,8 +158,9 @@ class Contact(models.Model):
     name = models.CharField(max_length=50, help_text="姓名")
     phone = models.CharField(max_length=30, help_text="主电话号码")
 
-    # 使用 TextField 存储 JSON 格式的额外号码列表，更灵活
-    ext = models.TextField(null=True, blank=True, help_text='额外电话号码 (JSON list)')
+    # 旧版以 JSON 字符串存储的额外号码，已由 ContactPhone (related_name='ext_phones') 取代
+    # 存量数据使用 `python manage.py migrate_contact_ext` 迁移，迁移后置空
+    ext = models.TextField(null=True, blank=True, help_text='旧版额外电话号码 (JSON list)，已迁移到 ContactPhone')
 
     # --- 分类与权限 ---
     class ContactType(models.IntegerChoices):
@@ -152,17 +200,41 @@ class Contact(models.Model):
     profile = models.TextField(null=True, blank=True, help_text="家人分组的Profile信息 (JSON)")
     created_at = models.DateTimeField(auto_now_add=True)
 
-    # 辅助方法，用于处理 ext 字段的存取
+    # 辅助方法，用于处理额外号码的存取
+    # 额外号码在 save() 时写入 ContactPhone 表
     def set_ext_phones(self, phones: list):
-        self.ext = json.dumps(phones)
+        self._pending_ext_phones = [str(phone) for phone in phones if phone not in (None, '')]
 
     def get_ext_phones(self) -> list:
-        if not self.ext:
-            return []
-        try:
-            return json.loads(self.ext)
-        except json.JSONDecodeError:
+        """
+        返回额外号码列表。批量读取时应使用 prefetch_related('ext_phones')，否则每个联系人会多一次查询。
+        """
+        if hasattr(self, '_pending_ext_phones'):
+            return list(self._pending_ext_phones)
+        if self.pk is None:
             return []
+        return [ext_phone.phone for ext_phone in self.ext_phones.all()]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录读出时的联系人类型，类型改变时新旧两个列表的版本号都要更新 (见 signals.py)
+        instance._loaded_contacts_type = instance.__dict__.get('contacts_type')
+        return instance
+
+    def save(self, *args, **kwargs):
+        pending = self.__dict__.pop('_pending_ext_phones', None)
+        if pending is None:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.ext_phones.all().delete()
+            ContactPhone.objects.bulk_create([
+                ContactPhone(contact=self, phone=phone, normalized=normalize_phone(phone), position=position)
+                for position, phone in enumerate(pending)
+            ])
+        # 预取缓存已过期
+        getattr(self, '_prefetched_objects_cache', {}).pop('ext_phones', None)
 
     def __str__(self):
         return f"{self.name} ({self.phone}) on Device {self.device.udid}"
@@ -173,6 +245,20 @@ class Contact(models.Model):
         ordering = ['spell', 'name']  # 默认按拼音和姓名排序
 
 
+class ContactPhone(models.Model):
+    """联系人的额外电话号码，每个号码一行，可以按号码查询"""
+    contact = models.ForeignKey(Contact, on_delete=models.CASCADE, related_name='ext_phones', help_text="所属联系人")
+    phone = models.CharField(max_length=30, help_text="电话号码 (原样保存)")
+    normalized = models.CharField(max_length=30, db_index=True, help_text="规范化后的号码，用于匹配")
+    position = models.PositiveSmallIntegerField(default=0, help_text="在额外号码列表中的顺序")
+
+    def __str__(self):
+        return self.phone
+
+    class Meta:
+        ordering = ['position']
+
+
 class CallRecord(models.Model):
     # 关联到哪个设备
     device = models.ForeignKey(WatchDevice, on_delete=models.CASCADE, related_name='call_records')
@@ -219,7 +305,8 @@ class ChatLog(models.Model):
         EMOJI = 4, '表情'
         VIDEO = 6, '视频'
 
-    device = models.ForeignKey(WatchDevice, on_delete=models.CASCADE, related_name='chat_logs', verbose_name="关联设备")
+    device = models.ForeignKey(WatchDevice, on_delete=models.DO_NOTHING, db_constraint=False, related_name='chat_logs',
+                               verbose_name="关联设备")
     message_id = models.CharField(max_length=100, unique=True, db_index=True, verbose_name="消息ID")
     chat_type = models.IntegerField(verbose_name="聊天类型")
     content_type = models.IntegerField(choices=ContentType.choices, verbose_name="内容类型")
@@ -237,6 +324,10 @@ class ChatLog(models.Model):
         verbose_name = "聊天记录"
         verbose_name_plural = verbose_name
         ordering = ['-stamp']
+        indexes = [
+            models.Index(fields=['device', 'stamp']),
+            models.Index(fields=['stamp']),
+        ]
 
     def __str__(self):
         return f"Chat from {self.from_user_id} to {self.to_id} ({self.get_content_type_display()})"
@@ -245,6 +336,8 @@ class ChatLog(models.Model):
 class SmsMessage(models.Model):
     """短信记录"""
     device = models.ForeignKey(WatchDevice, on_delete=models.CASCADE, related_name='sms_logs', verbose_name="关联设备")
+    # 关联到哪个联系人（如果能匹配到的话）
+    contact = models.ForeignKey(Contact, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="关联联系人")
     message = models.TextField(blank=True, null=True, verbose_name="文本内容")
     phone = models.CharField(max_length=30, help_text="电话号码")
     error_cause = models.CharField(max_length=16, verbose_name="错误码")
@@ -256,5 +349,62 @@ class SmsMessage(models.Model):
         ordering = ['-stamp']
 
     def __str__(self):
-        return f"{self.phone}：{self.message[:10]}"
+        return f"{self.phone}：{(self.message or '')[:10]}"
+
+
+
+class CatalogVersion(models.Model):
+    """静态目录接口 (主题、表盘、表情包等) 的内容版本，只在内容摘要变化时更新，见 catalog.py"""
+    name = models.CharField(max_length=64, unique=True, verbose_name="目录名称")
+    digest = models.CharField(max_length=64, verbose_name="内容摘要")
+    version = models.BigIntegerField(verbose_name="版本号")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "目录版本"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+
+class ResourceVersion(models.Model):
+    """设备各类资源 (联系人列表等) 的版本号，登录时作为 *_ver 下发，见 resource_versions.py"""
+    device = models.ForeignKey(WatchDevice, on_delete=models.CASCADE, related_name='resource_versions',
+                               verbose_name="关联设备")
+    resource = models.CharField(max_length=32, verbose_name="资源")
+    version = models.BigIntegerField(default=1, verbose_name="版本号")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "资源版本"
+        verbose_name_plural = verbose_name
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'resource'], name='unique_device_resource_version'),
+        ]
+
+    def __str__(self):
+        return f"{self.device_id} {self.resource} v{self.version}"
+
 
+class IngestCheckpoint(models.Model):
+    """写前日志的处理进度，与日志记录的入库结果在同一个事务中更新，见 ingest.py"""
+    name = models.CharField(max_length=64, unique=True, verbose_name="消费者名称")
+    offset = models.BigIntegerField(default=0, verbose_name="下一条记录的偏移量")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "入库检查点"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f"{self.name} @ {self.offset}"
+
+
+class ReplicaHeartbeat(models.Model):
+    """只读副本延迟的心跳 (见 replicas.py)，replica_heartbeat 命令定期在主库更新，副本与主库的差值即为延迟"""
+    stamp = models.FloatField(verbose_name="心跳时间戳 (秒)")
+
+    class Meta:
+        verbose_name = "副本心跳"
+        verbose_name_plural = verbose_name
@@ -0,0 +1,150 @@
+"""
+后台列表页使用的分页器。
+"""
+import heapq
+import itertools
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from teemog1_api.sharding import fan_out
+
+# 估算行数低于该值时仍然使用精确的 COUNT(*)
+ESTIMATE_THRESHOLD = 10000
+
+
+def estimate_row_count(model, using='default'):
+    """
+    从数据库统计信息中估算表的行数，无法估算时返回 None。
+    PostgreSQL 使用 pg_class.reltuples；SQLite 优先使用 ANALYZE 生成的 sqlite_stat1，
+    否则用主键范围近似 (只走索引，不扫表)。
+    """
+    table = model._meta.db_table
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone():
+                cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+                row = cursor.fetchone()
+                if row and row[0]:
+                    return int(row[0].split()[0])
+            pk = connection.ops.quote_name(model._meta.pk.column)
+            cursor.execute("SELECT MAX(%s) - MIN(%s) + 1 FROM %s" % (pk, pk, connection.ops.quote_name(table)))
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] is not None else 0
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    未加筛选条件的大表列表页使用估算的总行数，避免每次翻页都对整张表执行 COUNT(*)。
+    有筛选条件或表较小时仍返回精确值。
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if hasattr(queryset, 'query') and not queryset.query.where:
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class KeysetPaginator:
+    """
+    按 (field, 主键) 倒序的游标分页 (keyset pagination)。
+
+    游标指向上一页的最后一行，格式为 '<field 值>_<主键>'。下一页通过
+    WHERE (field, pk) < (游标) 加 LIMIT 取出，配合 field 上的索引，
+    翻到多深的页面代价都只取决于每页大小，也不需要 COUNT(*)。
+    """
+
+    def __init__(self, queryset, per_page: int, field: str):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.field = field
+
+    @staticmethod
+    def parse_cursor(cursor: str):
+        """解析游标，格式错误时抛出 ValueError"""
+        value, _, pk = cursor.rpartition('_')
+        return int(value), int(pk)
+
+    def make_cursor(self, obj) -> str:
+        return '%s_%s' % (getattr(obj, self.field), obj.pk)
+
+    def page(self, cursor: str = None):
+        """
+        :return: (本页对象列表, 下一页游标)，没有下一页时游标为 None
+        """
+        queryset = self.queryset
+        if cursor:
+            value, pk = self.parse_cursor(cursor)
+            queryset = queryset.filter(Q(**{self.field + '__lt': value}) | Q(**{self.field: value, 'pk__lt': pk}))
+        rows = list(queryset.order_by('-' + self.field, '-pk')[:self.per_page + 1])
+        next_cursor = self.make_cursor(rows[self.per_page - 1]) if len(rows) > self.per_page else None
+        return rows[:self.per_page], next_cursor
+
+
+class ShardedKeysetPaginator:
+    """
+    跨分片的 KeysetPaginator：每个分片按 (field, 主键) 倒序各取一页，归并后取前 per_page 行。
+
+    不同分片的主键会重复，所以游标记录每个分片各自的位置，格式为
+    '<别名>~<field 值>_<主键>' 用 '.' 连接，没有出现在游标中的分片从头开始。
+    """
+
+    def __init__(self, querysets: dict, per_page: int, field: str):
+        self.querysets = querysets
+        self.per_page = per_page
+        self.field = field
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> dict:
+        """解析游标，格式错误时抛出 ValueError"""
+        positions = {}
+        for part in cursor.split('.'):
+            alias, sep, position = part.partition('~')
+            if not sep:
+                raise ValueError(cursor)
+            value, _, pk = position.rpartition('_')
+            positions[alias] = (int(value), int(pk))
+        return positions
+
+    def make_cursor(self, positions: dict) -> str:
+        return '.'.join('%s~%s_%s' % (alias, value, pk) for alias, (value, pk) in sorted(positions.items()))
+
+    def _shard_page(self, alias, position):
+        queryset = self.querysets[alias]
+        if position is not None:
+            value, pk = position
+            queryset = queryset.filter(Q(**{self.field + '__lt': value}) | Q(**{self.field: value, 'pk__lt': pk}))
+        return list(queryset.order_by('-' + self.field, '-pk')[:self.per_page + 1])
+
+    def page(self, cursor: str = None):
+        """
+        :return: (本页对象列表, 下一页游标)，没有下一页时游标为 None
+        """
+        positions = self.parse_cursor(cursor) if cursor else {}
+        if set(positions) - set(self.querysets):
+            raise ValueError(cursor)
+        pages = fan_out(lambda alias: self._shard_page(alias, positions.get(alias)), list(self.querysets))
+
+        key = lambda obj: (getattr(obj, self.field), obj.pk)
+        merged = heapq.merge(*pages.values(), key=key, reverse=True)
+        rows = list(itertools.islice(merged, self.per_page + 1))
+        if len(rows) <= self.per_page:
+            return rows, None
+
+        rows = rows[:self.per_page]
+        for obj in rows:
+            positions[obj._state.db] = key(obj)
+        return rows, self.make_cursor(positions)
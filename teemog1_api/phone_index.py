@@ -0,0 +1,129 @@
+"""
+按设备划分的电话号码索引，用于把来电、通话记录、短信中的号码匹配到联系人。
+
+每个设备的索引是一个 {规范化号码: 联系人主键} 字典，同时包含主号码 phone 和 ext 中的
+额外号码 (ContactPhone)。索引保存在按设备数量限制大小的 LRU 缓存中，
+联系人保存/删除时通过模型信号失效 (见 signals.py)，同时通过 Redis 通知其他进程 (publish_invalidation)。
+通知可能丢失，所以每个设备的索引还带有 TTL；写入时仍需确认匹配到的联系人存在 (见 ingest.py)。
+"""
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_NON_DIGITS = re.compile(r'\D')
+
+# 与 views.notify_add_contact 相同的频道，由 run_tcp_server.redis_listener 处理
+CONTACTS_CHANNEL = 'contacts_notify'
+INVALIDATE_COMMAND = 'invalidate_phone_index'
+_redis_client = None
+
+
+def normalize_phone(phone) -> str:
+    """
+    规范化电话号码：去掉空格、横线、括号等非数字字符，去掉 +86 / 0086 国家码前缀。
+    """
+    if phone is None:
+        return ''
+    digits = _NON_DIGITS.sub('', str(phone))
+    if digits.startswith('0086'):
+        digits = digits[4:]
+    elif digits.startswith('86') and len(digits) == 13:
+        digits = digits[2:]
+    return digits
+
+
+class PhoneIndex:
+    """
+    :param max_devices: 最多缓存多少个设备的索引
+    :param ttl: 每个设备索引的有效期 (秒)
+    """
+
+    def __init__(self, max_devices: int = 1024, ttl: float = 300):
+        self.max_devices = max_devices
+        self.ttl = ttl
+        self._entries = OrderedDict()  # device_id -> (过期时间, {号码: 联系人主键})
+        self._lock = threading.Lock()
+        # 每次失效都加一，建立索引期间发生过失效则不缓存这次的结果
+        self._generation = 0
+
+    def _build(self, device_id) -> dict:
+        from teemog1_api.models import Contact, ContactPhone
+
+        index = {}
+        # 主号码优先于额外号码，同一号码按联系人默认排序取第一个
+        for contact_id, phone in Contact.objects.filter(device_id=device_id).values_list('pk', 'phone'):
+            index.setdefault(normalize_phone(phone), contact_id)
+        ext_phones = ContactPhone.objects.filter(contact__device_id=device_id) \
+            .order_by('contact__spell', 'contact__name', 'position').values_list('contact_id', 'normalized')
+        for contact_id, normalized in ext_phones:
+            index.setdefault(normalized, contact_id)
+        index.pop('', None)
+        return index
+
+    def get(self, device_id) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(device_id)
+                return entry[1]
+            generation = self._generation
+
+        index = self._build(device_id)
+        with self._lock:
+            if generation != self._generation:
+                return index
+            self._entries[device_id] = (now + self.ttl, index)
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > self.max_devices:
+                self._entries.popitem(last=False)
+        return index
+
+    def lookup(self, device_id, phone):
+        """返回号码对应的联系人主键，找不到返回 None"""
+        return self.get(device_id).get(normalize_phone(phone))
+
+    def lookup_many(self, device_id, phones) -> dict:
+        """批量匹配，返回 {原始号码: 联系人主键}，只包含匹配到的号码"""
+        index = self.get(device_id)
+        result = {}
+        for phone in phones:
+            contact_id = index.get(normalize_phone(phone))
+            if contact_id is not None:
+                result[phone] = contact_id
+        return result
+
+    def invalidate(self, device_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+def publish_invalidation(device_id):
+    """通知其他进程让该设备的号码索引失效，Redis 不可用时只记录日志"""
+    global _redis_client
+    try:
+        if _redis_client is None:
+            _redis_client = redis.Redis.from_url(
+                getattr(settings, 'PHONE_INDEX_REDIS_URL', 'redis://localhost:6379/0'),
+                socket_connect_timeout=1, socket_timeout=1)
+        _redis_client.publish(CONTACTS_CHANNEL, json.dumps(
+            {'command': INVALIDATE_COMMAND, 'device_id': device_id, 'ts': time.time()}))
+    except redis.RedisError as e:
+        logger.error("[!] 发布号码索引失效通知失败: %s", e)
+
+
+phone_index = PhoneIndex(getattr(settings, 'PHONE_INDEX_MAX_DEVICES', 1024), getattr(settings, 'PHONE_INDEX_TTL', 300))
@@ -0,0 +1,118 @@
+"""
+后台和导出请求的只读副本路由。
+
+配置了 REPLICA_DATABASES 时，ReplicaRoutingMiddleware 让 REPLICA_PATH_PREFIXES 下的 GET/HEAD 请求
+在事务外的读取使用副本 (由 routers.ReadWriteRouter 调用 read_alias())，后台翻页、导出等大查询
+不再与 TCP 服务器的写入争用主库。
+
+* 请求中一旦发生写入 (router.db_for_write)，该请求之后的读取都回到主库，响应中设置 REPLICA_PIN_COOKIE，
+  同一客户端在 REPLICA_PIN_SECONDS 秒内的请求也只读主库，保证保存后跳转的页面能看到刚写入的数据；
+* 副本延迟通过 ReplicaHeartbeat 测量：replica_heartbeat 命令定期在主库更新心跳并输出
+  teemo_replica_lag_seconds 指标；每个进程每 REPLICA_LAG_CHECK_INTERVAL 秒比较一次主库和副本中的心跳，
+  延迟超过 REPLICA_MAX_LAG 或无法测量 (没有心跳) 的副本不使用。使用了副本的响应带有 X-Replica-Lag 头。
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+REPLICA_PIN_COOKIE = 'db_pin'
+
+# 当前请求的路由状态: {'replica': 是否允许读副本, 'pinned': 是否已发生写入, 'used': 使用过的副本}
+_state = contextvars.ContextVar('replica_state', default=None)
+
+
+def replica_aliases() -> list:
+    return list(getattr(settings, 'REPLICA_DATABASES', None) or [])
+
+
+@contextmanager
+def replica_reads(allowed: bool = True):
+    """在该范围内 (包括其中 sync_to_async 的线程) 允许事务外的读取使用副本"""
+    state = {'replica': allowed, 'pinned': False, 'used': None}
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+def pin_primary():
+    """本请求发生了写入，之后的读取使用主库"""
+    state = _state.get()
+    if state is not None:
+        state['pinned'] = True
+
+
+def read_alias():
+    """当前上下文可以使用的副本，不允许或没有健康的副本时返回 None"""
+    state = _state.get()
+    if state is None or not state['replica'] or state['pinned']:
+        return None
+    if state['used'] is None:
+        # 同一个请求始终使用同一个副本，翻页和计数看到的是同一份数据
+        healthy = lag_monitor.healthy()
+        state['used'] = random.choice(healthy) if healthy else ''
+    return state['used'] or None
+
+
+class LagMonitor:
+    """每个进程缓存各副本的延迟 (秒)，无法测量时为 None"""
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self._lags = {}
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def measure(self) -> dict:
+        from teemog1_api.models import ReplicaHeartbeat
+
+        def beat(alias):
+            return ReplicaHeartbeat.objects.using(alias).filter(pk=1).values_list('stamp', flat=True).first()
+
+        primary = beat(getattr(settings, 'WRITE_DATABASE', 'default'))
+        lags = {}
+        for alias in replica_aliases():
+            try:
+                replica = beat(alias)
+            except DatabaseError as e:
+                logger.warning("[!] 无法读取副本 %s 的心跳: %s", alias, e)
+                lags[alias] = None
+                continue
+            if primary is None or replica is None:
+                # 没有运行 replica_heartbeat (或心跳还没有复制到副本)，无法测量，不使用该副本
+                lags[alias] = None
+            else:
+                lags[alias] = max(0.0, primary - replica)
+        return lags
+
+    def lags(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at >= self.interval:
+                self._checked_at = now
+                try:
+                    self._lags = self.measure()
+                except DatabaseError as e:
+                    logger.warning("[!] 无法测量副本延迟: %s", e)
+            return dict(self._lags)
+
+    def healthy(self) -> list:
+        max_lag = getattr(settings, 'REPLICA_MAX_LAG', 10)
+        return [alias for alias, lag in self.lags().items() if lag is not None and lag <= max_lag]
+
+    def reset(self):
+        with self._lock:
+            self._lags = {}
+            self._checked_at = float('-inf')
+
+
+lag_monitor = LagMonitor(interval=getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5))
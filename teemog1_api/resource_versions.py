@@ -0,0 +1,83 @@
+"""
+设备资源版本号登记表。
+
+手表登录时服务器下发 contact_ptt_ver 等 *_ver 字段，手表发现版本号比本地的大时才重新拉取对应资源。
+按设备区分的资源 (联系人列表等) 的版本号保存在 ResourceVersion 表中，由模型信号在资源变化时递增
+(见 signals.py)；没有记录的资源版本号为 1，与以前写死的值一致。
+主题、表盘、表情包对所有设备相同，版本号来自 catalog.py。
+
+每个设备的版本号整体缓存在 RESOURCE_VERSION_CACHE 中，登录时只读一次缓存。
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+
+from teemog1_api.models import Contact, ResourceVersion, WatchDevice
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VERSION = 1
+
+CONTACT_PTT = 'contact_ptt_ver'
+FAMILY_PTT = 'family_ptt_ver'
+FRIEND_PTT = 'friend_ptt_ver'
+COVER = 'cover_ver'
+
+DEVICE_RESOURCES = (CONTACT_PTT, FAMILY_PTT, FRIEND_PTT, COVER)
+
+# 联系人类型 -> 对应列表的资源
+CONTACT_RESOURCES = {
+    Contact.ContactType.NORMAL: CONTACT_PTT,
+    Contact.ContactType.FAMILY: FAMILY_PTT,
+    Contact.ContactType.FRIEND: FRIEND_PTT,
+}
+
+
+def _cache():
+    return caches[getattr(settings, 'RESOURCE_VERSION_CACHE', 'default')]
+
+
+def _cache_key(device_id) -> str:
+    return 'resource_versions:%s' % device_id
+
+
+def get_versions(device_id) -> dict:
+    """返回 {资源: 版本号}，包含 DEVICE_RESOURCES 中的所有资源"""
+    try:
+        versions = _cache().get(_cache_key(device_id))
+    except Exception as e:
+        logger.warning("[!] 读取资源版本缓存失败: %s", e)
+        versions = None
+    if versions is not None:
+        return versions
+
+    versions = dict.fromkeys(DEVICE_RESOURCES, DEFAULT_VERSION)
+    versions.update(ResourceVersion.objects.filter(device_id=device_id).values_list('resource', 'version'))
+    try:
+        _cache().set(_cache_key(device_id), versions, getattr(settings, 'RESOURCE_VERSION_CACHE_TTL', 3600))
+    except Exception as e:
+        logger.warning("[!] 写入资源版本缓存失败: %s", e)
+    return versions
+
+
+def bump(device_id, *resources):
+    """递增设备若干资源的版本号，设备已被删除时不做任何事"""
+    resources = set(resources)
+    with transaction.atomic():
+        existing = set(ResourceVersion.objects.filter(device_id=device_id, resource__in=resources)
+                       .values_list('resource', flat=True))
+        if existing:
+            ResourceVersion.objects.filter(device_id=device_id, resource__in=existing) \
+                .update(version=F('version') + 1)
+        if resources - existing and not WatchDevice.objects.filter(pk=device_id).exists():
+            return
+        ResourceVersion.objects.bulk_create(
+            [ResourceVersion(device_id=device_id, resource=resource, version=DEFAULT_VERSION + 1)
+             for resource in resources - existing], ignore_conflicts=True)
+    try:
+        _cache().delete(_cache_key(device_id))
+    except Exception as e:
+        logger.warning("[!] 删除资源版本缓存失败: %s", e)
@@ -0,0 +1,75 @@
+"""
+数据库路由。
+
+ShardRouter: LocationPackage、LocationData 和 ChatLog 的实例按所属设备路由到分片 (见 sharding.py)，
+不分片时不处理。没有实例的查询无法确定设备，需要显式 using() 或 sharding.shard_queryset()。
+
+ReadWriteRouter: 写入以及事务中的读取使用写库 (WRITE_DATABASE)，其余读取使用只读连接 (READ_DATABASE)。
+两者是同一个 SQLite 文件 (WAL 模式)，读连接看到的总是已提交的最新数据；事务中的读取必须留在写连接上，
+否则看不到本事务尚未提交的写入。后台和导出请求中的读取可以使用只读副本 (见 replicas.py)。
+"""
+from django.conf import settings
+from django.db import connections
+
+from teemog1_api import replicas
+from teemog1_api.sharding import shard_aliases, is_sharded, shard_map
+
+
+class ShardRouter:
+
+    def _db_for_instance(self, model, instance):
+        if instance is None or not is_sharded(model) or len(shard_aliases()) == 1:
+            return None
+        if is_sharded(type(instance)):
+            # 已经从某个分片读出的实例留在该分片 (迁移设备时旧分片中的数据也能正常删除)
+            if instance._state.db in shard_aliases():
+                return instance._state.db
+            device_id = instance.device_id
+        elif instance._meta.label == 'teemog1_api.WatchDevice':
+            # device.chat_logs 等反向关联
+            device_id = instance.pk
+        else:
+            return None
+        return shard_map.alias_for(device_id) if device_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_instance(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        replicas.pin_primary()
+        return self._db_for_instance(model, hints.get('instance'))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name is None or app_label != 'teemog1_api' or len(shard_aliases()) == 1:
+            return None
+        from django.apps import apps
+        if is_sharded(apps.get_model(app_label, model_name)):
+            return db in shard_aliases()
+        return None
+
+
+class ReadWriteRouter:
+
+    def __init__(self):
+        self.write_db = getattr(settings, 'WRITE_DATABASE', 'default')
+        self.read_db = getattr(settings, 'READ_DATABASE', self.write_db)
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        # 从分片中读出的实例关联的其他模型 (例如 LocationData.device) 不在分片中，仍按读写分离路由
+        if instance is not None and instance._state.db in (self.write_db, self.read_db, *replicas.replica_aliases()):
+            return instance._state.db
+        if connections[self.write_db].in_atomic_block:
+            return self.write_db
+        return replicas.read_alias() or self.read_db
+
+    def db_for_write(self, model, **hints):
+        replicas.pin_primary()
+        return self.write_db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 读库、副本和写库是同一份数据
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == self.write_db
@@ -0,0 +1,126 @@
+"""
+按设备水平分片 LocationPackage、LocationData 和 ChatLog。
+
+分片是 settings.SHARD_DATABASES 中的数据库别名，只有一个时不分片 (所有函数退化为普通查询)。
+设备第一次写入时按 crc32(udid) 选择分片并记录到 DeviceShard (位于写库)，之后一直使用该分片，
+增加分片只影响新设备，已有设备由 rebalance_shards 命令迁移。设备 -> 分片 的映射在进程内缓存
+SHARD_MAP_TTL 秒，rebalance_shards 切换分片后会等待缓存过期再删除原分片中的数据。
+
+* 写入：save() 由 routers.ShardRouter 根据 instance.device_id 选择分片；bulk_create 需要
+  显式 using(shard_map.alias_for(device))；
+* 按设备查询：shard_queryset(model, device)；
+* 跨分片查询 (后台列表页)：fan_out() 在每个分片上并行执行同一个查询，
+  paginators.ShardedKeysetPaginator 归并各分片的结果。
+
+分片与写库不在同一个事务中，写入分片的操作不受外层 transaction.atomic() 保护。
+"""
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+# 分片保存的模型 (model._meta.model_name)
+SHARDED_MODELS = frozenset({'locationpackage', 'locationdata', 'chatlog'})
+
+
+def shard_aliases() -> list:
+    return list(getattr(settings, 'SHARD_DATABASES', None) or [getattr(settings, 'WRITE_DATABASE', 'default')])
+
+
+def sharding_enabled() -> bool:
+    return len(shard_aliases()) > 1
+
+
+def is_sharded(model) -> bool:
+    return model._meta.app_label == 'teemog1_api' and model._meta.model_name in SHARDED_MODELS
+
+
+def hash_alias(udid: str, aliases: list = None) -> str:
+    """新设备的分片: crc32(udid) 对分片数取模"""
+    aliases = aliases or shard_aliases()
+    return aliases[zlib.crc32(udid.encode('utf-8')) % len(aliases)]
+
+
+class ShardMap:
+    """设备主键 -> 分片别名，带 TTL 的进程内缓存"""
+
+    def __init__(self, ttl: float = 30):
+        self.ttl = ttl
+        self._entries = {}  # device_id -> (过期时间, 别名)
+        self._lock = threading.Lock()
+
+    def alias_for(self, device) -> str:
+        """device 为 WatchDevice 或其主键"""
+        aliases = shard_aliases()
+        if len(aliases) == 1:
+            return aliases[0]
+        device_id = getattr(device, 'pk', device)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(device_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        alias = self._load(device, device_id, aliases)
+        with self._lock:
+            self._entries[device_id] = (now + self.ttl, alias)
+        return alias
+
+    def _load(self, device, device_id, aliases: list) -> str:
+        from teemog1_api.models import DeviceShard, WatchDevice
+
+        alias = DeviceShard.objects.filter(device_id=device_id).values_list('alias', flat=True).first()
+        if alias is None:
+            if not isinstance(device, WatchDevice):
+                device = WatchDevice.objects.get(pk=device_id)
+            alias = DeviceShard.objects.get_or_create(device_id=device_id,
+                                                      defaults={'alias': hash_alias(device.udid, aliases)})[0].alias
+        return alias
+
+    def invalidate(self, device_id=None):
+        with self._lock:
+            if device_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(device_id, None)
+
+
+shard_map = ShardMap(ttl=getattr(settings, 'SHARD_MAP_TTL', 30))
+
+
+def shard_queryset(model, device):
+    """某个设备在 model 中的数据，位于该设备所在的分片"""
+    queryset = model.objects.filter(device=device)
+    if sharding_enabled():
+        queryset = queryset.using(shard_map.alias_for(device))
+    return queryset
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _run_in_worker(func, alias):
+    try:
+        return func(alias)
+    finally:
+        # 线程池中的线程不经过请求周期，自行关闭过期的连接
+        close_old_connections()
+
+
+def fan_out(func, aliases: list = None) -> dict:
+    """在每个分片上执行 func(alias)，返回 {alias: 结果}。SHARD_FANOUT_WORKERS 为 0 时依次执行"""
+    global _executor
+    aliases = aliases or shard_aliases()
+    workers = getattr(settings, 'SHARD_FANOUT_WORKERS', 8)
+    if workers <= 0 or len(aliases) == 1:
+        return {alias: func(alias) for alias in aliases}
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard-fanout')
+    futures = {alias: _executor.submit(_run_in_worker, func, alias) for alias in aliases}
+    return {alias: future.result() for alias, future in futures.items()}
+
@@ -0,0 +1,78 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from teemog1_api.models import Contact, WatchDevice, LocationPackage, LocationData, ChatLog
+from teemog1_api import resource_versions
+from teemog1_api.authentication import forget_device_tokens
+from teemog1_api.phone_index import phone_index, publish_invalidation
+from teemog1_api.sharding import shard_aliases, shard_map
+
+
+@receiver([post_save, post_delete], sender=Contact)
+def invalidate_phone_index(sender, instance, **kwargs):
+    """
+    联系人变化时让该设备的号码索引失效，并通知其他进程。额外号码在同一事务中写入，所以等事务提交后再失效
+    """
+    device_id = instance.device_id
+
+    def invalidate():
+        phone_index.invalidate(device_id)
+        publish_invalidation(device_id)
+
+    transaction.on_commit(invalidate)
+
+
+@receiver([post_save, post_delete], sender=Contact)
+def bump_contact_list_version(sender, instance, origin=None, **kwargs):
+    """联系人变化时递增所在列表 (类型改变时包括原来的列表) 的版本号，手表下次登录时重新拉取"""
+    if isinstance(origin, WatchDevice):
+        # 随设备一起删除，没有需要更新的版本号
+        return
+    types = {instance.contacts_type, getattr(instance, '_loaded_contacts_type', None)}
+    resources = [resource_versions.CONTACT_RESOURCES[t] for t in types if t in resource_versions.CONTACT_RESOURCES]
+    instance._loaded_contacts_type = instance.contacts_type
+    device_id = instance.device_id
+    transaction.on_commit(lambda: resource_versions.bump(device_id, *resources))
+
+
+# 认证缓存中的设备只保证这些字段是最新的
+DEVICE_IDENTITY_FIELDS = {'udid', 'baby_id', 'http_token'}
+
+
+@receiver(post_save, sender=WatchDevice)
+def forget_changed_device_token(sender, instance, update_fields=None, **kwargs):
+    """身份字段可能被修改时删除新旧 token 的认证缓存，只更新状态字段的保存 (ping、状态上报) 不影响缓存"""
+    if update_fields is not None and not DEVICE_IDENTITY_FIELDS.intersection(update_fields):
+        return
+    tokens = [instance.http_token, getattr(instance, '_loaded_http_token', None)]
+    instance._loaded_http_token = instance.http_token
+    transaction.on_commit(lambda: forget_device_tokens(*tokens))
+
+
+@receiver(post_delete, sender=WatchDevice)
+def forget_deleted_device_token(sender, instance, **kwargs):
+    tokens = [instance.http_token, getattr(instance, '_loaded_http_token', None)]
+    transaction.on_commit(lambda: forget_device_tokens(*tokens))
+
+
+@receiver(pre_delete, sender=WatchDevice)
+def delete_device_shard_data(sender, instance, **kwargs):
+    """
+    删除设备时清理各分片中的数据 (外键为 DO_NOTHING，见 models.py)，与原来的 SET_NULL / CASCADE 一致：
+    保留定位历史 (数据包及其定位点) 但解除与设备的关联，删除聊天记录。还没有回填 device 的旧定位点
+    本来就没有关联，结果相同。迁移中的设备可能在两个分片中都有数据，所以每个分片都要清理。
+    写库可能正处于删除设备的事务中，在其他线程中写入会等待写锁，所以依次执行而不是 fan_out
+    """
+    for alias in shard_aliases():
+        LocationData.objects.using(alias).filter(device_id=instance.pk).update(device=None)
+        LocationPackage.objects.using(alias).filter(device_id=instance.pk).update(device=None)
+        ChatLog.objects.using(alias).filter(device_id=instance.pk).delete()
+    shard_map.invalidate(instance.pk)
+
+
+@receiver(pre_delete, sender=User)
+def detach_user_location_packages(sender, instance, **kwargs):
+    for alias in shard_aliases():
+        LocationPackage.objects.using(alias).filter(user_id=instance.pk).update(user=None)
@@ -0,0 +1,82 @@
+"""
+TCP 入库的 Redis Streams 通道。
+
+配置了 INGEST_STREAMS_URL 时，TCP 服务器把定位、聊天、通话记录和短信作为记录 (见 ingest.make_record)
+XADD 到按类型划分的 stream 中后立即回复 ACK；run_ingest_workers 命令以消费组 INGEST_STREAMS_GROUP
+读取并批量入库，入库成功后才 XACK。TCP 服务器随连接数扩展，入库进程随数据库能力扩展。
+
+消息在 XADD 返回后才算送达，持久性取决于 Redis 的 AOF/RDB 配置。
+"""
+import json
+import logging
+
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from teemog1_api import ingest
+
+logger = logging.getLogger(__name__)
+
+STREAM_PREFIX = 'teemo:ingest:'
+KINDS = (ingest.LOCATION, ingest.CHAT, ingest.CALL_RECORDS, ingest.SMS)
+
+
+def stream_name(kind: str) -> str:
+    return STREAM_PREFIX + kind
+
+
+def stream_kind(stream: str) -> str:
+    return stream[len(STREAM_PREFIX):]
+
+
+def encode(record: dict) -> dict:
+    return {'record': json.dumps(record, ensure_ascii=False, separators=(',', ':'))}
+
+
+def decode(fields: dict) -> dict:
+    return json.loads(fields['record'])
+
+
+class StreamPublisher:
+    """TCP 服务器一侧的发布者，与 journal.Journal 一样提供 append(record)"""
+
+    def __init__(self, url: str, maxlen: int = None):
+        self.client = redis.from_url(url)
+        self.maxlen = maxlen
+
+    async def append(self, record: dict):
+        # maxlen 为近似裁剪，只用来防止入库进程长时间停止时 Redis 内存无限增长
+        return await self.client.xadd(stream_name(record['kind']), encode(record),
+                                      maxlen=self.maxlen, approximate=True)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+async def ensure_groups(client, group: str):
+    """为每个 stream 创建消费组 (stream 不存在时一并创建)"""
+    for kind in KINDS:
+        try:
+            await client.xgroup_create(stream_name(kind), group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+
+async def group_lag(client, group: str) -> dict:
+    """每个 stream 的 {stream: (尚未投递的条数, 已投递未确认的条数)}，Redis 7 以下没有 lag 时为 None"""
+    result = {}
+    for kind in KINDS:
+        name = stream_name(kind)
+        try:
+            groups = await client.xinfo_groups(name)
+        except ResponseError:
+            continue
+        for info in groups:
+            if _text(info.get('name')) == group:
+                result[name] = (info.get('lag'), info.get('pending', 0))
+    return result
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,44 @@
+"""
+TCP 连接的会话状态。
+
+handle_client 为每个连接创建一个 ConnectionSession，作为 session 参数传给处理函数。
+手表没收到 ACK 时会重传同一条消息 (相同的 id)，会话中记录最近处理过的消息 id，
+重传的消息直接回复 ACK，不再访问数据库；换了连接之后的重传由数据库唯一约束兜底。
+"""
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class RecentIds:
+    """最近处理过的消息 id，最多保留 maxlen 个，超出时淘汰最久未出现的"""
+
+    def __init__(self, maxlen: int = 256):
+        self.maxlen = maxlen
+        self._ids = OrderedDict()
+
+    def __contains__(self, message_id) -> bool:
+        if message_id in self._ids:
+            self._ids.move_to_end(message_id)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, message_id):
+        self._ids[message_id] = None
+        self._ids.move_to_end(message_id)
+        if len(self._ids) > self.maxlen:
+            self._ids.popitem(last=False)
+
+
+class ConnectionSession:
+    """一个 TCP 连接的状态，只在该连接的协程中访问"""
+
+    def __init__(self):
+        # 记录类型 (ingest.LOCATION 等) -> 最近 ACK 过的消息 id
+        self.recent = {
+            'location': RecentIds(getattr(settings, 'TCP_RECENT_LOCATION_IDS', 256)),
+            'chat': RecentIds(getattr(settings, 'TCP_RECENT_CHAT_IDS', 256)),
+        }
@@ -1,3 +1,1276 @@
-from django.test import TestCase
+"""
+后台列表页查询数测试，以及协议与持久化热点路径的基准测试。
 
-# Create your tests here.
+基准测试默认跳过，设置 TEEMO_BENCH=1 才运行::
+
+    TEEMO_BENCH=1 python manage.py test teemog1_api --tag benchmark
+    # 保存当前结果作为基线
+    TEEMO_BENCH=1 TEEMO_BENCH_SAVE=1 python manage.py test teemog1_api --tag benchmark
+
+结果追加到 TEEMO_BENCH_REPORT (默认 bench_output.txt)。存在基线文件时，每个基准的中位耗时
+超过 基线 * TEEMO_BENCH_TOLERANCE 即判定为性能回退。
+测试使用进程内 SQLite 测试数据库，处理函数直接调用其同步实现 (绕过 database_sync_to_async)。
+"""
+import asyncio
+import atexit
+import base64
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import statistics
+import threading
+import tempfile
+import time
+import uuid
+import zlib
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from redis.exceptions import ResponseError
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, tag, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from teemog1_api.NativeUtils import NativeUtils
+from teemog1_api import catalog, resource_versions
+from teemog1_api.models import (WatchDevice, Contact, ContactPhone, CallRecord, LocationPackage, LocationData, ChatLog,
+                                SmsMessage, CatalogVersion, IngestCheckpoint, DeviceShard, ReplicaHeartbeat,
+                                ResourceVersion)
+from teemog1_api.phone_index import PhoneIndex, normalize_phone, phone_index
+from teemog1_api.management.commands.run_tcp_server import (
+    parse_teemo_packet, parse_teemo_zlib_packet, parse_chat_message_packet, create_teemo_response_packet,
+    handle_location_msg, handle_contact_request_db, handle_call_record_db, handle_login_request_db,
+    update_device_status_db, deduplicated,
+)
+from teemog1_api.authentication import get_device_by_token
+from teemog1_api.middleware import RequestTraceMiddleware, ReplicaRoutingMiddleware
+from teemog1_api.framing import BufferBudget, FrameDecoder, FrameError
+from teemog1_api import ingest
+from teemog1_api.journal import DEAD_LETTER_FILE, Journal, list_segments, read_records
+from teemog1_api.group_commit import GroupCommitter
+from teemog1_api.log import AsyncQueueHandler, PacketTraceSampler
+from teemog1_api.metrics import Counter, Histogram, Registry, start_metrics_server
+from teemog1_api.routers import ReadWriteRouter, ShardRouter
+from teemog1_api.paginators import ShardedKeysetPaginator
+from teemog1_api.sharding import hash_alias, shard_map
+from teemog1_api import replicas
+from teemog1_api.tcp_session import ConnectionSession, RecentIds
+from teemog1_api.management.commands.replay_load import build_chat_frame, build_zlib_frame
+from teemog1_api.management.commands import run_ingest_workers
+from teemog1_api import streams
+
+BENCH_ENABLED = os.environ.get('TEEMO_BENCH') == '1'
+BENCH_SKIP_REASON = '基准测试需要设置 TEEMO_BENCH=1'
+BENCH_REPORT = Path(os.environ.get('TEEMO_BENCH_REPORT', Path(settings.BASE_DIR) / 'bench_output.txt'))
+BENCH_BASELINE = Path(os.environ.get('TEEMO_BENCH_BASELINE', Path(settings.BASE_DIR) / 'bench_baseline.json'))
+BENCH_SAVE = os.environ.get('TEEMO_BENCH_SAVE') == '1'
+BENCH_TOLERANCE = float(os.environ.get('TEEMO_BENCH_TOLERANCE', '1.5'))
+
+
+# --- 合成的手表数据 ---
+def make_device(index: int = 0) -> WatchDevice:
+    return WatchDevice.objects.create(udid='benchdevice%013d' % index, baby_id=1000000 + index,
+                                      imei='86%013d' % index, mac='02:00:00:00:%02x:%02x' % divmod(index, 256))
+
+
+def make_contacts(device: WatchDevice, count: int):
+    contacts = Contact.objects.bulk_create([
+        Contact(device=device, user_id=device.baby_id * 10000 + i, name='联系人%d' % i,
+                phone='138%08d' % i, contacts_type=(i % 3) + 1, spell='LXR%d' % i)
+        for i in range(count)
+    ])
+    ContactPhone.objects.bulk_create([
+        ContactPhone(contact=contact, phone='139%08d' % i, normalized='139%08d' % i)
+        for i, contact in enumerate(contacts)
+    ])
+
+
+def location_payload(points: int) -> dict:
+    geo = base64.encodebytes(NativeUtils.encrypt(json.dumps({'lat': 39.9, 'lon': 116.4, 'accuracy': 30}), 5))
+    return {
+        'id': uuid.uuid4().hex,
+        'strategy': 1,
+        'data': [{'stamp': 1700000000 + i, 'power': 80, 'signal': 3, 'sos': 0, 'reply_loc': 0,
+                  'geo': geo.decode('ascii'), 'valid_wifi': {'id': [1, 2]}} for i in range(points)],
+    }
+
+
+def call_records_payload(start_id: int, count: int) -> dict:
+    return {
+        'id': start_id,
+        'recents': [{'id': start_id + i, 'phone': '138%08d' % (i % 50), 'name': '联系人%d' % i, 'in': i % 4,
+                     'stamp': 1700000000 + i, 'time': 30, 'is_read': 1, 'geo_data': None}
+                    for i in range(count)],
+    }
+
+
+def bench_report(line: str):
+    """基准结果追加到 BENCH_REPORT，不混入测试输出"""
+    with open(BENCH_REPORT, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+
+
+class BenchmarkMixin:
+    rounds = 20
+    _baseline = None
+    _results = {}
+
+    @classmethod
+    def baseline(cls) -> dict:
+        if BenchmarkMixin._baseline is None:
+            BenchmarkMixin._baseline = json.loads(BENCH_BASELINE.read_text()) if BENCH_BASELINE.exists() else {}
+        return BenchmarkMixin._baseline
+
+    def bench(self, name: str, func, rounds: int = None, setup=None):
+        """多次执行 func，记录中位耗时，并与基线比较"""
+        timings = []
+        for _ in range(rounds or self.rounds):
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start)
+        median = statistics.median(timings)
+        BenchmarkMixin._results[name] = median
+        bench_report('[bench] %-40s median %.3f ms' % (name, median * 1000))
+
+        expected = self.baseline().get(name)
+        if expected and not BENCH_SAVE:
+            self.assertLessEqual(median, expected * BENCH_TOLERANCE,
+                                 '%s 性能回退: %.3f ms, 基线 %.3f ms' % (name, median * 1000, expected * 1000))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if BENCH_SAVE and BenchmarkMixin._results:
+            baseline = dict(cls.baseline())
+            baseline.update(BenchmarkMixin._results)
+            BENCH_BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+
+
+@tag('benchmark')
+@skipUnless(BENCH_ENABLED, BENCH_SKIP_REASON)
+class ProtocolBenchmarks(BenchmarkMixin, TestCase):
+    rounds = 2000
+
+    def test_parse_teemo_packet(self):
+        frame = create_teemo_response_packet(0x0b, location_payload(10))
+        self.bench('parse_teemo_packet', lambda: parse_teemo_packet(frame))
+
+    def test_parse_teemo_zlib_packet(self):
+        frame = build_zlib_frame(0x7d, location_payload(10))
+        self.bench('parse_teemo_zlib_packet', lambda: parse_teemo_zlib_packet(frame))
+
+    def test_parse_chat_message_packet(self):
+        frame = build_chat_frame({'id': 'm1', 'chat_type': 1, 'content_type': 1, 'from_user_id': 1, 'to_id': 2,
+                                  'stamp': 1700000000000, 'content': {'voice_length': 3}}, b'\x00' * 4096)
+        self.bench('parse_chat_message_packet', lambda: parse_chat_message_packet(frame))
+
+    def test_create_teemo_response_packet(self):
+        payload = {'status': 1, 'msg': '', 'id': uuid.uuid4().hex}
+        self.bench('create_teemo_response_packet', lambda: create_teemo_response_packet(0x0b, payload))
+
+    def test_native_decrypt(self):
+        cipher = NativeUtils.encrypt(json.dumps({'lat': 39.9, 'lon': 116.4, 'accuracy': 30}), 5)
+        self.bench('NativeUtils.decrypt', lambda: NativeUtils.decrypt(cipher, 5))
+
+    def test_native_sign_dict_md5(self):
+        params = {'user': 'test_user', 'action': 'login', 'time': 1678886400, 'app_version': '2.1.0'}
+        self.bench('NativeUtils.sign_dict_MD5', lambda: NativeUtils.sign_dict_MD5(params, 'suffix', 2))
+
+
+@tag('benchmark')
+@skipUnless(BENCH_ENABLED, BENCH_SKIP_REASON)
+class PersistenceBenchmarks(BenchmarkMixin, TestCase):
+
+    def setUp(self):
+        # 测试之间会回滚数据库，主键可能被复用
+        phone_index.clear()
+        self.device = make_device()
+
+    def test_handle_location_msg(self):
+        for points in (1, 10, 100):
+            self.bench('handle_location_msg[%d]' % points, handle_location_msg.__wrapped__,
+                       setup=lambda: (self.device, location_payload(points)))
+        self.assertTrue(LocationData.objects.exists())
+
+    def test_contact_sync(self):
+        for count in (10, 100, 1000):
+            device = make_device(count)
+            make_contacts(device, count)
+            self.bench('handle_contact_request_db[%d]' % count,
+                       lambda: handle_contact_request_db.__wrapped__(device, {'sub_type': 2}))
+
+    def test_handle_call_record_db(self):
+        make_contacts(self.device, 50)
+        next_id = iter(range(1, 10 ** 9, 1000))
+        for count in (1, 10, 100):
+            self.bench('handle_call_record_db[%d]' % count, handle_call_record_db.__wrapped__,
+                       setup=lambda: (self.device, call_records_payload(next(next_id), count)))
+        self.assertTrue(CallRecord.objects.filter(contact__isnull=False).exists())
+
+
+@tag('benchmark')
+@skipUnless(BENCH_ENABLED, BENCH_SKIP_REASON)
+class GroupCommitBenchmarks(BenchmarkMixin, TransactionTestCase):
+    """组提交需要写线程使用自己的连接，数据必须真正提交，所以使用 TransactionTestCase"""
+    databases = {'default', 'reader'}
+    rounds = 5
+    burst = 200
+
+    def setUp(self):
+        self.devices = [make_device(i) for i in range(20)]
+
+    def ping_burst(self):
+        async def run():
+            await asyncio.gather(*(update_device_status_db(self.devices[i % len(self.devices)], {'power': i})
+                                   for i in range(self.burst)))
+        async_to_sync(run)()
+
+    def test_ping_burst(self):
+        for enabled in (False, True):
+            with override_settings(TCP_GROUP_COMMIT=enabled):
+                name = 'update_device_status_db[group_commit=%s]' % ('on' if enabled else 'off')
+                self.bench(name, self.ping_burst)
+                bench_report('[bench] %-40s %.0f ops/s' % (name, self.burst / BenchmarkMixin._results[name]))
+
+
+def sqlite_contention(path: str, pragmas: dict, begin: str, writers: int = 2, readers: int = 4,
+                      duration: float = 1.0) -> dict:
+    """在 SQLite 文件上同时运行写线程和读线程 duration 秒，返回写入数、读取数和 "database is locked" 错误数"""
+    setup = sqlite3.connect(path)
+    for name, value in pragmas.items():
+        setup.execute('PRAGMA %s=%s' % (name, value))
+    setup.execute('CREATE TABLE IF NOT EXISTS t (id INTEGER PRIMARY KEY, device INTEGER, payload TEXT)')
+    setup.commit()
+    setup.close()
+
+    counts = {'writes': 0, 'reads': 0, 'locked': 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def run(is_writer: bool):
+        conn = sqlite3.connect(path, isolation_level=None)
+        for name, value in pragmas.items():
+            conn.execute('PRAGMA %s=%s' % (name, value))
+        done = locked = 0
+        while time.monotonic() < stop:
+            try:
+                if is_writer:
+                    conn.execute(begin)
+                    conn.execute('INSERT INTO t (device, payload) VALUES (?, ?)', (done % 100, 'x' * 200))
+                    conn.execute('COMMIT')
+                else:
+                    conn.execute('SELECT count(*), max(id) FROM t WHERE device = ?', (done % 100,)).fetchall()
+                done += 1
+            except sqlite3.OperationalError:
+                locked += 1
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+        conn.close()
+        with lock:
+            counts['writes' if is_writer else 'reads'] += done
+            counts['locked'] += locked
+
+    threads = [threading.Thread(target=run, args=(i < writers,)) for i in range(writers + readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+@tag('benchmark')
+@skipUnless(BENCH_ENABLED, BENCH_SKIP_REASON)
+class SqliteContentionBenchmarks(SimpleTestCase):
+    """读写并发下默认 SQLite 配置与 settings.SQLITE_PRAGMAS 的对比 (使用临时文件，不经过 Django 连接)"""
+
+    def test_contention(self):
+        configs = {
+            'default': ({}, 'BEGIN'),
+            'tuned': (settings.SQLITE_PRAGMAS, 'BEGIN IMMEDIATE'),
+        }
+        for name, (pragmas, begin) in configs.items():
+            with tempfile.TemporaryDirectory() as directory:
+                result = sqlite_contention(os.path.join(directory, 'bench.sqlite3'), pragmas, begin)
+            bench_report('[bench] sqlite_contention[%-7s] writes %6d  reads %7d  locked %d'
+                         % (name, result['writes'], result['reads'], result['locked']))
+
+
+class SqlitePragmaTests(SimpleTestCase):
+    """测试数据库在内存中，用 default / reader 的配置连接一个临时文件检查连接参数"""
+
+    def connect(self, alias: str, path: str):
+        wrapper = DatabaseWrapper(dict(connections.settings[alias], NAME=path), 'pragma-%s' % alias)
+        self.addCleanup(wrapper.close)
+        return wrapper.cursor()
+
+    def pragma(self, cursor, name: str):
+        return cursor.execute('PRAGMA %s' % name).fetchone()[0]
+
+    def test_connections_apply_pragmas(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'pragma.sqlite3')
+        for alias in ('default', 'reader'):
+            cursor = self.connect(alias, path)
+            self.assertEqual(self.pragma(cursor, 'journal_mode'), 'wal')
+            self.assertEqual(self.pragma(cursor, 'busy_timeout'), settings.SQLITE_PRAGMAS['busy_timeout'])
+            self.assertEqual(self.pragma(cursor, 'synchronous'), 1)  # NORMAL
+        self.assertEqual(self.pragma(self.connect('default', path), 'query_only'), 0)
+        self.assertEqual(self.pragma(self.connect('reader', path), 'query_only'), 1)
+
+
+def make_admin_rows(index: int, count: int):
+    """为后台列表页生成 count 行各类数据"""
+    device = make_device(index)
+    make_contacts(device, count)
+    contact = device.contacts.first()
+    for i in range(count):
+        package = LocationPackage.objects.create(device=device, msg_id='pkg-%d-%d' % (index, i))
+        LocationData.objects.create(package=package, stamp=1700000000 + i)
+        ChatLog.objects.create(device=device, message_id='msg-%d-%d' % (index, i), chat_type=1, content_type=2,
+                               from_user_id=1, to_id=2, stamp=1700000000000 + i, content_text='hi')
+        CallRecord.objects.create(device=device, contact=contact, record_id=index * 10000 + i, phone_number='138',
+                                  call_type=0, stamp=timezone.now())
+        SmsMessage.objects.create(device=device, contact=contact, phone='138', error_cause='0', stamp=timezone.now())
+
+
+class AdminChangelistQueryTests(TestCase):
+    """后台列表页的查询数不应随行数增长 (N+1)"""
+    changelists = ['watchdevice', 'locationpackage', 'locationdata', 'contact', 'callrecord', 'chatlog',
+                   'smsmessage']
+
+    def setUp(self):
+        phone_index.clear()
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def count_queries(self, url) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_query_count_is_constant(self):
+        make_admin_rows(1, 2)
+        baseline = {name: self.count_queries(reverse('admin:teemog1_api_%s_changelist' % name))
+                    for name in self.changelists}
+        make_admin_rows(2, 20)
+        for name in self.changelists:
+            with self.subTest(changelist=name):
+                self.assertEqual(self.count_queries(reverse('admin:teemog1_api_%s_changelist' % name)),
+                                 baseline[name])
+
+    def test_keyset_pagination_walks_all_rows(self):
+        device = make_device()
+        # 相同 stamp 的行靠主键区分先后
+        ChatLog.objects.bulk_create([
+            ChatLog(device=device, message_id='msg-%d' % i, chat_type=1, content_type=2, from_user_id=1, to_id=2,
+                    stamp=1700000000000 + i // 3, content_text='hi')
+            for i in range(250)
+        ])
+        url = reverse('admin:teemog1_api_chatlog_changelist')
+        seen = []
+        while url:
+            cl = self.client.get(url).context['cl']
+            seen.extend(obj.pk for obj in cl.result_list)
+            url = cl.next_page_url and reverse('admin:teemog1_api_chatlog_changelist') + cl.next_page_url
+        self.assertEqual(seen, list(ChatLog.objects.order_by('-stamp', '-pk').values_list('pk', flat=True)))
+        self.assertEqual(self.client.get(reverse('admin:teemog1_api_chatlog_changelist') + '?cursor=bad').status_code,
+                         302)
+
+
+@override_settings(DEVICE_AUTH_CACHE='default')
+class LocationExportTests(TestCase):
+
+    def setUp(self):
+        self.device = make_device()
+        self.token = str(uuid.uuid4())
+        self.device.http_token = self.token
+        self.device.save()
+        package = LocationPackage.objects.create(device=self.device, msg_id='pkg')
+        LocationData.objects.bulk_create([
+            LocationData(package=package, device=self.device, stamp=1700000000 + i, power=80, geo_decrypted='{}')
+            for i in range(5)
+        ])
+        self.url = reverse('export_locations')
+
+    async def export(self, **params) -> list:
+        response = await self.async_client.get(self.url, {'user_id': self.device.baby_id, 'token': self.token,
+                                                          **params})
+        self.assertEqual(response.status_code, 200)
+        return b''.join([chunk async for chunk in response.streaming_content]).decode('utf-8').splitlines()
+
+    async def test_jsonl(self):
+        lines = await self.export(start=1700000001, end=1700000004)
+        self.assertEqual([json.loads(line)['stamp'] for line in lines], [1700000001, 1700000002, 1700000003])
+
+    async def test_csv(self):
+        lines = await self.export(output='csv')
+        self.assertEqual(lines[0], 'stamp,power,signal,sos,reply_loc,geo_decrypted,valid_wifis,lat,lon,accuracy,source')
+        self.assertEqual(len(lines), 6)
+
+    def test_requires_token(self):
+        for token in ('wrong', str(uuid.uuid4())):
+            response = self.client.get(self.url, {'user_id': self.device.baby_id, 'token': token})
+            self.assertEqual(response.status_code, 403)
+
+    def test_staff_without_token(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(self.url, {'user_id': self.device.baby_id}).status_code, 200)
+        self.assertEqual(self.client.get(self.url, {'user_id': 'abc'}).status_code, 403)
+
+
+@override_settings(DEVICE_AUTH_CACHE='default', RESOURCE_VERSION_CACHE='default')
+class DeviceTokenAuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def login(self, device: WatchDevice) -> str:
+        with self.captureOnCommitCallbacks(execute=True):
+            handle_login_request_db.__wrapped__(None, {'udid': device.udid, 'imei': device.imei, 'mac': device.mac})
+        return str(WatchDevice.objects.get(pk=device.pk).http_token)
+
+    def test_token_lookup_is_cached(self):
+        device = make_device()
+        WatchDevice.objects.filter(pk=device.pk).update(http_token=uuid.uuid4())
+        token = str(WatchDevice.objects.get(pk=device.pk).http_token)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_device_by_token(token).pk, device.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_device_by_token(token).pk, device.pk)
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_device_by_token('not-a-uuid'))
+
+    def test_login_rotates_cached_token(self):
+        device = make_device()
+        old_token = self.login(device)
+        new_token = self.login(device)
+        self.assertNotEqual(old_token, new_token)
+        self.assertIsNone(get_device_by_token(old_token))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_device_by_token(new_token).pk, device.pk)
+
+    def test_device_changes_drop_cached_token(self):
+        device = make_device()
+        token = self.login(device)
+        device = WatchDevice.objects.get(pk=device.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            device.last_power = 3
+            device.save(update_fields=['last_power'])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_device_by_token(token).pk, device.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            device.http_token = uuid.uuid4()
+            device.save()
+        self.assertIsNone(get_device_by_token(token))
+
+        token = str(device.http_token)
+        self.assertEqual(get_device_by_token(token).pk, device.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            device.delete()
+        self.assertIsNone(get_device_by_token(token))
+
+    def test_contact_endpoint_uses_token(self):
+        device = make_device()
+        token = self.login(device)
+        url = reverse('delete_contact')
+        response = self.client.post(url, {'token': token, 'user_id': device.baby_id + 1, 'id': 1})
+        self.assertEqual(response.json()['message'], '联系人不存在，操作视为成功')
+        contact = Contact.objects.create(device=device, user_id=1, name='a', phone='1', contacts_type=1)
+        response = self.client.post(url, {'token': token, 'user_id': device.baby_id, 'id': contact.user_id})
+        self.assertEqual(response.json()['message'], '删除成功')
+        self.assertFalse(Contact.objects.filter(pk=contact.pk).exists())
+
+    def test_add_contact_with_json_body(self):
+        device = make_device()
+        token = self.login(device)
+        response = self.client.post(reverse('add_contact'), {'token': token, 'user_id': device.baby_id, 'name': 'b',
+                                                             'phone': '13800000000', 'ext': '["010-1234"]'},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['message'], '添加成功')
+        contact = Contact.objects.get(device=device, user_id=response.json()['data']['id'])
+        self.assertEqual(contact.get_ext_phones(), ['010-1234'])
+        # 与已有联系人的额外号码重复
+        response = self.client.post(reverse('add_contact'), {'token': token, 'user_id': device.baby_id, 'name': 'c',
+                                                             'phone': '0101234'}, content_type='application/json')
+        self.assertEqual(response.json()['message'], '该号码已存在')
+
+
+class PhoneIndexTests(TestCase):
+
+    def setUp(self):
+        phone_index.clear()
+        self.device = make_device()
+        self.contact = Contact(device=self.device, user_id=1, name='a', phone='138 0000 0000', contacts_type=1)
+        self.contact.set_ext_phones(['(010) 1234'])
+        self.contact.save()
+
+    def test_normalize_phone(self):
+        self.assertEqual(normalize_phone('+86 138-0000-0000'), '13800000000')
+        self.assertEqual(normalize_phone('0086 10010'), '10010')
+        self.assertEqual(normalize_phone(None), '')
+
+    def test_lookup_primary_and_ext_phones(self):
+        self.assertEqual(phone_index.lookup(self.device.pk, '+8613800000000'), self.contact.pk)
+        self.assertEqual(phone_index.lookup_many(self.device.pk, ['0101234', '10086']), {'0101234': self.contact.pk})
+        with self.assertNumQueries(0):
+            self.assertIsNone(phone_index.lookup(self.device.pk, '10086'))
+
+    def test_contact_changes_invalidate_and_publish(self):
+        phone_index.get(self.device.pk)
+        with mock.patch('teemog1_api.signals.publish_invalidation') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.contact.delete()
+        publish.assert_called_once_with(self.device.pk)
+        self.assertIsNone(phone_index.lookup(self.device.pk, '13800000000'))
+
+    def test_ttl_and_lru(self):
+        index = PhoneIndex(max_devices=1, ttl=0)
+        index.get(self.device.pk)
+        with self.assertNumQueries(2):
+            index.get(self.device.pk)
+        other = make_device(1)
+        index = PhoneIndex(max_devices=1, ttl=300)
+        index.get(self.device.pk)
+        index.get(other.pk)
+        with self.assertNumQueries(2):
+            index.get(self.device.pk)
+
+    def test_stale_index_entry_is_not_linked(self):
+        phone_index.get(self.device.pk)
+        # 在其他进程中删除：本进程的索引没有失效
+        ContactPhone.objects.filter(contact=self.contact)._raw_delete('default')
+        Contact.objects.filter(pk=self.contact.pk)._raw_delete('default')
+        sms = ingest.apply_sms(self.device, {'phone': '13800000000', 'message': 'x'})
+        self.assertIsNone(sms.contact_id)
+        ingest.apply_call_records(self.device, {'recents': [{'id': 1, 'phone': '0101234', 'stamp': 1}]})
+        self.assertIsNone(CallRecord.objects.get(record_id=1).contact_id)
+
+
+class RequestTraceMiddlewareTests(TestCase):
+
+    def get_response(self, request):
+        return HttpResponse('x' * 100, content_type='application/json')
+
+    @override_settings(HTTP_TRACE_SAMPLE_RATE=1.0, HTTP_TRACE_MAX_BODY=16)
+    def test_traces_when_debug_enabled(self):
+        with self.assertLogs('teemog1_api.http', 'DEBUG') as logs:
+            middleware = RequestTraceMiddleware(self.get_response)
+            middleware(RequestFactory().post('/timo/apps/get.do?a=1', {'token': 't'}, content_type='application/json'))
+        trace = json.loads(logs.records[0].getMessage()[len('[http] '):])
+        self.assertEqual(trace['query'], {'a': '1'})
+        self.assertEqual(trace['request_body'], '{"token": "t"}')
+        self.assertTrue(trace['response_body'].endswith('...<100 bytes>'))
+
+    def test_not_used_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            RequestTraceMiddleware(self.get_response)
+
+
+class CatalogTests(TestCase):
+
+    def setUp(self):
+        catalog.reset()
+
+    def test_version_is_stable_and_etag_revalidates(self):
+        url = reverse('get_theme_info')
+        first = self.client.get(url)
+        catalog.reset()
+        second = self.client.get(url)
+        self.assertEqual(first.json()['data']['version'], second.json()['data']['version'])
+        self.assertEqual(first['ETag'], second['ETag'])
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_version_changes_with_content(self):
+        entry = catalog.CatalogEntry('test', lambda version, items=(): {'items': list(items), 'version': version})
+        CatalogVersion.objects.create(name='test', digest='old', version=1)
+        self.assertGreater(entry.body().version, 1)
+        self.assertEqual(json.loads(entry.body(items=(1,)).body)['items'], [1])
+
+
+@override_settings(DEVICE_AUTH_CACHE='default', RESOURCE_VERSION_CACHE='default')
+class ResourceVersionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        catalog.reset()
+        self.device = make_device()
+
+    def login_versions(self) -> dict:
+        _, packet = handle_login_request_db.__wrapped__(
+            None, {'udid': self.device.udid, 'imei': self.device.imei, 'mac': self.device.mac})
+        return parse_teemo_packet(packet)[0]
+
+    def test_contact_changes_bump_only_their_list(self):
+        payload = self.login_versions()
+        self.assertEqual([payload['contact_ptt_ver'], payload['family_ptt_ver'], payload['friend_ptt_ver']], [1, 1, 1])
+        self.assertEqual(payload['theme_ver'], str(catalog.themes.version()))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            contact = Contact.objects.create(device=self.device, user_id=1, name='a', phone='1',
+                                             contacts_type=Contact.ContactType.FAMILY)
+        payload = self.login_versions()
+        self.assertEqual([payload['contact_ptt_ver'], payload['family_ptt_ver'], payload['friend_ptt_ver']], [1, 2, 1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            contact = Contact.objects.get(pk=contact.pk)
+            contact.contacts_type = Contact.ContactType.FRIEND
+            contact.save()
+        self.assertEqual(resource_versions.get_versions(self.device.pk)[resource_versions.FAMILY_PTT], 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(resource_versions.get_versions(self.device.pk)[resource_versions.FRIEND_PTT], 2)
+
+    @mock.patch('teemog1_api.signals.publish_invalidation')
+    def test_deleting_device_with_contacts_bumps_nothing(self, publish):
+        make_contacts(self.device, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.device.delete()
+        self.assertFalse(ResourceVersion.objects.exists())
+        resource_versions.bump(self.device.pk, resource_versions.FAMILY_PTT)
+        self.assertFalse(ResourceVersion.objects.exists())
+
+
+class FrameDecoderTests(TestCase):
+
+    def decoder(self, budget=None) -> FrameDecoder:
+        return FrameDecoder({0x01: 64, 0x7a: 1024}, unknown_max_size=32, max_garbage=16, budget=budget)
+
+    def test_resyncs_after_garbage_and_skips_unknown(self):
+        ping = create_teemo_response_packet(0x01, {})
+        unknown = create_teemo_response_packet(0x55, {})
+        decoder = self.decoder()
+        frames = decoder.feed(b'\xff\xff\xff\x00' + ping + unknown[:4])
+        self.assertEqual(frames, [ping])
+        self.assertEqual(decoder.discarded, 4)
+        self.assertEqual(decoder.feed(unknown[4:] + ping), [unknown, ping])
+        self.assertEqual(decoder.buffered, 0)
+
+    def test_oversized_frame_is_garbage(self):
+        decoder = self.decoder()
+        with self.assertRaises(FrameError):
+            # 0x01 的上限是 64 字节，声明 1000 字节的帧头不会被等待
+            decoder.feed(b'\x00\x03\xe8\x04\x01' + b'\x00' * 32)
+
+    def test_buffer_budget_is_shared(self):
+        budget = BufferBudget(100)
+        first, second = self.decoder(budget), self.decoder(budget)
+        first.feed(b'\x00\x01\x00\x04\x7a' + b'\x00' * 60)
+        with self.assertRaises(FrameError):
+            second.feed(b'\x00\x01\x00\x04\x7a' + b'\x00' * 60)
+        first.close()
+        self.assertEqual(budget.used, 0)
+        second.feed(b'\x00\x01\x00\x04\x7a' + b'\x00' * 60)
+        self.assertEqual(budget.used, 65)
+
+
+class IngestJournalTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.device = make_device()
+
+    async def write(self, records, segment_bytes=1024):
+        journal = Journal(self.directory, segment_bytes=segment_bytes)
+        journal.open()
+        for record in records:
+            await journal.append(record)
+        await journal.close()
+        return journal.offset
+
+    def test_journal_rolls_segments_and_truncates_torn_tail(self):
+        records = [ingest.make_record(ingest.LOCATION, self.device, location_payload(3)) for _ in range(5)]
+        end = async_to_sync(self.write)(records)
+        self.assertGreater(len(list_segments(self.directory)), 1)
+        entries = read_records(self.directory, 0, 100)
+        self.assertEqual([record for _, record in entries], records)
+        self.assertEqual(entries[-1][0], end)
+
+        # 模拟崩溃时写了一半的记录
+        with open(list_segments(self.directory)[-1][1], 'ab') as f:
+            f.write(b'\x00\x00\x01\x00garbage')
+        self.assertEqual(len(read_records(self.directory, 0, 100)), 5)
+        self.assertEqual(async_to_sync(self.write)([records[0]]) - end, entries[0][0])
+
+    def test_read_records_stops_after_limit(self):
+        records = [ingest.make_record(ingest.LOCATION, self.device, location_payload(1)) for _ in range(20)]
+        async_to_sync(self.write)(records, segment_bytes=1024 * 1024)
+        self.assertEqual(len(list_segments(self.directory)), 1)
+        with mock.patch('teemog1_api.journal.zlib.crc32', wraps=zlib.crc32) as crc32:
+            entries = read_records(self.directory, 0, 2)
+        # 只校验需要的记录，不扫描整个段
+        self.assertEqual(crc32.call_count, 2)
+        self.assertEqual([record for _, record in entries], records[:2])
+        rest = read_records(self.directory, entries[-1][0], 100)
+        self.assertEqual([record for _, record in rest], records[2:])
+
+    def test_database_error_keeps_checkpoint_and_retries(self):
+        end = async_to_sync(self.write)([ingest.make_record(ingest.SMS, self.device, {'phone': '10086', 'message': 'x'})])
+        apply_record = ingest.apply_record
+        calls = []
+
+        def apply(device_instance, record):
+            calls.append(record)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            apply_record(device_instance, record)
+
+        consumer = ingest.JournalConsumer(self.directory)
+        with mock.patch.object(ingest, 'apply_record', apply):
+            with self.assertRaises(OperationalError):
+                consumer.run_once()
+            self.assertFalse(IngestCheckpoint.objects.filter(name='default', offset__gt=0).exists())
+            self.assertEqual(len(list_segments(self.directory)), 1)
+            self.assertEqual(consumer.run_once(), 1)
+        self.assertEqual(SmsMessage.objects.get().phone, '10086')
+        self.assertEqual(IngestCheckpoint.objects.get(name='default').offset, end)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, DEAD_LETTER_FILE)))
+
+    def test_bad_payload_is_dead_lettered(self):
+        end = async_to_sync(self.write)([
+            ingest.make_record(ingest.SMS, self.device, {'phone': '10010', 'message': 'x', 'error_cause': 'bad'}),
+            ingest.make_record(ingest.SMS, self.device, {'phone': '10086', 'message': 'x'}),
+        ])
+        consumer = ingest.JournalConsumer(self.directory)
+        self.assertEqual(consumer.run_once(), 2)
+        self.assertEqual(IngestCheckpoint.objects.get(name='default').offset, end)
+        with open(os.path.join(self.directory, DEAD_LETTER_FILE), encoding='utf-8') as f:
+            self.assertEqual([json.loads(line)['record']['payload']['phone'] for line in f], ['10010'])
+        self.assertEqual(SmsMessage.objects.get().phone, '10086')
+
+    def test_consumer_applies_once_from_checkpoint(self):
+        async_to_sync(self.write)([
+            ingest.make_record(ingest.LOCATION, self.device, location_payload(3)),
+            ingest.make_record(ingest.CHAT, self.device, {'id': 'm1', 'chat_type': 1, 'content_type': 2,
+                                                         'from_user_id': 1, 'to_id': 2, 'stamp': 1,
+                                                         'content': {'text': 'hi'}}),
+            ingest.make_record(ingest.SMS, self.device, {'phone': '10086', 'message': 'x'}),
+        ])
+        consumer = ingest.JournalConsumer(self.directory, batch_size=2)
+        self.assertEqual(consumer.run_once(), 2)
+        self.assertEqual(consumer.run_once(), 1)
+        self.assertEqual(consumer.run_once(), 0)
+        self.assertEqual(LocationData.objects.filter(device=self.device).count(), 3)
+        self.assertEqual(ChatLog.objects.count(), 1)
+        self.assertEqual(SmsMessage.objects.count(), 1)
+        self.assertEqual(IngestCheckpoint.objects.get(name='default').offset,
+                         read_records(self.directory, 0, 100)[-1][0])
+
+
+class JournalDeadLetterTests(TransactionTestCase):
+    databases = {'default', 'reader'}
+
+    def test_record_failing_at_commit_is_dead_lettered(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        device = make_device()
+        apply_record = ingest.apply_record
+
+        def apply(device_instance, record):
+            if record['payload']['phone'] == 'bad':
+                # 外键约束延迟到提交时才检查，保存点中不会出错
+                SmsMessage.objects.create(device=device_instance, contact_id=999999, phone='bad', message='x',
+                                          stamp=timezone.now())
+            else:
+                apply_record(device_instance, record)
+
+        async def write():
+            journal = Journal(directory)
+            journal.open()
+            for phone in ('10086', 'bad', '10010'):
+                await journal.append(ingest.make_record(ingest.SMS, device, {'phone': phone, 'message': 'x'}))
+            await journal.close()
+            return journal.offset
+
+        end = async_to_sync(write)()
+        consumer = ingest.JournalConsumer(directory)
+        with mock.patch.object(ingest, 'apply_record', apply):
+            self.assertEqual(consumer.run_once(), 3)
+        self.assertEqual(sorted(SmsMessage.objects.values_list('phone', flat=True)), ['10010', '10086'])
+        self.assertEqual(IngestCheckpoint.objects.get(name='default').offset, end)
+        self.assertEqual(consumer.run_once(), 0)
+        with open(os.path.join(directory, DEAD_LETTER_FILE), encoding='utf-8') as f:
+            self.assertEqual([json.loads(line)['record']['payload']['phone'] for line in f], ['bad'])
+
+
+class IngestBatchTests(TestCase):
+
+    def setUp(self):
+        self.devices = [make_device(i) for i in range(2)]
+
+    def test_apply_records_bulk_inserts_and_ignores_duplicates(self):
+        locations = [ingest.make_record(ingest.LOCATION, device, location_payload(4)) for device in self.devices]
+        with self.assertNumQueries(6):
+            # 查询设备 + 查询已有的数据包 + 两次 bulk_create，另外两条是测试事务内的 SAVEPOINT / RELEASE
+            self.assertEqual(ingest.apply_records(ingest.LOCATION, locations), (2, {0, 1}))
+        self.assertEqual(LocationData.objects.filter(device=self.devices[1]).count(), 4)
+        self.assertEqual(LocationPackage.objects.filter(device=self.devices[1]).count(), 1)
+
+        # 重传的数据包 (相同的 id) 无论在同一批还是之后的批次中都只保存一次
+        self.assertEqual(ingest.apply_records(ingest.LOCATION, locations + locations[:1]), (0, {0, 1, 2}))
+        self.assertEqual(LocationPackage.objects.filter(device=self.devices[0]).count(), 1)
+        self.assertEqual(LocationData.objects.filter(device=self.devices[0]).count(), 4)
+
+        chat = {'id': 'm1', 'chat_type': 1, 'content_type': 2, 'from_user_id': 1, 'to_id': 2, 'stamp': 1,
+                'content': {'text': 'hi'}}
+        records = [ingest.make_record(ingest.CHAT, self.devices[0], chat)] * 2
+        # 忽略的重复消息不计入写入条数
+        self.assertEqual(ingest.apply_records(ingest.CHAT, records), (1, {0, 1}))
+        self.assertEqual(ingest.apply_records(ingest.CHAT, records), (0, {0, 1}))
+        self.assertEqual(ChatLog.objects.count(), 1)
+
+
+    @mock.patch('teemog1_api.signals.publish_invalidation')
+    def test_deleting_device_keeps_location_history(self, publish):
+        device = self.devices[0]
+        ingest.apply_location(device, location_payload(2))
+        # 还没有回填 device 的旧定位点
+        LocationData.objects.filter(pk=LocationData.objects.filter(device=device).first().pk).update(device=None)
+        ingest.apply_chat(device, {'id': 'm1', 'chat_type': 1, 'content_type': 2, 'from_user_id': 1, 'to_id': 2,
+                                   'stamp': 1, 'content': {'text': 'hi'}})
+        device.delete()
+        self.assertEqual(LocationPackage.objects.filter(device__isnull=True).count(), 1)
+        self.assertEqual(LocationData.objects.filter(device__isnull=True).count(), 2)
+        self.assertFalse(ChatLog.objects.exists())
+
+
+class FakeStreams:
+    """内存中的 Redis Streams，只实现入库用到的命令，未确认的消息立即可以认领"""
+
+    def __init__(self):
+        self.streams = {}  # stream -> [(id, fields)]
+        self.groups = {}  # (stream, group) -> {'delivered': 条数, 'pending': {id: fields}}
+
+    async def xadd(self, name, fields, maxlen=None, approximate=True):
+        entries = self.streams.setdefault(name, [])
+        entry_id = '%d-0' % (len(entries) + 1)
+        entries.append((entry_id, fields))
+        return entry_id
+
+    async def xgroup_create(self, name, group, id='0', mkstream=False):
+        if (name, group) in self.groups:
+            raise ResponseError('BUSYGROUP Consumer Group name already exists')
+        self.streams.setdefault(name, [])
+        self.groups[(name, group)] = {'delivered': 0, 'pending': {}}
+
+    async def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        response = []
+        for name in streams:
+            state = self.groups[(name, group)]
+            entries = self.streams[name][state['delivered']:state['delivered'] + count]
+            state['delivered'] += len(entries)
+            state['pending'].update(entries)
+            if entries:
+                response.append((name, entries))
+        return response
+
+    async def xautoclaim(self, name, group, consumer, min_idle_time, start_id='0-0', count=None):
+        return '0-0', list(self.groups[(name, group)]['pending'].items()), []
+
+    async def xack(self, name, group, *ids):
+        pending = self.groups[(name, group)]['pending']
+        return sum(pending.pop(entry_id, None) is not None for entry_id in ids)
+
+    async def xinfo_groups(self, name):
+        return [{'name': group, 'lag': len(self.streams[stream]) - state['delivered'],
+                 'pending': len(state['pending'])}
+                for (stream, group), state in self.groups.items() if stream == name]
+
+
+class IngestStreamTests(TestCase):
+
+    def setUp(self):
+        self.device = make_device()
+        self.client = FakeStreams()
+        self.command = run_ingest_workers.Command()
+        self.command.options = {'batch_size': 100, 'block_ms': 0, 'claim_idle_ms': 0}
+        self.sms_stream = streams.stream_name(ingest.SMS)
+
+    def publish(self, *phones):
+        publisher = streams.StreamPublisher('redis://localhost:6379/0')
+        publisher.client = self.client
+        for phone in phones:
+            async_to_sync(publisher.append)(ingest.make_record(ingest.SMS, self.device, {'phone': phone, 'message': 'x'}))
+
+    async def read(self):
+        response = await self.client.xreadgroup('writers', 'c1', {self.sms_stream: '>'}, count=100)
+        for name, entries in response:
+            await self.command.apply(self.client, 'writers', name, entries)
+
+    def test_consumer_group_round_trip(self):
+        async_to_sync(streams.ensure_groups)(self.client, 'writers')
+        # 重复创建消费组不报错
+        async_to_sync(streams.ensure_groups)(self.client, 'writers')
+        self.publish('10086', '10010')
+        self.assertEqual(async_to_sync(streams.group_lag)(self.client, 'writers')[self.sms_stream], (2, 0))
+        async_to_sync(self.read)()
+        self.assertEqual(sorted(SmsMessage.objects.values_list('phone', flat=True)), ['10010', '10086'])
+        self.assertEqual(async_to_sync(streams.group_lag)(self.client, 'writers')[self.sms_stream], (0, 0))
+
+    def test_failed_records_stay_pending(self):
+        async_to_sync(streams.ensure_groups)(self.client, 'writers')
+        self.publish('10086', '10010')
+        with mock.patch.object(ingest, '_bulk_apply', side_effect=OperationalError('database is locked')), \
+                mock.patch.object(ingest, 'apply_record', side_effect=OperationalError('database is locked')):
+            async_to_sync(self.read)()
+        self.assertFalse(SmsMessage.objects.exists())
+        self.assertEqual(async_to_sync(streams.group_lag)(self.client, 'writers')[self.sms_stream], (0, 2))
+
+        # 数据库恢复后重新认领，写入后才确认
+        names = [streams.stream_name(kind) for kind in streams.KINDS]
+        async_to_sync(self.command.claim)(self.client, 'writers', 'c2', names)
+        self.assertEqual(SmsMessage.objects.count(), 2)
+        self.assertEqual(async_to_sync(streams.group_lag)(self.client, 'writers')[self.sms_stream], (0, 0))
+
+    def test_consumer_backs_off_on_database_error(self):
+        async_to_sync(streams.ensure_groups)(self.client, 'writers')
+        self.publish('10086')
+
+        class Stop(Exception):
+            pass
+
+        with mock.patch.object(ingest, 'apply_records', side_effect=OperationalError('database is locked')), \
+                mock.patch.object(run_ingest_workers.asyncio, 'sleep', side_effect=Stop) as sleep:
+            with self.assertRaises(Stop):
+                async_to_sync(self.command.consume)(self.client, 'writers', 'c1')
+        sleep.assert_called_once_with(5)
+        self.assertEqual(async_to_sync(streams.group_lag)(self.client, 'writers')[self.sms_stream], (0, 1))
+
+
+class RetransmitTests(TestCase):
+
+    def setUp(self):
+        self.device = make_device(0)
+
+    def test_database_retransmit_is_acked_once_stored(self):
+        payload = location_payload(2)
+        first = handle_location_msg.__wrapped__(self.device, payload)
+        self.assertEqual(handle_location_msg.__wrapped__(self.device, dict(payload)), first)
+        self.assertEqual(LocationPackage.objects.filter(device=self.device).count(), 1)
+        self.assertEqual(LocationData.objects.filter(device=self.device).count(), 2)
+
+    def test_chat_retransmit_is_a_single_insert(self):
+        chat = {'id': 'm1', 'chat_type': 1, 'content_type': 2, 'from_user_id': 1, 'to_id': 2, 'stamp': 1,
+                'content': {'text': 'hi'}}
+        with self.assertNumQueries(3):
+            # INSERT，另外两条是 atomic 的 SAVEPOINT / RELEASE
+            self.assertTrue(ingest.apply_chat(self.device, chat))
+        self.assertFalse(ingest.apply_chat(self.device, chat))
+        self.assertEqual(ChatLog.objects.count(), 1)
+
+    def test_session_retransmit_skips_handler(self):
+        calls = []
+
+        async def handler(device_instance, payload, **kwargs):
+            calls.append(payload.get('id'))
+            return b'ack'
+
+        wrapped = deduplicated(ingest.LOCATION, handler, lambda payload: b'ack again')
+        session = ConnectionSession()
+        self.assertEqual(async_to_sync(wrapped)(self.device, {'id': 'a'}, session=session), b'ack')
+        self.assertEqual(async_to_sync(wrapped)(self.device, {'id': 'a'}, session=session), b'ack again')
+        # 另一个连接 (或没有 id 的消息) 仍然交给 handler
+        async_to_sync(wrapped)(self.device, {'id': 'a'}, session=ConnectionSession())
+        async_to_sync(wrapped)(self.device, {}, session=session)
+        self.assertEqual(calls, ['a', 'a', None])
+
+    def test_recent_ids_evicts_least_recent(self):
+        recent = RecentIds(2)
+        recent.add('a')
+        recent.add('b')
+        self.assertIn('a', recent)
+        recent.add('c')
+        self.assertEqual(len(recent), 2)
+        self.assertNotIn('b', recent)
+        self.assertIn('a', recent)
+
+
+class GeoColumnTests(TestCase):
+
+    def test_parse_geo(self):
+        self.assertEqual(ingest.parse_geo('{"lat": 39.9, "lng": "116.4", "radius": 30, "type": "WIFI"}'),
+                         {'lat': 39.9, 'lon': 116.4, 'accuracy': 30.0, 'source': LocationData.Source.WIFI})
+        self.assertEqual(ingest.parse_geo('{"lat": 39.9, "lon": 116.4}')['source'], '')
+        for decoded in ('', 'not json', '[1, 2]', '{"lat": 95, "lon": 116.4}', '{"lat": 39.9}'):
+            self.assertEqual(ingest.parse_geo(decoded), {})
+
+    def test_ingest_and_backfill_fill_columns(self):
+        device = make_device(0)
+        package = ingest.apply_location(device, location_payload(1))
+        point = package.data_points.get()
+        self.assertEqual((point.lat, point.lon, point.accuracy), (39.9, 116.4, 30.0))
+
+        LocationData.objects.update(lat=None, lon=None, accuracy=None)
+        LocationData.objects.create(package=package, device=device, stamp=1, geo_decrypted='garbage')
+        call_command('backfill_geo', stdout=io.StringIO())
+        self.assertEqual(LocationData.objects.filter(lat=39.9, lon=116.4).count(), 1)
+        self.assertEqual(LocationData.objects.filter(lat__isnull=True).count(), 1)
+
+
+class LoggingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('teemog1_api.tests.trace')
+        self.logger.propagate = False
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+    def test_sampler_requires_debug_and_positive_rate(self):
+        self.logger.setLevel(logging.INFO)
+        self.assertFalse(any(PacketTraceSampler(self.logger, 1.0).sample() for _ in range(100)))
+        self.logger.setLevel(logging.DEBUG)
+        self.assertFalse(any(PacketTraceSampler(self.logger, 0).sample() for _ in range(100)))
+        self.assertTrue(all(PacketTraceSampler(self.logger, 1.0).sample() for _ in range(100)))
+        with mock.patch('teemog1_api.log.random.random', side_effect=[0.2, 0.7]):
+            sampler = PacketTraceSampler(self.logger, 0.5)
+            self.assertEqual([sampler.sample(), sampler.sample()], [True, False])
+
+    def test_queue_handler_delivers_records_before_stop_returns(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'server.log')
+        handler = AsyncQueueHandler(filename=path, console=False, fmt='%(levelname)s %(message)s')
+        atexit.unregister(handler.listener.stop)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.info("[*] 第 %d 条", 1)
+        self.logger.warning("[!] 第 %d 条", 2)
+        handler.listener.stop()
+        handler.listener.handlers[0].close()
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['INFO [*] 第 1 条', 'WARNING [!] 第 2 条'])
+
+    def test_queue_handler_drops_records_when_full(self):
+        handler = AsyncQueueHandler(console=False, queue_size=1)
+        handler.listener.stop()
+        atexit.unregister(handler.listener.stop)
+        record = self.logger.makeRecord(self.logger.name, logging.INFO, __file__, 0, 'x', (), None)
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(handler.dropped, 1)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_counter_renders_escaped_labels(self):
+        registry = Registry()
+        counter = Counter('test_total', '测试计数', ('path',), registry=registry)
+        counter.inc(path='a"b\\c\nd')
+        counter.inc(2, path='a"b\\c\nd')
+        counter.inc(path='x')
+        self.assertEqual(counter.value(path='x'), 1)
+        self.assertEqual(registry.render(), '# HELP test_total 测试计数\n# TYPE test_total counter\n'
+                                            'test_total{path="a\\"b\\\\c\\nd"} 3\n'
+                                            'test_total{path="x"} 1\n')
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', '测试耗时', ('kind',), buckets=(0.1, 1), registry=Registry())
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, kind='a')
+        self.assertEqual(histogram.collect(), [
+            'test_seconds_bucket{kind="a",le="0.1"} 2',
+            'test_seconds_bucket{kind="a",le="1"} 3',
+            'test_seconds_bucket{kind="a",le="+Inf"} 4',
+            'test_seconds_count{kind="a"} 4',
+            'test_seconds_sum{kind="a"} 3.65',
+        ])
+
+    def test_metrics_endpoint(self):
+        async def request(path: bytes) -> bytes:
+            server = await start_metrics_server('127.0.0.1', 0)
+            try:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                writer.write(b'GET ' + path + b' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                response = await reader.read()
+                writer.close()
+                return response
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        response = async_to_sync(request)(b'/metrics?x=1')
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'# TYPE teemo_frames_total counter', response)
+        self.assertTrue(async_to_sync(request)(b'/other').startswith(b'HTTP/1.1 404 Not Found\r\n'))
+
+
+class GroupCommitTests(TransactionTestCase):
+    databases = {'default', 'reader'}
+
+    def setUp(self):
+        self.committer = GroupCommitter(window=0.05, max_ops=10)
+        self.addCleanup(self.committer.stop)
+
+    def create_device(self, index: int):
+        if index == 3:
+            raise ValueError('bad op')
+        return WatchDevice.objects.create(udid='groupcommit%013d' % index, baby_id=index).pk
+
+    def test_ops_are_batched_and_failures_isolated(self):
+        async def run():
+            return await asyncio.gather(*(self.committer.submit(self.create_device, i) for i in range(6)),
+                                        return_exceptions=True)
+        results = async_to_sync(run)()
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(WatchDevice.objects.filter(udid__startswith='groupcommit').count(), 5)
+
+    def test_metrics_are_observed_on_the_event_loop(self):
+        threads = []
+
+        async def run():
+            with mock.patch('teemog1_api.group_commit.GROUP_COMMIT_OPS.observe',
+                            side_effect=lambda value: threads.append((threading.current_thread(), value))):
+                await asyncio.gather(*(self.committer.submit(self.create_device, i) for i in range(2)))
+                # 结果返回之后，指标回调已经在同一个事件循环中执行
+                await asyncio.sleep(0)
+            return threading.current_thread()
+
+        loop_thread = async_to_sync(run)()
+        self.assertEqual(threads, [(loop_thread, 2)])
+
+    def test_deferred_fk_error_fails_only_its_op(self):
+        device = make_device()
+
+        def create_sms(contact_id):
+            return SmsMessage.objects.create(device=device, contact_id=contact_id, phone='1', message='x',
+                                             stamp=timezone.now()).pk
+
+        async def run():
+            return await asyncio.gather(*(self.committer.submit(create_sms, contact_id)
+                                          for contact_id in (None, 999999, None)), return_exceptions=True)
+        results = async_to_sync(run)()
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertEqual(sorted(SmsMessage.objects.values_list('pk', flat=True)), sorted([results[0], results[2]]))
+
+
+class ReadWriteRouterTests(TransactionTestCase):
+    databases = {'default', 'reader'}
+
+    def test_reads_outside_transactions_use_reader(self):
+        router = ReadWriteRouter()
+        self.assertEqual(WatchDevice.objects.all().db, 'reader')
+        self.assertEqual(router.db_for_write(WatchDevice), 'default')
+        with transaction.atomic():
+            # 事务中的读取必须看到本事务的写入
+            self.assertEqual(WatchDevice.objects.all().db, 'default')
+        device = make_device()
+        self.assertEqual(WatchDevice.objects.get(pk=device.pk)._state.db, 'reader')
+
+
+@override_settings(SHARD_DATABASES=['default', 'reader'], SHARD_FANOUT_WORKERS=0)
+class ShardingTests(TransactionTestCase):
+    """用 default 和 reader 两个别名模拟两个分片 (同一个数据库)"""
+    databases = {'default', 'reader'}
+
+    def setUp(self):
+        shard_map.invalidate()
+
+    def tearDown(self):
+        shard_map.invalidate()
+
+    def test_router_follows_shard_map(self):
+        device = make_device()
+        router = ShardRouter()
+        alias = hash_alias(device.udid)
+        self.assertEqual(router.db_for_write(ChatLog, instance=ChatLog(device=device)), alias)
+        self.assertEqual(router.db_for_read(ChatLog, instance=device), alias)
+        self.assertIsNone(router.db_for_write(WatchDevice, instance=device))
+        self.assertEqual(DeviceShard.objects.get(device=device).alias, alias)
+
+        # 迁移后 (缓存失效) 路由到新分片
+        other = 'reader' if alias == 'default' else 'default'
+        DeviceShard.objects.filter(device=device).update(alias=other)
+        shard_map.invalidate(device.pk)
+        self.assertEqual(router.db_for_write(LocationData, instance=LocationData(device=device)), other)
+
+    def test_paginator_merges_shards(self):
+        devices = [make_device(0), make_device(1)]
+        for index, device in enumerate(devices):
+            ChatLog.objects.bulk_create([
+                ChatLog(device=device, message_id='msg-%d-%d' % (index, i), chat_type=1, content_type=2,
+                        from_user_id=1, to_id=2, stamp=1700000000000 + i // (index + 2), content_text='hi')
+                for i in range(55)
+            ])
+        querysets = {'default': ChatLog.objects.using('default').filter(device=devices[0]),
+                     'reader': ChatLog.objects.using('reader').filter(device=devices[1])}
+        paginator = ShardedKeysetPaginator(querysets, 20, 'stamp')
+
+        seen, cursor = [], None
+        while True:
+            rows, cursor = paginator.page(cursor)
+            seen.extend((obj.stamp, obj.pk) for obj in rows)
+            if cursor is None:
+                break
+        self.assertEqual(seen, sorted(ChatLog.objects.values_list('stamp', 'pk'), reverse=True))
+        with self.assertRaises(ValueError):
+            paginator.page('shard9~1_1')
+
+
+@override_settings(READ_DATABASE='default', REPLICA_DATABASES=['reader'], REPLICA_MAX_LAG=10)
+class ReplicaRoutingTests(TransactionTestCase):
+    """reader (同一个数据库) 作为副本，读库设为 default 以便区分"""
+    databases = {'default', 'reader'}
+
+    def setUp(self):
+        replicas.lag_monitor.reset()
+        self.addCleanup(replicas.lag_monitor.reset)
+
+    def test_reads_use_replica_until_a_write(self):
+        router = ReadWriteRouter()
+        self.assertEqual(router.db_for_read(WatchDevice), 'default')
+        # 没有心跳无法测量延迟，不使用副本
+        self.assertEqual(replicas.lag_monitor.lags(), {'reader': None})
+        with replicas.replica_reads():
+            self.assertEqual(router.db_for_read(WatchDevice), 'default')
+        ReplicaHeartbeat.objects.create(pk=1, stamp=time.time())
+        replicas.lag_monitor.reset()
+        with replicas.replica_reads() as state:
+            self.assertEqual(router.db_for_read(WatchDevice), 'reader')
+            router.db_for_write(WatchDevice)
+            self.assertEqual(router.db_for_read(WatchDevice), 'default')
+        self.assertTrue(state['pinned'])
+
+    def test_lagging_replica_is_skipped(self):
+        router = ReadWriteRouter()
+        ReplicaHeartbeat.objects.create(pk=1, stamp=time.time())
+        self.assertEqual(replicas.lag_monitor.lags(), {'reader': 0.0})
+        with mock.patch.object(replicas.lag_monitor, 'lags', return_value={'reader': 60.0}), replicas.replica_reads():
+            self.assertEqual(router.db_for_read(WatchDevice), 'default')
+
+    def test_middleware_pins_client_after_write(self):
+        factory = RequestFactory()
+
+        def view(request):
+            if request.method == 'POST':
+                make_device()
+            return HttpResponse(WatchDevice.objects.count())
+
+        middleware = ReplicaRoutingMiddleware(view)
+        ReplicaHeartbeat.objects.create(pk=1, stamp=time.time())
+        response = middleware(factory.post('/admin/teemog1_api/watchdevice/add/'))
+        self.assertEqual(response.cookies[replicas.REPLICA_PIN_COOKIE]['max-age'], settings.REPLICA_PIN_SECONDS)
+        response = middleware(factory.get('/admin/teemog1_api/watchdevice/'))
+        self.assertEqual(response['X-Replica-Lag'], 'reader=0.0s')
+
+        request = factory.get('/admin/teemog1_api/watchdevice/')
+        request.COOKIES[replicas.REPLICA_PIN_COOKIE] = '1'
+        self.assertNotIn('X-Replica-Lag', middleware(request))
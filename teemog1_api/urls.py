@@ -11,6 +11,7 @@ urlpatterns = [
     path('commoncontact/e1/del.do', views.delete_contact, name='delete_contact'),
     path('emoticon/package/info.do', views.get_emoticon_package_info, name='get_emoticon_package_info'),
     path('chat/image/upload.do', views.chat_image_upload, name='chat_image_upload'),
+    path('location/history/export.do', views.export_locations, name='export_locations'),
 
     path('login/passport/login.do', views.passport_login, name='passport_login'),
     path('user/info/get.do', views.android_client_user_info, name='android_client_user_info'),